@@ -0,0 +1,76 @@
+"""
+Compares the PlantUML generation with the buffered ``FileContext`` against a context 
+that opens and closes the output file on every write (the previous implementation).
+
+    python -m benchmarks.bench_file_context --elements 50000
+"""
+import argparse
+import builtins
+import os
+import pathlib
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_model
+from sofaman.generator.generator import Generator, Context
+from sofaman.generator.plantuml import PumlContext, PumlVisitor
+
+class _AppendPerWriteContext(Context):
+    """
+    Opens the file in append mode for each write.
+    """
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.desc_as_notes = False
+        with open(self.out_file, "w"): ...
+
+    def write(self, content):
+        with open(self.out_file, "a") as o:
+            o.write(content)
+
+    def name(self):
+        return pathlib.PurePath(self.out_file).stem
+
+class _OpenCounter:
+    def __init__(self):
+        self.count = 0
+        self._open = builtins.open
+
+    def __enter__(self):
+        def counting_open(*args, **kwargs):
+            self.count += 1
+            return self._open(*args, **kwargs)
+        builtins.open = counting_open
+        return self
+
+    def __exit__(self, *args):
+        builtins.open = self._open
+
+def _run(sofa_root, context_factory, out_file):
+    with _OpenCounter() as counter:
+        start = time.perf_counter()
+        Generator().generate(sofa_root, context_factory(out_file), PumlVisitor())
+        elapsed = time.perf_counter() - start
+    return elapsed, counter.count, os.path.getsize(out_file)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--elements", type=int, default=50_000)
+    args = parser.parse_args()
+
+    sofa_root = synthetic_model(args.elements)
+    with tempfile.TemporaryDirectory() as tmp:
+        naive_file, buffered_file = os.path.join(tmp, "model.puml"), os.path.join(tmp, "buffered", "model.puml")
+        os.mkdir(os.path.dirname(buffered_file))
+        naive = _run(sofa_root, _AppendPerWriteContext, naive_file)
+        buffered = _run(sofa_root, PumlContext, buffered_file)
+        with open(naive_file, "rb") as a, open(buffered_file, "rb") as b:
+            identical = a.read() == b.read()
+
+    print(f"{'context':<12}{'seconds':>10}{'opens':>10}{'bytes':>12}")
+    for label, (elapsed, opens, size) in (("per-write", naive), ("buffered", buffered)):
+        print(f"{label:<12}{elapsed:>10.3f}{opens:>10}{size:>12}")
+    print(f"speedup: {naive[0] / buffered[0]:.1f}x, identical output: {identical}")
+
+if __name__ == "__main__":
+    main()
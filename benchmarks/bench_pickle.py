@@ -0,0 +1,36 @@
+"""
+Measures the cost of sending the model to another process, i.e. of pickling and unpickling it, 
+on synthetic models of increasing size, scaled to 100k elements. The root ("root") is compared with 
+its attributes pickled as they are ("as_is"), indexes included, as before the root defined how it is 
+pickled.
+
+    python -m benchmarks.bench_pickle --sizes 10000 100000
+"""
+import argparse
+import pickle
+import time
+
+from benchmarks.synthetic import synthetic_model
+
+def _run(obj):
+    start = time.perf_counter()
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    dumped = time.perf_counter()
+    pickle.loads(data)
+    return dumped - start, time.perf_counter() - dumped, len(data)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    print(f"{'size':>10}{'state':>10}{'dump s':>10}{'load s':>10}{'MiB':>8}   (per 100k elements)")
+    for size in args.sizes:
+        sofa_root = synthetic_model(size)
+        for name, obj in (("as_is", dict(vars(sofa_root))), ("root", sofa_root)):
+            dumped, loaded, length = _run(obj)
+            scale = 100_000 / size
+            print(f"{size:>10}{name:>10}{dumped * scale:>10.2f}{loaded * scale:>10.2f}{length * scale / 2**20:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares the PlantUML output with one package block per package (grouped), with one package
+block per element, and rendered with the default templates, on synthetic models of increasing
+size: the time to produce it, its size and the number of package blocks.
+
+    python -m benchmarks.bench_puml --sizes 10000 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_model
+from sofaman.generator.generator import Generator
+from sofaman.generator.plantuml import PumlVisitor, PumlContext
+from sofaman.generator.plantuml_template import PumlTemplateVisitor
+
+MODES = {
+    "grouped": lambda: PumlVisitor(),
+    "per_element": lambda: PumlVisitor(group_packages=False),
+    "template": lambda: PumlTemplateVisitor(),
+}
+
+def _run(sofa_root, mode, out_file):
+    start = time.perf_counter()
+    # Descriptions are rendered as notes, which is the most expensive rendering.
+    with PumlContext(out_file, desc_as_notes=True) as context:
+        Generator().generate(sofa_root, context, MODES[mode]())
+    return time.perf_counter() - start
+
+def _count_packages(out_file):
+    with open(out_file) as f:
+        return sum(1 for line in f if line.startswith("package "))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    print(f"{'size':>10}{'mode':>12}{'seconds':>10}{'MiB':>8}{'packages':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        out_file = os.path.join(tmp, "model.puml")
+        for size in args.sizes:
+            sofa_root = synthetic_model(size)
+            for mode in MODES:
+                elapsed = _run(sofa_root, mode, out_file)
+                print(f"{size:>10}{mode:>12}{elapsed:>10.2f}{os.path.getsize(out_file) / 2**20:>8.1f}"
+                      f"{_count_packages(out_file):>10}")
+
+if __name__ == "__main__":
+    main()
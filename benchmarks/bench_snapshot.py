@@ -0,0 +1,65 @@
+"""
+Compares loading the model from a pickle against opening its snapshot (see ``sofaman.ir.snapshot``),
+on synthetic models of increasing size: the time to load or open it, to look up an element by name 
+in it, and to generate PlantUML from it, and the size of the file.
+
+    python -m benchmarks.bench_snapshot --sizes 10000 100000
+"""
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_model
+from sofaman.generator.generator import Generator, BufferContext
+from sofaman.generator.plantuml import PumlVisitor
+from sofaman.ir.snapshot import SnapshotRoot, write_snapshot
+
+class _Context(BufferContext):
+    desc_as_notes = False
+
+    def name(self):
+        return "bench"
+
+def _load_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def _run(open_model, path, qname):
+    start = time.perf_counter()
+    sofa_root = open_model(path)
+    opened = time.perf_counter()
+    sofa_root.get_by_qname(qname)
+    looked_up = time.perf_counter()
+    Generator().generate(sofa_root, _Context(), PumlVisitor())
+    done = time.perf_counter()
+    return opened - start, looked_up - opened, done - looked_up
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+    # Elements refer to each other deeply.
+    sys.setrecursionlimit(100_000)
+
+    print(f"{'size':>10}{'format':>10}{'open s':>10}{'lookup ms':>11}{'puml s':>10}{'MiB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            sofa_root = synthetic_model(size)
+            pickle_file = os.path.join(tmp, "model.pickle")
+            snapshot_file = os.path.join(tmp, "model.snapshot")
+            with open(pickle_file, "wb") as f:
+                pickle.dump(sofa_root, f)
+            write_snapshot(sofa_root, snapshot_file)
+            qname = sofa_root.classes[len(sofa_root.classes.elems) // 2].get_qname()
+            del sofa_root
+
+            for name, open_model, path in (("pickle", _load_pickle, pickle_file), ("snapshot", SnapshotRoot, snapshot_file)):
+                opened, looked_up, generated = _run(open_model, path, qname)
+                print(f"{size:>10}{name:>10}{opened:>10.3f}{looked_up * 1000:>11.3f}{generated:>10.2f}"
+                      f"{os.path.getsize(path) / 2**20:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures the XMI generation throughput (model elements per second) on synthetic models of
+increasing size, in both XMI flavors and with both XMI engines.
+
+    python -m benchmarks.bench_xmi --sizes 10000 100000 1000000 --json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_model
+from sofaman.generator.generator import Generator
+from sofaman.generator.uml2 import XmiVisitor, XmiContext, XmiFlavor
+from sofaman.generator.uml2_stream import XmiStreamVisitor
+from sofaman.generator.uml2_parallel import XmiParallelVisitor
+
+ENGINES = {"dom": XmiVisitor, "stream": XmiStreamVisitor, "parallel": XmiParallelVisitor}
+FLAVORS = {"normal": XmiFlavor.NORMAL, "sparx_ea": XmiFlavor.SPARX_EA}
+
+def _count_elements(sofa_root):
+    return sum(len(elems.elems) for elems in (sofa_root.packages, sofa_root.primitives, sofa_root.classes,
+                                              sofa_root.components, sofa_root.relations))
+
+def _run(sofa_root, engine, flavor, out_file):
+    start = time.perf_counter()
+    with XmiContext(out_file, mode=FLAVORS[flavor]) as context:
+        Generator().generate(sofa_root, context, ENGINES[engine]())
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--engines", nargs="+", choices=ENGINES.keys(), default=list(ENGINES.keys()))
+    parser.add_argument("--json", help="Appends the results to the given JSON file, to track them over time")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'size':>10}{'flavor':>10}{'engine':>10}{'seconds':>10}{'elements/s':>12}{'MiB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        out_file = os.path.join(tmp, "model.xmi")
+        for size in args.sizes:
+            sofa_root = synthetic_model(size)
+            elements = _count_elements(sofa_root)
+            for flavor in FLAVORS:
+                for engine in args.engines:
+                    elapsed = _run(sofa_root, engine, flavor, out_file)
+                    result = {"size": size, "flavor": flavor, "engine": engine, "elements": elements,
+                              "seconds": elapsed, "elements_per_second": elements / elapsed,
+                              "bytes": os.path.getsize(out_file)}
+                    results.append(result)
+                    print(f"{size:>10}{flavor:>10}{engine:>10}{elapsed:>10.2f}{result['elements_per_second']:>12.0f}"
+                          f"{result['bytes'] / 2**20:>8.1f}")
+
+    if args.json:
+        history = []
+        if os.path.exists(args.json):
+            with open(args.json) as f:
+                history = json.load(f)
+        history.append({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                        "results": results})
+        with open(args.json, "w") as f:
+            json.dump(history, f, indent=2)
+
+if __name__ == "__main__":
+    main()
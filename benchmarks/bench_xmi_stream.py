@@ -0,0 +1,59 @@
+"""
+Compares the DOM and the streaming XMI engines on a synthetic model. Each engine runs in
+a separate process, so that the peak memory (max RSS) of each can be reported.
+
+    python -m benchmarks.bench_xmi_stream --elements 100000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_model
+from sofaman.generator.generator import Generator
+from sofaman.generator.uml2 import XmiVisitor, XmiContext, XmiFlavor
+from sofaman.generator.uml2_stream import XmiStreamVisitor
+
+ENGINES = {"dom": XmiVisitor, "stream": XmiStreamVisitor}
+
+def _run_engine(engine, elements, out_file):
+    sofa_root = synthetic_model(elements)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    with XmiContext(out_file, mode=XmiFlavor.SPARX_EA) as context:
+        Generator().generate(sofa_root, context, ENGINES[engine]())
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Peak increase over the model itself, in KiB (Linux).
+    print(f"{elapsed} {peak_rss - base_rss}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--elements", type=int, default=100_000)
+    parser.add_argument("--engine", choices=ENGINES.keys(), help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.engine:
+        _run_engine(args.engine, args.elements, args.out)
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in ENGINES:
+            out_file = os.path.join(tmp, engine, "model.xmi")
+            os.mkdir(os.path.dirname(out_file))
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_xmi_stream", "--elements", str(args.elements),
+                                     "--engine", engine, "--out", out_file], check=True, capture_output=True, text=True).stdout
+            elapsed, rss = output.split()
+            results[engine] = (float(elapsed), int(rss), os.path.getsize(out_file))
+
+    print(f"{'engine':<10}{'seconds':>10}{'peak MiB':>12}{'bytes':>14}")
+    for engine, (elapsed, rss, size) in results.items():
+        print(f"{engine:<10}{elapsed:>10.3f}{rss / 1024:>12.1f}{size:>14}")
+
+if __name__ == "__main__":
+    main()
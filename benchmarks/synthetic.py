@@ -0,0 +1,55 @@
+"""
+Builds synthetic sofa models of a given size for the benchmarks. The models are built 
+directly as IR, since parsing large sofa files would dominate the measurements.
+"""
+from sofaman.ir.model import (SofaRoot, Struct, Package, Primitive, Class, 
+                              Component, Relation, RelationType)
+
+def synthetic_model(elements, packages=10, sub_packages=5, relations_per_element=1):
+    """
+    Builds a model with roughly the given number of classes and components, spread over 
+    nested packages. Every element is related to its successor(s), and half of the 
+    elements carry attributes, operations, descriptions and stereotypes. The attributes include 
+    one typed by the next of these elements, so that the types form a chain.
+    """
+    sofa_root = SofaRoot()
+
+    pkg_names = []
+    for p in range(packages):
+        pkg_names.append(f"P{p}")
+        for s in range(sub_packages):
+            pkg_names.append(f"P{p}.S{s}")
+    sofa_root.packages.extend(map(lambda n: Package(Struct(n, [], {"visibility": "public"})), pkg_names))
+    sofa_root.primitives.extend([Primitive(Struct("String")), Primitive(Struct("Boolean"))])
+
+    names = []
+    for i in range(elements):
+        name = f"E{i}"
+        names.append(name)
+        props = {"package": pkg_names[i % len(pkg_names)]}
+        if i % 2 == 0:
+            props["description"] = f"Element {i} of the synthetic model"
+            props["attributes"] = {
+                "id": {"cardinality": "1", "type": "String", "visibility": "public"},
+                "active": {"cardinality": "0..1", "type": "Boolean"},
+            }
+            if i + 2 < elements:
+                props["attributes"]["next"] = {"cardinality": "0..1", "type": f"E{i + 2}"}
+            props["operations"] = {"run": {"parameters": ["a", "b"]}}
+        if i % 3 == 0:
+            sofa_root.components.append(Component(Struct(name, [], props | {"ports": ["443"]})))
+        else:
+            sofa_root.classes.append(Class(Struct(name, [], props)))
+
+    rel_types = [RelationType.ASSOCIATION, RelationType.INFORMATION_FLOW, RelationType.COMPOSITION,
+                 RelationType.BI_ASSOCIATION, RelationType.AGGREGATION]
+    for i in range(elements - 1):
+        for r in range(relations_per_element):
+            source, target = names[i], names[(i + 1 + r) % elements]
+            rel_type = rel_types[(i + r) % len(rel_types)]
+            sofa_root.relations.append(Relation(rel_type, source, None, target, None, 
+                                                Struct(f"{source}_{rel_type.name}_{target}", [], {})))
+
+    sofa_root.add_children([sofa_root.packages, sofa_root.primitives, sofa_root.classes, 
+                            sofa_root.components, sofa_root.relations])
+    return sofa_root
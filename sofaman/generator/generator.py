@@ -3,7 +3,23 @@ This module contains basic support for generating output from the sofa model usi
 """
 from sofaman.ir.model import SofaRoot, Visitor
 from typing import Protocol
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
 import pathlib
+import queue
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError: # Not on Windows, where the manifest is not locked
+    fcntl = None
 
 class Context(Protocol):
     """
@@ -21,37 +37,265 @@ class Context(Protocol):
         """
         self.write(content + "\n")
 
+    def close(self):
+        """
+        Releases the resources held by the context, if any.
+        """
+        ...
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 class BufferContext(Context):
     """
-    Context with content stored in a buffer.
+    Context with content stored in a buffer. The content is kept as a list of chunks, 
+    which are joined only when the content is requested.
     """
     
     def __init__(self):
-        self.content = ""
+        self._chunks = []
     
     def write(self, content):
-        self.content += content
+        self._chunks.append(content)
     
     def get_content(self):
         """
         Gets content from the buffer.
         """
-        return self.content
+        if len(self._chunks) > 1:
+            # Keep the joined content, so that subsequent calls are cheap.
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    @property
+    def content(self):
+        """
+        The content of the buffer.
+        """
+        return self.get_content()
+
+class BytesBufferContext(Context):
+    """
+    Context with binary content stored in a buffer. Text content is encoded before it is stored.
+    """
+
+    def __init__(self, encoding = "utf-8"):
+        self.encoding = encoding
+        self.buffer = io.BytesIO()
+
+    def write(self, content):
+        if isinstance(content, str):
+            content = content.encode(self.encoding)
+        self.buffer.write(content)
+
+    def stream(self):
+        """
+        Returns the underlying binary stream, for writers that produce bytes.
+        """
+        return self.buffer
+
+    def get_content(self):
+        """
+        Gets a copy of the content from the buffer.
+        """
+        return self.buffer.getvalue()
+
+    def get_view(self):
+        """
+        Gets a read-only view of the content without copying it. 
+        The buffer cannot be written to while the view is in use.
+        """
+        return self.buffer.getbuffer().toreadonly()
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+class OutputManifest:
+    """
+    Manifest of the files produced by the generation, with the SHA-256 hash of the content of each, 
+    so that unchanged files need not be written again (see ``FileContext``). Other tools can use it 
+    as well. The manifest is a JSON file next to the files (see ``next_to``), where the files are 
+    keyed by their path relative to it.
+
+    Files are recorded as they are produced, and the records are merged into the manifest file under 
+    a lock on ``save``, as the files of a generation may be produced by several processes. Forked 
+    workers (see ``fork_map``) save their records right away. The manifest can be used as a context 
+    manager, which saves it at the end of the block.
+    """
+
+    FILE_NAME = "sofaman.manifest.json"
+    FORMAT = 1
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self._dir = os.path.dirname(os.path.abspath(manifest_file))
+        self._pid = os.getpid()
+        # Key -> {"sha256", "size", "mtime_ns"}, as of the last generation
+        self._files = self._read()
+        self._pending = {}
+
+    @classmethod
+    def next_to(cls, out_file):
+        """
+        Returns the manifest of the directory of the given file.
+        """
+        return cls(os.path.join(os.path.dirname(os.path.abspath(out_file)), cls.FILE_NAME))
+
+    def _read(self):
+        try:
+            with open(self.manifest_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {} # Missing or unreadable, so every file is written again
+        return data.get("files", {}) if data.get("format") == self.FORMAT else {}
+
+    def _key(self, path):
+        return pathlib.PurePath(os.path.relpath(os.path.abspath(path), self._dir)).as_posix()
+
+    def digest(self, path):
+        """
+        Returns the recorded hash of the given file, if the file has not changed since. 
+        """
+        entry = self._files.get(self._key(path))
+        if entry is None: return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        # Same as git, the file is trusted to be unchanged if its size and time are.
+        if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]): return None
+        return entry["sha256"]
+
+    def is_unchanged(self, path, digest):
+        """
+        Returns whether the given file exists with content of the given hash.
+        """
+        if not os.path.exists(path): return False
+        recorded = self.digest(path)
+        return (recorded or _file_digest(path)) == digest
+
+    def record(self, path, digest):
+        """
+        Records the hash of the given file, which has just been produced.
+        """
+        stat = os.stat(path)
+        key = self._key(path)
+        self._files[key] = self._pending[key] = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        # Forked workers end without returning to the code that saves the manifest.
+        if os.getpid() != self._pid: self.save()
+
+    def replace(self, tmp_file, path):
+        """
+        Replaces the given file by the temporary file, which has just been produced, if their content 
+        differs; otherwise the temporary file is removed. Records the hash either way, and returns 
+        whether the file was replaced.
+        """
+        digest = _file_digest(tmp_file)
+        changed = not self.is_unchanged(path, digest)
+        if changed:
+            os.replace(tmp_file, path)
+        else:
+            os.remove(tmp_file)
+        self.record(path, digest)
+        return changed
+
+    def lock_file(self):
+        """
+        Returns the lock file of the manifest, in the temporary directory, so that none is left next 
+        to the files. The manifest itself cannot be locked, as it is replaced when saved.
+        """
+        name = hashlib.sha256(os.path.abspath(self.manifest_file).encode()).hexdigest()[:32]
+        return os.path.join(tempfile.gettempdir(), f"sofaman-manifest-{name}.lock")
+
+    @contextlib.contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        # Read-only, so that a lock file created by another user can be locked as well.
+        fd = os.open(self.lock_file(), os.O_RDONLY | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def save(self):
+        """
+        Merges the records into the manifest file.
+        """
+        if not self._pending: return
+        with self._lock():
+            files = self._read()
+            files.update(self._pending)
+            tmp_file = f"{self.manifest_file}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"format": self.FORMAT, "files": dict(sorted(files.items()))}, f, indent=2)
+            os.replace(tmp_file, self.manifest_file)
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
 
 class FileContext(Context):
     """
-    Context with content stored in a file.
+    Context with content stored in a file. The file is opened once and the writes 
+    are buffered. The file is closed by the visitor at the end of the visit, or when 
+    the context is used as a context manager, at the end of the block.
+
+    With a manifest (see ``OutputManifest``), the content is written to a temporary file next 
+    to the file, which replaces the file on close only if the content changed; otherwise the 
+    file is left untouched, along with its modification time. ``changed`` tells which it was.
     """
 
-    def __init__(self, out_file):
+    def __init__(self, out_file, manifest = None):
         self.out_file = out_file
-        # Not nice. Hack for the moment to ensure old data is removed.
-        with open(self.out_file, "w"): ...
+        self.manifest = manifest
+        self.changed = None
+        if manifest is None:
+            # Truncates the old data, if any.
+            self._file = open(self.out_file, "w")
+        else:
+            path = pathlib.PurePath(os.path.abspath(out_file))
+            self._tmp_file = str(path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp"))
+            self._file = open(self._tmp_file, "w")
 
     def write(self, content):
-        # Yes, a very naive implementation for the moment
-        with open(self.out_file, "a") as o:
-            o.write(content)
+        self._file.write(content)
+
+    def stream(self):
+        """
+        Returns the binary stream of the file, for writers that produce bytes.
+        Content written earlier through ``write`` is flushed first.
+        """
+        self._file.flush()
+        return self._file.buffer
+
+    def close(self):
+        """
+        Flushes the buffered content and closes the file.
+        """
+        if self._file.closed: return
+        self._file.close()
+        if self.manifest is None: return
+        self.changed = self.manifest.replace(self._tmp_file, self.out_file)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or self.manifest is None or self._file.closed:
+            return super().__exit__(exc_type, exc_value, traceback)
+        # Incomplete content does not replace the file.
+        self._file.close()
+        os.remove(self._tmp_file)
     
     def name(self):
         """
@@ -59,6 +303,138 @@ class FileContext(Context):
         """
         return pathlib.PurePath(self.out_file).stem
 
+# Function and items of the running fork_map, inherited by the worker processes when they are forked.
+_worker_state = None
+
+def _call_worker(index):
+    fn, items = _worker_state
+    return fn(items[index])
+
+def fork_map(fn, items, workers = None):
+    """
+    Maps the function over the items in a pool of forked processes, and yields the results in order.
+    The workers inherit the state of this process, so neither the function nor the items are 
+    serialized; only the results are. Where forking is not available, with a single worker, or 
+    with less than two items, the items are mapped in this process. So are they when other threads
+    run (e.g. those of ``FanOutVisitor``), as a forked worker could wait forever for a lock held 
+    by one of them.
+    """
+    workers = workers or os.cpu_count() or 1
+    if (len(items) < 2 or workers < 2 or threading.active_count() > 1
+            or "fork" not in multiprocessing.get_all_start_methods()):
+        yield from map(fn, items)
+        return
+
+    global _worker_state
+    _worker_state = (fn, items)
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            yield from executor.map(_call_worker, range(len(items)))
+    finally:
+        _worker_state = None
+
+class _VisitorThread(threading.Thread):
+    """
+    Thread that makes the visits of a single visitor, in the order in which they are queued.
+    """
+
+    # Bounds the visits queued ahead of a slower visitor.
+    QUEUE_SIZE = 1024
+
+    def __init__(self, context, visitor):
+        super().__init__(daemon=True)
+        self.context = context
+        self.visitor = visitor
+        self.visits = queue.Queue(self.QUEUE_SIZE)
+        self.error = None
+
+    def run(self):
+        while True:
+            visit = self.visits.get()
+            if visit is None: return
+            # After an error, the remaining visits are only consumed.
+            if self.error: continue
+            method, obj = visit
+            try:
+                getattr(self.visitor, method)(self.context, obj)
+            except BaseException as e:
+                self.error = e
+
+class FanOutVisitor(Visitor):
+    """
+    Visitor that drives several visitors, each with its own context, from a single traversal 
+    of the model. So the model is built and validated once for all the outputs. The context 
+    given to the visit methods is not used.
+
+    With ``threaded``, each visitor runs in a thread of its own, so that writing one output 
+    overlaps with generating the others. Only I/O and the parts that release the GIL (such as 
+    the serialization of lxml) run concurrently.
+    """
+
+    def __init__(self, targets, threaded = False):
+        # [(context, visitor)]
+        self.targets = list(targets)
+        self.threaded = threaded
+        self._threads = []
+
+    def _visit(self, method, obj):
+        if self._threads:
+            for thread in self._threads:
+                thread.visits.put((method, obj))
+        else:
+            for context, visitor in self.targets:
+                getattr(visitor, method)(context, obj)
+
+    def visit_root(self, context, sofa_root):
+        if self.threaded and len(self.targets) > 1:
+            self._threads = [_VisitorThread(ctx, visitor) for ctx, visitor in self.targets]
+            for thread in self._threads:
+                thread.start()
+        self._visit("visit_root", sofa_root)
+
+    def visit_diagram(self, context, diagram):
+        self._visit("visit_diagram", diagram)
+
+    def visit_package(self, context, package):
+        self._visit("visit_package", package)
+
+    def visit_stereotype_profile(self, context, stereotype_profile):
+        self._visit("visit_stereotype_profile", stereotype_profile)
+
+    def visit_primitive(self, context, primitive):
+        self._visit("visit_primitive", primitive)
+
+    def visit_actor(self, context, actor):
+        self._visit("visit_actor", actor)
+
+    def visit_component(self, context, component):
+        self._visit("visit_component", component)
+
+    def visit_relation(self, context, relation):
+        self._visit("visit_relation", relation)
+
+    def visit_interface(self, context, interface):
+        self._visit("visit_interface", interface)
+
+    def visit_class(self, context, clazz):
+        self._visit("visit_class", clazz)
+
+    def visit_domain(self, context, domain):
+        self._visit("visit_domain", domain)
+
+    def visit_capability(self, context, capability):
+        self._visit("visit_capability", capability)
+
+    def visit_end(self, context, sofa_root):
+        self._visit("visit_end", sofa_root)
+        threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.visits.put(None)
+            thread.join()
+        # Reported once all the outputs are done.
+        for thread in threads:
+            if thread.error: raise thread.error
+
 class Generator:
     """
     Generates an output from the sofa model.
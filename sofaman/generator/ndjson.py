@@ -0,0 +1,150 @@
+"""
+Module that generates newline-delimited JSON (NDJSON) from the Sofa model, and loads it back.
+"""
+import json
+from sofaman.generator.generator import Visitor
+from sofaman.ir.model import (SofaRoot, Struct, KeyValue, Diagram, Package, StereoTypeProfile, Domain,
+                              Capability, Actor, Primitive, Interface, Class, Component, Relation,
+                              RelationType, Port)
+
+FORMAT = 1
+
+# Kind of record -> (element class, group of the root), in the order of visiting
+KINDS = {
+    "diagram": (Diagram, "diagrams"),
+    "package": (Package, "packages"),
+    "stereotype_profile": (StereoTypeProfile, "stereotype_profiles"),
+    "domain": (Domain, "domains"),
+    "capability": (Capability, "capabilities"),
+    "actor": (Actor, "actors"),
+    "primitive": (Primitive, "primitives"),
+    "interface": (Interface, "interfaces"),
+    "class": (Class, "classes"),
+    "component": (Component, "components"),
+    "relation": (Relation, "relations"),
+}
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+class NdjsonVisitor(Visitor):
+    """
+    Visitor that writes the model as NDJSON, one record per line, as the elements are visited, so
+    that it takes constant memory. The first record is ``{"kind": "model", "format": 1}``.
+    The other records have a ``kind`` (the name of the visit method, e.g. ``"class"``), and
+    depending on it:
+
+    * diagrams: ``name``, ``type``, ``properties``
+    * stereotype profiles: ``id``, ``name``, ``stereotypes``
+    * other elements: ``id``, ``name``, ``qname``, ``package_id`` (of the parent package, or null),
+      ``inheritance``, ``properties`` (as declared)
+    * relations, in addition: ``type``, and ``source`` and ``target`` with the ``name`` and ``port``
+      they refer to, and the ``ref_id`` of the element (null if it is not defined)
+
+    The keys are always present and in this order. Since the IDs of the elements are kept, the
+    records can be processed independently, e.g. by jq or Spark. See ``load_ndjson`` for the reverse.
+    """
+
+    def visit_root(self, context, sofa_root):
+        context.write_ln(_dumps({"kind": "model", "format": FORMAT}))
+
+    def _element(self, kind, elem):
+        parent = elem.parent_package
+        return {"kind": kind, "id": elem.id, "name": elem.get_name(), "qname": elem.get_qname(),
+                "package_id": parent.id if parent is not None else None,
+                "inheritance": elem.struct.inheritance, "properties": elem.struct.properties}
+
+    def _endpoint(self, endpoint):
+        return {"name": endpoint.name, "port": endpoint.port.get_name() if endpoint.port else None,
+                "ref_id": endpoint.ref.id if endpoint.ref is not None else None}
+
+    def _write_element(self, context, kind, elem):
+        context.write_ln(_dumps(self._element(kind, elem)))
+
+    def visit_diagram(self, context, diagram):
+        properties = diagram.diagram.value if isinstance(diagram.diagram, KeyValue) else {}
+        context.write_ln(_dumps({"kind": "diagram", "name": diagram.get_name(),
+                                 "type": diagram.get_type().value, "properties": properties}))
+
+    def visit_package(self, context, package):
+        self._write_element(context, "package", package)
+
+    def visit_stereotype_profile(self, context, stereotype_profile):
+        context.write_ln(_dumps({"kind": "stereotype_profile", "id": stereotype_profile.id,
+                                 "name": stereotype_profile.get_name(), "stereotypes": stereotype_profile.stereotypes}))
+
+    def visit_domain(self, context, domain):
+        self._write_element(context, "domain", domain)
+
+    def visit_capability(self, context, capability):
+        self._write_element(context, "capability", capability)
+
+    def visit_actor(self, context, actor):
+        self._write_element(context, "actor", actor)
+
+    def visit_primitive(self, context, primitive):
+        self._write_element(context, "primitive", primitive)
+
+    def visit_interface(self, context, interface):
+        self._write_element(context, "interface", interface)
+
+    def visit_class(self, context, clazz):
+        self._write_element(context, "class", clazz)
+
+    def visit_component(self, context, component):
+        self._write_element(context, "component", component)
+
+    def visit_relation(self, context, relation):
+        record = self._element("relation", relation)
+        record["type"] = relation.type.value
+        record["source"] = self._endpoint(relation.source)
+        record["target"] = self._endpoint(relation.target)
+        context.write_ln(_dumps(record))
+
+    def visit_end(self, context, sofa_root):
+        context.close()
+
+def _build_element(kind, record):
+    clazz, _ = KINDS[kind]
+    if kind == "diagram":
+        properties = record["properties"]
+        return Diagram(KeyValue(record["name"], properties) if properties else record["name"])
+    if kind == "stereotype_profile":
+        elem = StereoTypeProfile(record["name"], record["stereotypes"])
+    else:
+        name = record["name"]
+        # Packages are named by their qualified name, so that the intermediate packages are
+        # placed as before (unless the package is placed by a property).
+        if kind == "package" and "package" not in record["properties"]: name = record["qname"]
+        struct = Struct(name, record["inheritance"], record["properties"])
+        if kind == "relation":
+            source, target = record["source"], record["target"]
+            elem = Relation(RelationType(record["type"]), source["name"], source["port"] and Port(source["port"]),
+                            target["name"], target["port"] and Port(target["port"]), struct)
+        else:
+            elem = clazz(struct)
+    elem.id = record["id"]
+    return elem
+
+def load_ndjson(ndjson_file):
+    """
+    Loads the model from an NDJSON file written by ``NdjsonVisitor``, without parsing the Sofa model
+    again. The elements keep their IDs, and the model is linked as after parsing, but it is not
+    validated. The file is read line by line.
+    """
+    sofa_root = SofaRoot()
+    with open(ndjson_file, encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("kind") != "model" or header.get("format") != FORMAT:
+            raise AssertionError(f"{ndjson_file} is not a Sofa NDJSON file of format {FORMAT}")
+        for line in f:
+            if not line.strip(): continue
+            record = json.loads(line)
+            kind = record.get("kind")
+            if kind not in KINDS:
+                raise AssertionError(f"Unknown kind of record {kind} in {ndjson_file}")
+            getattr(sofa_root, KINDS[kind][1]).append(_build_element(kind, record))
+
+    groups = [getattr(sofa_root, group) for _, group in KINDS.values()]
+    sofa_root.add_children([group for group in groups if group.elems])
+    return sofa_root
@@ -2,37 +2,110 @@
 """
 Module that generates PlantUML files from the Sofa model.
 """
+import pathlib
+import re
 from textwrap import dedent
-from sofaman.generator.generator import FileContext, Visitor
+from sofaman.generator.generator import BufferContext, FileContext, Visitor, fork_map
 from sofaman.ir.model import RelationType, Attribute, Port
 
 class PumlContext(FileContext):
     """
     PlantUML context with content stored in a file.
     """
-    def __init__(self, out_file, desc_as_notes = False):
-        super().__init__(out_file)
+    def __init__(self, out_file, desc_as_notes = False, manifest = None):
+        super().__init__(out_file, manifest)
         self.desc_as_notes = desc_as_notes
 
+    def diagram(self, name):
+        """
+        Creates the context of a separate diagram, stored in a file next to this one.
+        """
+        path = pathlib.PurePath(self.out_file)
+        return PumlContext(str(path.with_name(f"{path.stem}.{name}{path.suffix}")), self.desc_as_notes, self.manifest)
+
+class _PackageContext(BufferContext):
+    """
+    Buffer of the members of a package, until the package is rendered.
+    """
+    def __init__(self, context):
+        super().__init__()
+        self.desc_as_notes = context.desc_as_notes
+
 class PumlVisitor(Visitor):
     """
-    PlantUML visitor that generates PlantUML code.
+    PlantUML visitor that generates PlantUML code. 
+    
+    Each package is rendered once, with its members and nested packages, after the elements
+    (see ``_write_packages``). With ``group_packages`` off, each element is wrapped in a package 
+    block of its own instead, as in earlier versions.
+
+    With ``bundle_relations`` set to ``"count"`` or ``"names"``, relations of the same type between 
+    the same elements are drawn as one edge, labeled with their number or their names, and opposite 
+    associations and flows are drawn as one bidirectional edge (see ``_bundles``).
     """
     INDENT = " " * 4
+    BUNDLE_LABELS = ("count", "names")
+    # Relation types that are merged with their opposite into the bidirectional type, by name
+    OPPOSITES = {RelationType.ASSOCIATION.name: RelationType.BI_ASSOCIATION.name, 
+                 RelationType.INFORMATION_FLOW.name: RelationType.BI_INFO_FLOW.name}
 
     # In general the rendering puts newline in at first instead of later,
-    # this is because PlantUML is a bit finicky on braces on a new line.
+    # this is because PlantUML is a bit finicky on braces on a new line.
     # Putting newline in front avoids some conditional checks.
 
+    def __init__(self, group_packages = True, bundle_relations = None):
+        if bundle_relations is not None and bundle_relations not in self.BUNDLE_LABELS:
+            raise AssertionError(f"Relations must be bundled by {'|'.join(self.BUNDLE_LABELS)}")
+        self.group_packages = group_packages
+        self.bundle_relations = bundle_relations
+        # Package name -> members of the package
+        self._packages = {}
+        # (source, target, type name) -> relations, when bundled
+        self._relations = {}
+
     def visit_root(self, context, sofa_root): 
+        self._packages = {}
+        self._relations = {}
+        self._write_header(context)
+
+    def _write_header(self, context):
         context.write_ln(f"@startuml {context.name()}\nallowmixing")
     
     def visit_package(self, context, package): 
         ... # Packages are rendered only when they are referenced by other objects
 
+    def _package_context(self, context, obj):
+        # Members of a package are kept until the package is rendered.
+        if not self.group_packages or obj.package() is None: return context
+        package_context = self._packages.get(obj.package())
+        if package_context is None:
+            package_context = self._packages[obj.package()] = _PackageContext(context)
+        return package_context
+
     def _wrap_inside_package(self, context, obj, content):
-        if obj.package() is None: return content
+        if self.group_packages or obj.package() is None: return content
         return f"\npackage {obj.package()} {{ {content} \n}}"
+
+    def _write_packages(self, context):
+        """
+        Renders each package with its members, nesting the packages by their qualified names.
+        """
+        if not self._packages: return
+        tree = {}
+        for name in self._packages:
+            node = tree
+            for part in name.split("."):
+                node = node.setdefault(part, {})
+        self._write_package_tree(context, tree, None)
+        self._packages = {}
+
+    def _write_package_tree(self, context, tree, parent):
+        for name, children in tree.items():
+            qname = f"{parent}.{name}" if parent else name
+            context.write(f"\npackage {name} {{ ")
+            if qname in self._packages: context.write(self._packages[qname].content)
+            self._write_package_tree(context, children, qname)
+            context.write("\n}")
     
     def _sterotype(self, context, obj):
         if obj.stereotypes() is None: return ""
@@ -50,6 +123,7 @@ class PumlVisitor(Visitor):
         """))
 
     def visit_primitive(self, context, primitive): 
+        context = self._package_context(context, primitive)
         context.write_ln(self._wrap_inside_package(context, primitive, f"\nclass {primitive.get_name()} {self._sterotype(context, primitive)}"))
         self._description(context, primitive)
 
@@ -58,10 +132,12 @@ class PumlVisitor(Visitor):
     def visit_stereotype_profile(self, context, stereotype): ...
     
     def visit_actor(self, context, actor): 
+        context = self._package_context(context, actor)
         context.write_ln(self._wrap_inside_package(context, actor, f"\nactor {actor.get_name()} {self._sterotype(context, actor)}"))
         self._description(context, actor)
 
     def visit_component(self, context, component):
+        context = self._package_context(context, component)
         context.write(self._wrap_inside_package(context, component, f"\ncomponent {component.get_name()} {self._sterotype(context, component)} {self._gen_ports(context, component)}"))
         self._description(context, component)
 
@@ -81,7 +157,48 @@ class PumlVisitor(Visitor):
         return content
 
     def visit_relation(self, context, relation): 
-        context.write_ln(f"\n{self._determine_source(context, relation)} {self._as_arrow(context, relation)} {self._determine_target(context, relation)}")
+        # Relations come after the elements.
+        self._write_packages(context)
+        source, target = self._determine_source(context, relation), self._determine_target(context, relation)
+        if self.bundle_relations is None:
+            self._write_relation(context, source, self._as_arrow(context, relation), target)
+            return
+        # Keyed by the type name, as hashing enums is much slower.
+        key = (source, target, relation.type.name)
+        # Bidirectional relations are the same either way.
+        if relation.is_bidirectional() and key not in self._relations and (target, source, key[2]) in self._relations:
+            key = (target, source, key[2])
+        self._relations.setdefault(key, []).append(relation)
+
+    def _bundles(self):
+        """
+        Returns the bundled relations by (source, target, type). Associations and flows are merged
+        into the bidirectional type when there is one the other way, or a bidirectional one. 
+        Lookups are by key, so that bundling takes linear time.
+        """
+        bundles = {}
+        for (source, target, type), relations in self._relations.items():
+            both = self.OPPOSITES.get(type)
+            if both is not None and ((target, source, type) in self._relations or (source, target, both) in self._relations
+                                     or (target, source, both) in self._relations):
+                type = both
+            if type in self.OPPOSITES.values() and (target, source, type) in bundles:
+                source, target = target, source
+            bundles.setdefault((source, target, type), []).extend(relations)
+        return bundles
+
+    def _write_relations(self, context):
+        for (source, target, type), relations in self._bundles().items():
+            label = ""
+            if len(relations) > 1 and self.bundle_relations == "count":
+                label = f" : {len(relations)}"
+            elif len(relations) > 1:
+                label = f" : {', '.join(dict.fromkeys(relation.get_name() for relation in relations))}"
+            self._write_relation(context, source, self._arrow(RelationType[type]), target, label)
+        self._relations = {}
+
+    def _write_relation(self, context, source, arrow, target, label = ""):
+        context.write_ln(f"\n{source} {arrow} {target}{label}")
     
     def _determine_source(self, context, relation):
         return relation.source.port.get_name() if relation.source.port else relation.source.name
@@ -90,7 +207,10 @@ class PumlVisitor(Visitor):
         return relation.target.port.get_name() if relation.target.port else relation.target.name
     
     def _as_arrow(self, context, relation):
-        match relation.type:
+        return self._arrow(relation.type)
+
+    def _arrow(self, type):
+        match type:
             case RelationType.COMPOSITION:
                 return "*-->"
             case RelationType.AGGREGATION:
@@ -111,11 +231,13 @@ class PumlVisitor(Visitor):
                 return "--"
     
     def visit_interface(self, context, interface): 
+        context = self._package_context(context, interface)
         context.write_ln(self._wrap_inside_package(context, interface, f"\ninterface {interface.get_name()} {self._sterotype(context, interface)}"))
         self._gen_attributes(context, interface)
         self._description(context, interface)
 
     def visit_class(self, context, clazz): 
+        context = self._package_context(context, clazz)
         context.write(self._wrap_inside_package(context, clazz, f"\nclass {clazz.get_name()} {self._sterotype(context, clazz)}"))
         self._gen_attributes(context, clazz)
         self._description(context, clazz)
@@ -144,4 +266,139 @@ class PumlVisitor(Visitor):
     def visit_capability(self, context, capability): ...
 
     def visit_end(self, context, sofa_root): 
+        self._write_packages(context)
+        self._write_relations(context)
+        self._write_footer(context)
+        context.close()
+
+    def _write_footer(self, context):
         context.write_ln("\n@enduml")
+
+def _diagram_name(diagram):
+    # Names in inline lists may keep their quotes.
+    return diagram.get_name().strip().strip('"')
+
+class PumlElements(Visitor):
+    """
+    Visitor that collects the elements rendered by ``PumlVisitor``, along with the visit method 
+    of each, in the order of visiting. The elements can then be rendered again in any subset.
+    """
+
+    def __init__(self):
+        # [(visit method, element)]
+        self.visited = []
+
+    def _add(self, method, elem):
+        self.visited.append((method, elem))
+
+    def visit_root(self, context, sofa_root):
+        self.visited = []
+
+    def visit_diagram(self, context, diagram): ...
+
+    def visit_package(self, context, package): ...
+
+    def visit_stereotype_profile(self, context, stereotype_profile): ...
+
+    def visit_primitive(self, context, primitive):
+        self._add("visit_primitive", primitive)
+
+    def visit_actor(self, context, actor):
+        self._add("visit_actor", actor)
+
+    def visit_component(self, context, component):
+        self._add("visit_component", component)
+
+    def visit_relation(self, context, relation):
+        self._add("visit_relation", relation)
+
+    def visit_interface(self, context, interface):
+        self._add("visit_interface", interface)
+
+    def visit_class(self, context, clazz):
+        self._add("visit_class", clazz)
+
+    def visit_domain(self, context, domain): ...
+
+    def visit_capability(self, context, capability): ...
+
+    def visit_end(self, context, sofa_root): ...
+
+class DiagramIndex:
+    """
+    Index of the members of each diagram, built in a single pass over the model. An element is 
+    a member of the diagrams it declares. A relation is a member of the diagrams it declares, 
+    along with its endpoints, and of the diagrams that both its endpoints are members of.
+    The members are kept in the order of visiting.
+    """
+
+    def __init__(self, sofa_root):
+        # Diagram name -> [(visit method, element)]
+        self.members = {}
+        # Element id -> names of the diagrams of the element
+        self._diagrams = {}
+        elements = PumlElements()
+        sofa_root.visit(None, elements)
+        self._build(elements.visited)
+
+    def _declared(self, elem):
+        return set(filter(None, map(_diagram_name, elem.diagrams() or [])))
+
+    def _build(self, visited):
+        relations = []
+        for method, elem in visited:
+            if method == "visit_relation":
+                relations.append(elem)
+                continue
+            diagrams = self._declared(elem)
+            if diagrams: self._diagrams[elem.id] = diagrams
+
+        # Endpoints of the relations declared in a diagram are members as well.
+        for relation in relations:
+            declared = self._declared(relation)
+            if not declared: continue
+            self._diagrams[relation.id] = declared
+            for endpoint in (relation.source.ref, relation.target.ref):
+                if endpoint is None: continue
+                self._diagrams.setdefault(endpoint.id, set()).update(declared)
+
+        for relation in relations:
+            source, target = relation.source.ref, relation.target.ref
+            if source is None or target is None: continue
+            common = self._diagrams.get(source.id, set()) & self._diagrams.get(target.id, set())
+            if common: self._diagrams.setdefault(relation.id, set()).update(common)
+
+        for method, elem in visited:
+            for diagram in self._diagrams.get(elem.id, ()):
+                self.members.setdefault(diagram, []).append((method, elem))
+
+class PumlDiagramVisitor(PumlVisitor):
+    """
+    PlantUML visitor that, besides the file of the whole model, writes a file for each declared 
+    diagram (see ``PumlContext.diagram``) with only the members of the diagram (see ``DiagramIndex``).
+    When the output is stored in files, the diagram files are written in parallel (see ``fork_map``).
+    """
+
+    def __init__(self, group_packages = True, bundle_relations = None, workers = None):
+        super().__init__(group_packages, bundle_relations)
+        self.workers = workers
+        self._index = None
+
+    def visit_root(self, context, sofa_root):
+        super().visit_root(context, sofa_root)
+        self._index = DiagramIndex(sofa_root)
+
+    def visit_end(self, context, sofa_root):
+        super().visit_end(context, sofa_root)
+        names = list(dict.fromkeys(filter(None, map(_diagram_name, sofa_root.diagrams))))
+        # Diagrams in memory must be written by this process.
+        workers = self.workers if isinstance(context, FileContext) else 1
+        list(fork_map(lambda name: self._write_diagram(context, sofa_root, name), names, workers))
+
+    def _write_diagram(self, context, sofa_root, name):
+        diagram_context = context.diagram(re.sub(r"[^\w.-]+", "_", name))
+        visitor = PumlVisitor(self.group_packages, self.bundle_relations)
+        visitor.visit_root(diagram_context, sofa_root)
+        for method, elem in self._index.members.get(name, []):
+            getattr(visitor, method)(diagram_context, elem)
+        visitor.visit_end(diagram_context, sofa_root)
@@ -0,0 +1,273 @@
+"""
+Module that generates PlantUML files from the Sofa model, splitting the diagram into several
+parts that fit a budget of nodes and edges.
+"""
+from collections import deque
+from sofaman.generator.generator import FileContext, fork_map
+from sofaman.generator.plantuml import PumlVisitor, PumlElements
+
+class ModelGraph:
+    """
+    Graph of the elements rendered by PlantUML (the nodes) and the relations between them
+    (the edges), in the order of visiting.
+    """
+
+    def __init__(self, visited):
+        self.visited = visited
+        # Element id -> (visit method, element)
+        self.nodes = {}
+        # Element id -> ids of the related elements
+        self.neighbours = {}
+        # Element id -> ids of the relations of the element
+        self.edges = {}
+        for method, elem in visited:
+            if method == "visit_relation": continue
+            self.nodes[elem.id] = (method, elem)
+            self.neighbours[elem.id] = set()
+            self.edges[elem.id] = set()
+
+        for method, relation in visited:
+            if method != "visit_relation": continue
+            ends = self.ends(relation)
+            for id in ends:
+                self.edges[id].add(relation.id)
+                self.neighbours[id].update(ends)
+                self.neighbours[id].discard(id)
+
+    def ends(self, relation):
+        """
+        Returns the ids of the rendered elements that the relation relates.
+        """
+        refs = (relation.source.ref, relation.target.ref)
+        return list(dict.fromkeys(ref.id for ref in refs if ref is not None and ref.id in self.nodes))
+
+class _Part:
+    """
+    The elements of a part, along with the other elements they are related to (rendered as stubs)
+    and their relations.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.members = set()
+        self.stubs = set()
+        self.relations = set()
+
+    def cost(self, ids):
+        """
+        Returns the number of nodes and edges of the part, if the given elements were added.
+        """
+        added = set(ids) - self.members
+        stubs = set()
+        relations = set()
+        for id in added:
+            stubs.update(self.graph.neighbours[id])
+            relations.update(self.graph.edges[id])
+        stubs.update(self.stubs)
+        stubs -= added
+        stubs -= self.members
+        return len(self.members) + len(added) + len(stubs), len(self.relations | relations)
+
+    def add(self, ids):
+        for id in ids:
+            self.members.add(id)
+            self.stubs.update(self.graph.neighbours[id])
+            self.relations.update(self.graph.edges[id])
+        self.stubs -= self.members
+
+def _within(cost, max_nodes, max_edges):
+    # No limit when the maximum is None
+    nodes, edges = cost
+    return (max_nodes is None or nodes <= max_nodes) and (max_edges is None or edges <= max_edges)
+
+class Partitioner:
+    """
+    Partitions a model graph into parts of at most the given number of nodes and edges, counting
+    the stubs of the related elements in other parts and the relations to them.
+
+    Packages are kept whole as far as they fit, otherwise their sub-packages are partitioned in
+    turn; the elements of a package that does not fit on its own are clustered by connectivity,
+    growing each cluster along the relations. The resulting units are then packed into parts,
+    preferring the part a unit has the most relations with. A single element that does not fit
+    with its stubs makes a part on its own.
+    """
+
+    def __init__(self, graph, max_nodes, max_edges = None):
+        self.graph = graph
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        # Package id (None for the root) -> ids of the elements directly in it
+        self._elements = {}
+        # Package id (None for the root) -> child packages
+        self._packages = {}
+        for id, (_, elem) in graph.nodes.items():
+            self._elements.setdefault(self._package_id(elem.parent_package), []).append(id)
+            self._add_package(elem.parent_package)
+
+    def _package_id(self, package):
+        return package.id if package is not None else None
+
+    def _add_package(self, package):
+        # Registers the package with its ancestors, once.
+        while package is not None:
+            children = self._packages.setdefault(self._package_id(package.parent_package), [])
+            if package in children: return
+            children.append(package)
+            package = package.parent_package
+
+    def _fits(self, cost):
+        return _within(cost, self.max_nodes, self.max_edges)
+
+    def partition(self):
+        """
+        Returns the parts, as lists of element ids in the order of visiting.
+        """
+        parts = []
+        part_of = {}
+        for unit in self._units(None):
+            part = self._part_for(unit, parts, part_of)
+            if part is None:
+                part = _Part(self.graph)
+                parts.append(part)
+            part.add(unit)
+            for id in unit: part_of[id] = part
+        order = {id: i for i, id in enumerate(self.graph.nodes)}
+        return [sorted(part.members, key=order.get) for part in parts]
+
+    def _part_for(self, unit, parts, part_of):
+        # The part with the most relations to the unit, or else the latest one, that has room.
+        links = {}
+        for id in unit:
+            for other in self.graph.neighbours[id]:
+                part = part_of.get(other)
+                if part is not None: links[part] = links.get(part, 0) + 1
+        candidates = sorted(links, key=links.get, reverse=True)
+        if parts and parts[-1] not in links: candidates.append(parts[-1])
+        return next((part for part in candidates if self._fits(part.cost(unit))), None)
+
+    def _subtree(self, package_id):
+        ids = list(self._elements.get(package_id, []))
+        for child in self._packages.get(package_id, []):
+            ids.extend(self._subtree(child.id))
+        return ids
+
+    def _units(self, package_id):
+        ids = self._subtree(package_id)
+        if not ids: return []
+        if self._fits(_Part(self.graph).cost(ids)): return [ids]
+        units = self._clusters(self._elements.get(package_id, []))
+        for child in self._packages.get(package_id, []):
+            units.extend(self._units(child.id))
+        return units
+
+    def _clusters(self, ids):
+        remaining = dict.fromkeys(ids)
+        clusters = []
+        while remaining:
+            seed = next(iter(remaining))
+            cluster = _Part(self.graph)
+            queue = deque([seed])
+            while queue:
+                id = queue.popleft()
+                if id not in remaining: continue
+                if cluster.members and not self._fits(cluster.cost([id])): continue
+                cluster.add([id])
+                del remaining[id]
+                queue.extend(other for other in self.graph.neighbours[id] if other in remaining)
+            clusters.append(list(cluster.members))
+        return clusters
+
+class PumlStubVisitor(PumlVisitor):
+    """
+    PlantUML visitor that also renders stubs, which stand for the elements of other parts.
+    """
+
+    KEYWORDS = {"visit_primitive": "class", "visit_actor": "actor", "visit_component": "component",
+                "visit_interface": "interface", "visit_class": "class"}
+
+    def visit_stub(self, context, method, elem, link):
+        """
+        Renders the element with its name (and ports) only, linking to the part that has it.
+        """
+        context = self._package_context(context, elem)
+        ports = self._gen_ports(context, elem) if method == "visit_component" else ""
+        content = f"\n{self.KEYWORDS[method]} {elem.get_name()} <<stub>> [[{link}]] {ports}"
+        context.write_ln(self._wrap_inside_package(context, elem, content))
+
+class PumlSplitVisitor(PumlElements):
+    """
+    PlantUML visitor that splits the diagram into parts of at most ``max_nodes`` nodes and
+    ``max_edges`` edges, where None is no limit (see ``Partitioner``), as PlantUML layout time
+    grows faster than the size of the diagram. Each part is written to a file of its own (see ``PumlContext.diagram``),
+    where the related elements of other parts are rendered as stubs that link to their parts.
+    The output file is then an index of the parts, with the number of relations between them.
+    A model that fits the budget is written as a single diagram.
+
+    When the output is stored in files, the parts are written in parallel (see ``fork_map``).
+    """
+
+    def __init__(self, max_nodes = 300, max_edges = None, bundle_relations = None, workers = None):
+        super().__init__()
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        # Budgets count the relations before bundling.
+        self.bundle_relations = bundle_relations
+        self.workers = workers
+
+    def visit_end(self, context, sofa_root):
+        graph = ModelGraph(self.visited)
+        if self._fits(graph):
+            self._write_part(context, sofa_root, graph, None, {})
+            return
+
+        parts = Partitioner(graph, self.max_nodes, self.max_edges).partition()
+        part_of = {id: index for index, part in enumerate(parts) for id in part}
+        contexts = [context.diagram(f"part{index + 1}") for index in range(len(parts))]
+        links = [f"{part_context.name()}.puml" for part_context in contexts]
+        self._write_index(context, sofa_root, graph, parts, part_of, links)
+
+        # Parts in memory must be written by this process.
+        workers = self.workers if isinstance(context, FileContext) else 1
+        write = lambda index: self._write_part(contexts[index], sofa_root, graph, index, part_of, links)
+        list(fork_map(write, range(len(parts)), workers))
+
+    def _fits(self, graph):
+        edges = sum(1 for method, _ in graph.visited if method == "visit_relation")
+        return _within((len(graph.nodes), edges), self.max_nodes, self.max_edges)
+
+    def _write_part(self, context, sofa_root, graph, index, part_of, links = None):
+        visitor = PumlStubVisitor(bundle_relations=self.bundle_relations)
+        visitor.visit_root(context, sofa_root)
+        for method, elem in graph.visited:
+            if method == "visit_relation":
+                ends = graph.ends(elem)
+                # Relations of no rendered element are in the first part.
+                homes = {part_of.get(id) for id in ends} if ends else {0 if part_of else None}
+                if index in homes: getattr(visitor, method)(context, elem)
+            elif part_of.get(elem.id) == index:
+                getattr(visitor, method)(context, elem)
+            elif any(part_of.get(id) == index for id in graph.neighbours[elem.id]):
+                visitor.visit_stub(context, method, elem, links[part_of[elem.id]])
+        visitor.visit_end(context, sofa_root)
+
+    def _write_index(self, context, sofa_root, graph, parts, part_of, links):
+        context.write_ln(f"@startuml {context.name()}")
+        for index, part in enumerate(parts):
+            packages = list(dict.fromkeys(filter(None, (graph.nodes[id][1].package() for id in part))))
+            summary = f"{len(part)} elements"
+            if packages:
+                summary += "\\n" + ", ".join(packages[:5]) + (", ..." if len(packages) > 5 else "")
+            context.write_ln(f'rectangle "part{index + 1}\\n{summary}" as part{index + 1} [[{links[index]}]]')
+
+        # Relations across parts, by source and target part
+        across = {}
+        for method, elem in graph.visited:
+            if method != "visit_relation": continue
+            source, target = (ref.id if ref is not None else None for ref in (elem.source.ref, elem.target.ref))
+            key = (part_of.get(source), part_of.get(target))
+            if None in key or key[0] == key[1]: continue
+            across[key] = across.get(key, 0) + 1
+        for (source, target), count in across.items():
+            context.write_ln(f"part{source + 1} ..> part{target + 1} : {count}")
+        context.write_ln("@enduml")
+        context.close()
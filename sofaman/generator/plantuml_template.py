@@ -0,0 +1,158 @@
+"""
+Module that generates PlantUML files from the Sofa model using output templates.
+"""
+from string import Formatter
+from sofaman.generator.plantuml import PumlVisitor
+from sofaman.ir.model import Attribute, Port
+
+# Same output as PumlVisitor
+DEFAULT_TEMPLATES = {
+    "header": "@startuml {name}\nallowmixing\n",
+    "footer": "\n@enduml\n",
+    "primitive": "\nclass {name} {stereotypes}\n{note}",
+    "actor": "\nactor {name} {stereotypes}\n{note}",
+    "component": "\ncomponent {name} {stereotypes} {ports}{note}",
+    "interface": "\ninterface {name} {stereotypes}\n{attributes}{note}",
+    "class": "\nclass {name} {stereotypes}{attributes}{note}",
+    "note": "\nnote top of {name}\n    {description}\nend note\n\n",
+    "relation": "\n{source} {arrow} {target}{label}\n",
+}
+
+_ELEMENT_FIELDS = ("name", "package", "stereotypes", "attributes", "ports", "note")
+
+class PumlTemplateVisitor(PumlVisitor):
+    """
+    PlantUML visitor that renders the output with a template per kind of output (see
+    ``DEFAULT_TEMPLATES``), which are Python format strings. User templates replace the
+    default ones, e.g. a header with skinparams and sprite includes::
+
+        PumlTemplateVisitor({"header": "@startuml {name}\\nallowmixing\\n!include <tupadr3/common>\\n"})
+
+    The templates are checked and compiled once per visitor, along with the fields each one uses,
+    so that only those fields are computed for every element. The output is written to the
+    context in batches of ``BATCH_SIZE`` chunks.
+    """
+
+    # Kind of output -> fields of its template
+    FIELDS = {
+        "header": ("name",),
+        "footer": ("name",),
+        "primitive": _ELEMENT_FIELDS,
+        "actor": _ELEMENT_FIELDS,
+        "component": _ELEMENT_FIELDS,
+        "interface": _ELEMENT_FIELDS,
+        "class": _ELEMENT_FIELDS,
+        "note": ("name", "description"),
+        "relation": ("source", "arrow", "target", "label"),
+    }
+    COMPUTED = ("stereotypes", "attributes", "ports", "note")
+    BATCH_SIZE = 1024
+
+    def __init__(self, templates = None, group_packages = True, bundle_relations = None):
+        super().__init__(group_packages, bundle_relations)
+        # Kind -> (render function, (field, function computing it) of the fields used)
+        self._templates = {}
+        for kind, template in (DEFAULT_TEMPLATES | (templates or {})).items():
+            self._templates[kind] = self._compile(kind, template)
+        self._batch = []
+
+    def _compile(self, kind, template):
+        if kind not in self.FIELDS:
+            raise AssertionError(f"Unknown template {kind}, expected one of {', '.join(self.FIELDS)}")
+        fields = set()
+        for _, field, _, _ in Formatter().parse(template):
+            if field is None: continue
+            # Only plain fields, so that templates cannot reach into the model.
+            if field not in self.FIELDS[kind]:
+                raise AssertionError(f"Unknown field '{field}' in the {kind} template")
+            fields.add(field)
+        # Fields other than the name and the package are computed by the method of the same name.
+        computed = tuple((field, getattr(self, f"_{field}")) for field in fields if field in self.COMPUTED)
+        return template.format_map, computed
+
+    def _emit(self, context, content):
+        self._batch.append(content)
+        if len(self._batch) >= self.BATCH_SIZE: self._flush(context)
+
+    def _flush(self, context):
+        if not self._batch: return
+        context.write("".join(self._batch))
+        self._batch = []
+
+    def _write_header(self, context):
+        self._batch = []
+        render, _ = self._templates["header"]
+        self._emit(context, render({"name": context.name()}))
+
+    def _write_footer(self, context):
+        render, _ = self._templates["footer"]
+        self._emit(context, render({"name": context.name()}))
+        self._flush(context)
+
+    def _write_packages(self, context):
+        # Packages are written to the context directly.
+        if not self._packages: return
+        self._flush(context)
+        super()._write_packages(context)
+
+    def _write_relation(self, context, source, arrow, target, label = ""):
+        render, _ = self._templates["relation"]
+        self._emit(context, render({"source": source, "arrow": arrow, "target": target, "label": label}))
+
+    def _write_element(self, context, kind, obj):
+        render, computed = self._templates[kind]
+        values = {"name": obj.get_name(), "package": obj.package() or ""}
+        # Only the fields used by the template
+        for field, compute in computed:
+            values[field] = compute(context, obj)
+        content = render(values)
+
+        package_context = self._package_context(context, obj)
+        if package_context is context:
+            self._emit(context, self._wrap_inside_package(context, obj, content))
+        else:
+            package_context.write(content)
+
+    def _stereotypes(self, context, obj):
+        stereotypes = obj.stereotypes()
+        return "".join(f"<<{s}>>" for s in stereotypes) if stereotypes else ""
+
+    def _attributes(self, context, obj):
+        attrs = obj.attributes()
+        if not attrs: return ""
+        lines = ["{\n"]
+        for attr in attrs:
+            if isinstance(attr, str):
+                lines.append(f"{self.INDENT}{attr}\n")
+            elif isinstance(attr, Attribute):
+                type = f"{attr.type} " if attr.type is not None else ""
+                lines.append(f"{self.INDENT}{type}{attr.name}\n")
+            else:
+                raise AssertionError("Attributes must be str|dict")
+        lines.append("}\n")
+        return "".join(lines)
+
+    def _ports(self, context, obj):
+        ports = obj.list_values("ports", Port)
+        if not ports: return ""
+        return "{\n" + "".join(f"{self.INDENT}port {port.get_name()}\n" for port in ports) + "}\n"
+
+    def _note(self, context, obj):
+        if not context.desc_as_notes or obj.description() is None: return ""
+        render, _ = self._templates["note"]
+        return render({"name": obj.get_name(), "description": obj.description()})
+
+    def visit_primitive(self, context, primitive):
+        self._write_element(context, "primitive", primitive)
+
+    def visit_actor(self, context, actor):
+        self._write_element(context, "actor", actor)
+
+    def visit_component(self, context, component):
+        self._write_element(context, "component", component)
+
+    def visit_interface(self, context, interface):
+        self._write_element(context, "interface", interface)
+
+    def visit_class(self, context, clazz):
+        self._write_element(context, "class", clazz)
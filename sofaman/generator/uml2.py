@@ -1,11 +1,17 @@
 """
 Module that generates XMI code from the Sofa model.
 """
+import gzip
+import hashlib
+import os
+import pathlib
 import uuid
-from sofaman.generator.generator import FileContext, Visitor
+from sofaman.generator.generator import FileContext, BytesBufferContext, Visitor
 import lxml.etree as etree
 from lxml.etree import Element, SubElement
-from sofaman.ir.model import Attribute, ArchElement, Module, Named, Operation, Parameter, Struct, RelationType, PropertyContainer
+from sofaman.ir.model import (Attribute, ArchElement, Module, Operation, Parameter, Struct, RelationType, PropertyContainer,
+                              Package, Primitive, Actor, Component, Relation, Interface, Class)
+from sofaman.tools.export.id_store import write_ids
 from enum import Enum
 
 NS_UML = "http://schema.omg.org/spec/UML/2.1"
@@ -20,6 +26,31 @@ NS_MAP = {
     "uml": NS_UML
 }
 
+# Default namespace, for the elements below the ones that do not declare it.
+DEFAULT_NS_MAP = {None: NS_UML}
+
+# Namespace for the IDs derived from the IDs of the model elements.
+NS_DERIVED_ID = uuid.UUID("6f0c5b1e-8d1a-4b7e-9a5c-3f3f1d2c7a10")
+
+def _format_id(h, version):
+    # Formats the hex digest as the string of a UUID with the given version.
+    return f"{h[:8]}-{h[8:12]}-{version}{h[13:16]}-{"89ab"[int(h[16], 16) & 3]}{h[17:20]}-{h[20:32]}"
+
+def _random_id():
+    # Same as str(uuid.uuid4()), without the UUID object.
+    return _format_id(os.urandom(16).hex(), 4)
+
+def _derived_id(name):
+    # Same as str(uuid.uuid5(NS_DERIVED_ID, name)), without the UUID object.
+    return _format_id(hashlib.sha1(NS_DERIVED_ID.bytes + name.encode()).hexdigest(), 5)
+
+class RelationRole:
+    """
+    The role of an element within a relation.
+    """
+    SOURCE = "source"
+    TARGET = "target"
+
 class XmiFlavor:
     """
     The different flavors of XMI. This is because some tools have different 
@@ -28,15 +59,19 @@ class XmiFlavor:
     NORMAL = 1
     SPARX_EA = 2
 
-class XmiContext(FileContext):
+class XmiContextBase:
     """
-    XMI context with content stored in a file.
+    State and behaviour common to the XMI contexts, independent of where the content is stored.
     """
-    def __init__(self, out_file, mode=XmiFlavor.NORMAL):
-        super().__init__(out_file)
+    def _init_xmi(self, mode, pretty_print=True, compress=False):
         self.mode = mode
         self.root = None
         self.ids = None
+        # ID map written at the end of the generation, if any (see XmiVisitor.written_ids)
+        self.ids_out_file = None
+        self.pretty_print = pretty_print
+        self.compress = compress
+        self._xmi_stream = None
 
     def is_sparx_ea(self):
         """
@@ -44,17 +79,124 @@ class XmiContext(FileContext):
         """
         return self.mode == XmiFlavor.SPARX_EA
 
+    def serialize(self):
+        """
+        Generates the serialized bytes of the XMI DOM.
+        """
+        return etree.tostring(self.root, pretty_print=self.pretty_print)
+
+    def xmi_stream(self):
+        """
+        Returns the binary stream to write the XMI to. The stream compresses the content, 
+        if compression is enabled.
+        """
+        if self._xmi_stream is None:
+            stream = self.stream()
+            # No file name and time in the header, so that the output is reproducible.
+            self._xmi_stream = gzip.GzipFile(filename="", mode="wb", fileobj=stream, mtime=0) if self.compress else stream
+        return self._xmi_stream
+
+    def write_xmi(self):
+        """
+        Serializes the XMI DOM directly to the XMI stream, without an intermediate copy of the content.
+        """
+        etree.ElementTree(self.root).write(self.xmi_stream(), pretty_print=self.pretty_print)
+
+    def shard_file_name(self, name):
+        """
+        Returns the file name of the shard (a separate XMI document) with the given name.
+        """
+        return f"{name}.xmi.gz" if self.compress else f"{name}.xmi"
+
+    def _close_xmi_stream(self):
+        if self.compress and self._xmi_stream is not None:
+            # Writes the end of the compressed content. Does not close the underlying stream.
+            self._xmi_stream.close()
+        self._xmi_stream = None
+
+class XmiContext(XmiContextBase, FileContext):
+    """
+    XMI context with content stored in a file.
+    """
+    def __init__(self, out_file, mode=XmiFlavor.NORMAL, pretty_print=True, compress=False, manifest=None):
+        FileContext.__init__(self, out_file, manifest)
+        self._init_xmi(mode, pretty_print, compress)
+
     def get_content(self):
         """
         Generates a string representation of the XMI DOM.
         """
-        return str(etree.tostring(self.root, pretty_print=True), encoding="UTF8")
+        return str(self.serialize(), encoding="UTF8")
+
+    def name(self):
+        """
+        Name of the file, without the extension of the compression.
+        """
+        path = pathlib.PurePath(self.out_file)
+        if self.compress and path.suffix == ".gz":
+            path = path.with_suffix("")
+        return path.stem
 
     def flush(self):
         """
-        Saves the content to a file.
+        Saves the content to a file and closes it.
         """
-        self.write(self.get_content())
+        self.write_xmi()
+        self.close()
+
+    def shard(self, name):
+        """
+        Creates the context of a shard, stored in a file next to this one.
+        """
+        out_file = os.path.join(os.path.dirname(self.out_file), self.shard_file_name(name))
+        return XmiContext(out_file, self.mode, self.pretty_print, self.compress, self.manifest)
+
+    def close(self):
+        """
+        Completes the XMI stream and closes the file.
+        """
+        if self._file.closed: return
+        self._close_xmi_stream()
+        FileContext.close(self)
+
+class XmiBufferContext(XmiContextBase, BytesBufferContext):
+    """
+    XMI context with content stored in an in-memory binary buffer. 
+    The serialized bytes are stored as is, without decoding them.
+    """
+    def __init__(self, name = "model", mode=XmiFlavor.NORMAL, pretty_print=True, compress=False):
+        BytesBufferContext.__init__(self)
+        self._init_xmi(mode, pretty_print, compress)
+        self._name = name
+        # File name -> context of the shard
+        self.shards = {}
+
+    def name(self):
+        """
+        Name of the model.
+        """
+        return self._name
+
+    def flush(self):
+        """
+        Saves the serialized XMI DOM to the buffer.
+        """
+        self.write_xmi()
+        self.close()
+
+    def shard(self, name):
+        """
+        Creates the context of a shard, stored in another buffer (see ``shards``).
+        """
+        context = XmiBufferContext(name, self.mode, self.pretty_print, self.compress)
+        self.shards[self.shard_file_name(name)] = context
+        return context
+
+    def close(self):
+        """
+        Completes the XMI stream. The buffer remains available.
+        """
+        self._close_xmi_stream()
 
 class XmiVisitor(Visitor):
     """
@@ -71,9 +213,16 @@ class XmiVisitor(Visitor):
             self.endpoint_obj = endpoint_obj
             self.endpoint_elem = endpoint_elem
 
+    # Model elements written as packaged elements
+    PACKAGED_TYPES = (Package, Primitive, Actor, Component, Relation, Interface, Class)
+
     def __init__(self):
         super().__init__()
         self.registry = {}
+        self._pkg_qnames = {}
+        self._outer_id = None
+        # Model element ID -> ID adopted from an ID map or a previous generation (see _adopt_ids)
+        self._adopted_ids = {}
     
     def _register(self, obj, elem):
         self.registry[obj] = elem
@@ -82,16 +231,60 @@ class XmiVisitor(Visitor):
         return self.registry.get(obj, None)
 
     def _id_attr(self, context, obj, elem, id=None):
-        e_id = None
-        if obj and context.ids and isinstance(obj, Named):
-            qname = obj.get_qname()
-            if qname:
-                # Check if there is an explicit ID for the object.
-                e_id = context.ids.get(qname, None)
-        id_val = e_id or id or str(uuid.uuid4())
+        id_val = self._id_value(context, obj, id)
         elem.set(XMI + "id", id_val)
         return id_val
 
+    def _id_value(self, context, obj, id=None):
+        # Explicit IDs are those of the model elements (see _adopt_ids), the others are random.
+        return id or _random_id()
+
+    def _ref_id(self, obj):
+        # ID of the model element, as used by the XMI elements that refer to it.
+        return self._adopted_ids.get(obj.id, obj.id)
+
+    def _adopt_ids(self, sofa_root, ids, prefix = ""):
+        """
+        Gives the elements the IDs of the given map (qualified name -> ID), so that the XMI of a
+        previous generation remains valid. Names are also looked up with the given prefix, e.g. 
+        the outer package of Sparx EA. Ambiguous names are ignored. Returns the IDs of all the 
+        unambiguous elements, by qualified name.
+        """
+        elems = {}
+        duplicates = set()
+        for elem in sofa_root.model_elements():
+            if not isinstance(elem, ArchElement): continue
+            qname = self._qname(elem)
+            # The same element may be listed more than once.
+            if elems.get(qname, elem) is not elem:
+                duplicates.add(qname)
+            elems[qname] = elem
+
+        elem_ids = {}
+        for qname, elem in elems.items():
+            if qname in duplicates: continue
+            id = ids.get(qname)
+            if id is None and prefix:
+                id = ids.get(prefix + qname)
+            if id is not None:
+                self._adopted_ids[elem.id] = id
+            elem_ids[qname] = self._ref_id(elem)
+        return elem_ids
+
+    def _ids_prefix(self, context):
+        # IDs exported from Sparx EA are qualified by the outer package.
+        return f"{context.name()}." if context.is_sparx_ea() else ""
+
+    def _qname(self, obj):
+        # Same as obj.get_qname(), but walks the packages only once.
+        pkg = getattr(obj, "parent_package", None)
+        if pkg is None:
+            return obj.get_qname()
+        pkg_qname = self._pkg_qnames.get(pkg.id)
+        if pkg_qname is None:
+            pkg_qname = self._pkg_qnames[pkg.id] = pkg.get_qname()
+        return f"{pkg_qname}.{obj.get_name()}"
+
     def _common_aspects(self, context, parent_elem, obj: ArchElement|str):
         self._owned_comment(context, parent_elem, obj)
         self._stereotypes(context, parent_elem, obj)
@@ -102,7 +295,7 @@ class XmiVisitor(Visitor):
         if not obj.description():
             return
         
-        elem = SubElement(parent, UML + "ownedComment", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "ownedComment")
         elem.set(XMI + "type", "uml:Comment")
         self._id_attr(context, obj, elem) # Random ID
         elem.set("body", obj.description())
@@ -111,8 +304,8 @@ class XmiVisitor(Visitor):
         return elem
 
     def _annotated_element(self, parent, obj: ArchElement|str):
-        elem = SubElement(parent, UML + "annotatedElement", nsmap=NS_MAP)
-        elem.set(XMI+"idref", obj.id)
+        elem = SubElement(parent, UML + "annotatedElement")
+        elem.set(XMI+"idref", self._ref_id(obj))
         # No need to register.
         return elem
 
@@ -121,53 +314,60 @@ class XmiVisitor(Visitor):
             return
         
         for stereo in obj.stereotypes():
-            elem = SubElement(context.root, "{%s}" % stereo.profile + stereo.name, nsmap=NS_MAP)
-            elem.set("base_" + obj.__class__.__name__, obj.id)
+            elem = self._stereotype_elem(context, "{%s}" % stereo.profile + stereo.name)
+            elem.set("base_" + obj.__class__.__name__, self._ref_id(obj))
             self._id_attr(context, obj, elem) # Random ID
 
         # No need to register.
         return elem
 
-    def _packaged_element(self, context, parent, obj: ArchElement|str, uml_name, is_abstract=False):
-        elem = SubElement(parent, UML + "packagedElement", nsmap=NS_MAP)
+    def _stereotype_elem(self, context, tag):
+        # Stereotype applications are placed at the root.
+        return SubElement(context.root, tag)
+
+    def _packaged_element(self, context, parent, obj: ArchElement|str, uml_name, is_abstract=False, nsmap=None):
+        elem = SubElement(parent, UML + "packagedElement", nsmap=nsmap)
         elem.set(XMI + "type", "uml:"+uml_name)
-        self._id_attr(context, obj, elem, obj.id)
+        self._id_attr(context, obj, elem, self._ref_id(obj))
         elem.set("name", obj.get_name())
-        elem.set("isAbstract", str(is_abstract).lower())
+        elem.set("isAbstract", "true" if is_abstract else "false")
         elem.set("visibility", obj.visibility.value)
         self._register(obj, elem)
         self._common_aspects(context, elem, obj)
         return elem
     
     def _realization(self, relation_elem, src_ep: RelationEndPoint, tgt_ep: RelationEndPoint):
-        relation_elem.set("client", src_ep.endpoint_obj.id)
-        relation_elem.set("supplier", tgt_ep.endpoint_obj.id)
+        relation_elem.set("client", self._ref_id(src_ep.endpoint_obj))
+        relation_elem.set("supplier", self._ref_id(tgt_ep.endpoint_obj))
 
     def _inheritance(self, context, relation, src_ep: RelationEndPoint, tgt_ep: RelationEndPoint):
-        elem = SubElement(src_ep.endpoint_elem, UML + "generalization", nsmap=NS_MAP)
+        self._generalization(context, src_ep.endpoint_elem, relation, tgt_ep.endpoint_obj)
+
+    def _generalization(self, context, parent, relation, general_obj):
+        elem = SubElement(parent, UML + "generalization")
         elem.set(XMI + "type", "uml:Generalization")
         if relation.struct and relation.struct.name: elem.set("name", relation.struct.name)
-        elem.set("general", tgt_ep.endpoint_obj.id)
+        elem.set("general", self._ref_id(general_obj))
         elem.set("isSubstitutable", "true") # TODO: May be need to be exposed in sofa
         self._id_attr(context, relation, elem) # Generated ID
 
     def _info_flow(self, relation_elem, src_ep: RelationEndPoint, tgt_ep: RelationEndPoint):
-        relation_elem.set("informationSource", src_ep.endpoint_obj.id)
-        relation_elem.set("informationTarget", tgt_ep.endpoint_obj.id)
+        relation_elem.set("informationSource", self._ref_id(src_ep.endpoint_obj))
+        relation_elem.set("informationTarget", self._ref_id(tgt_ep.endpoint_obj))
 
     def _get_owned_end_elem(self, relation_elem):
         return relation_elem.find(UML + "ownedEnd")
 
     def _owned_literal(self, context, parent, obj, name):
-        elem = SubElement(parent, UML + "ownedLiteral", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "ownedLiteral")
         elem.set("name", name)
-        self._id_attr(context, obj, elem, obj.id)
-        self._register(obj, elem)
+        self._id_attr(context, obj, elem, _derived_id(f"{self._ref_id(obj)}.{name}"))
+        # Not registered, as obj is the owner of the literal.
         self._common_aspects(context, elem, obj)
         return elem
 
     def _owned_attribute(self, context, parent, attr):
-        elem = SubElement(parent, UML + "ownedAttribute", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "ownedAttribute")
         self._id_attr(context, attr, elem, attr.id)
         if isinstance(attr, str):
             elem.set("name", attr)
@@ -177,9 +377,9 @@ class XmiVisitor(Visitor):
             elem.set(XMI + "type", "uml:Property")
             self._cardinality(elem, attr.cardinality)
             if attr.type is not None:
-                arch_elem = context.sofa_root.get_by_qname(attr.type)
+                arch_elem = attr.type_ref
                 if arch_elem is not None: 
-                    self._type(elem, arch_elem.id)
+                    self._type(elem, self._ref_id(arch_elem))
                 else:
                     raise AssertionError(f"Type {attr.type} not defined. Please define it in your sofa file.")
         else:
@@ -189,7 +389,7 @@ class XmiVisitor(Visitor):
         return elem
 
     def _owned_operation(self, context, parent, op: Operation):
-        elem = SubElement(parent, UML + "ownedOperation", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "ownedOperation")
         self._id_attr(context, op, elem, op.id)
         if isinstance(op, str):
             elem.set("name", op)
@@ -205,7 +405,7 @@ class XmiVisitor(Visitor):
         return elem
 
     def _owned_parameter(self, context, parent, parameter):
-        elem = SubElement(parent, UML + "ownedParameter", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "ownedParameter")
         self._id_attr(context, parameter, elem, parameter.id)
         if isinstance(parameter, str):
             elem.set("name", parameter)
@@ -225,17 +425,37 @@ class XmiVisitor(Visitor):
         self._lower_value(elem, lower)
         self._upper_value(elem, upper)
 
-    def _owned_association_attribute(self, context, parent, obj, relation):
-        elem = SubElement(parent, UML + "ownedAttribute", nsmap=NS_MAP)
-        self._id_attr(context, obj, elem)
-        elem.set("association", relation.id)
-        self._type(elem, obj.id)
+    def _end_id(self, relation, role):
+        # Derived from the relation, so that the ends can be referred to 
+        # before (or without) creating the owning elements.
+        return _derived_id(f"{self._ref_id(relation)}.{role}")
+
+    def _association_end(self, context, parent, relation, role):
+        if role == RelationRole.SOURCE:
+            # Source endpoint has an ownedAttribute that refers to the target obj
+            elem = self._owned_association_attribute(context, parent, relation.target.ref, relation, role)
+            match relation.type:
+                case RelationType.AGGREGATION:
+                    elem.set("aggregation", "shared")
+                case RelationType.COMPOSITION:
+                    elem.set("aggregation", "composite")
+                case _:
+                    elem.set("aggregation", "none")
+        else:
+            elem = self._owned_association_attribute(context, parent, relation.source.ref, relation, role)
+        return elem
+
+    def _owned_association_attribute(self, context, parent, obj, relation, role):
+        elem = SubElement(parent, UML + "ownedAttribute")
+        self._id_attr(None, None, elem, self._end_id(relation, role))
+        elem.set("association", self._ref_id(relation))
+        self._type(elem, self._ref_id(obj))
         self._cardinality(elem, relation.source.cardinality)
         # No registration as it is an attribute that is specific to XMI structure
         return elem
 
     def _lower_value(self, parent, value):
-        elem = SubElement(parent, UML + "lowerValue", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "lowerValue")
         elem.set(XMI+"type", "uml:LiteralInteger")
         elem.set("value", str(value))
         self._id_attr(None, None, elem) # No external ids
@@ -243,7 +463,7 @@ class XmiVisitor(Visitor):
         return elem
 
     def _upper_value(self, parent, value):
-        elem = SubElement(parent, UML + "upperValue", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "upperValue")
         elem.set(XMI+"type", "uml:LiteralUnlimitedNatural")
         elem.set("value", str(value))
         self._id_attr(None, None, elem) # No external ids
@@ -251,19 +471,18 @@ class XmiVisitor(Visitor):
         return elem
 
     def _type(self, parent, refid):
-        elem = SubElement(parent, UML + "type", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "type")
         elem.set(XMI+"idref", refid)
         # No registration as it is an attribute that is specific to XMI structure
         return elem
 
     def _owned_end(self, context, parent, relation, obj_refid):
-        elem = SubElement(parent, UML + "ownedEnd", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "ownedEnd")
         self._id_attr(context, relation, elem)
 
-        elem.set(XMI+"association", relation.id)
+        elem.set(XMI+"association", self._ref_id(relation))
 
-        type = SubElement(elem, UML + "type", nsmap=NS_MAP)
-        type.set(XMI+"idref", obj_refid)
+        self._type(elem, obj_refid)
 
         self._cardinality(elem, relation.target.cardinality)
 
@@ -271,7 +490,7 @@ class XmiVisitor(Visitor):
         return elem
 
     def _member_end(self, parent, owned_end_refid):
-        elem = SubElement(parent, UML + "memberEnd", nsmap=NS_MAP)
+        elem = SubElement(parent, UML + "memberEnd")
         elem.set(XMI+"idref", owned_end_refid)
         # No registration as it is an attribute that is specific to XMI structure
         return elem
@@ -288,6 +507,11 @@ class XmiVisitor(Visitor):
         for prof in sofa_root.stereotype_profiles:
             NS_MAP[prof.name.lower()] = prof.name
 
+        # Also waits for IDs extracted in the background (see BackgroundIds), before any worker is forked.
+        if context.ids:
+            # The explicit IDs of the elements
+            self._adopt_ids(sofa_root, context.ids, self._ids_prefix(context))
+
         context.root = Element(XMI + "XMI", nsmap=NS_MAP)
 
         if context.is_sparx_ea():
@@ -312,22 +536,30 @@ class XmiVisitor(Visitor):
         if context.is_sparx_ea():
             # Need an outer package for EA.
             # TODO: Revisit after implementing modules.
-            elem = self._packaged_element(context, context.contentRoot, Module(Struct(context.name())), "Package")
+            # Declares the default namespace again, which the elements below use (see "Model").
+            elem = self._packaged_element(context, context.contentRoot, self._outer_package(context), "Package", nsmap=DEFAULT_NS_MAP)
+            self._outer_id = elem.get(XMI + "id")
             context.contentRoot = elem
 
+    def _outer_package(self, context):
+        # The outer package of Sparx EA, named after the file.
+        package = Module(Struct(context.name()))
+        id = context.ids.get(context.name()) if context.ids else None
+        if id is not None:
+            self._adopted_ids[package.id] = id
+        return package
+
     def _get_parent_elem(self, context, elem):
-        parent_elem = context.contentRoot
-        if elem.parent_package:
-            # Find the corresponding package
-            pkg = context.sofa_root.get_by_id(elem.parent_package.id)
-            if pkg:
-                # Get element corresponding to the package
-                parent_elem = self._lookup(pkg)
-                if parent_elem is None:
-                    # Create the package element.
-                    self.visit_package(context, pkg)
-                    # TODO: May be we return created elements in visitor?
-                    parent_elem = self._lookup(pkg)
+        pkg = elem.parent_package
+        if pkg is None:
+            return context.contentRoot
+        # Get element corresponding to the package
+        parent_elem = self._lookup(pkg)
+        if parent_elem is None:
+            # Create the package element.
+            self.visit_package(context, pkg)
+            # TODO: May be we return created elements in visitor?
+            parent_elem = self._lookup(pkg)
         return parent_elem
 
     def visit_diagram(self, context, diagram): ...
@@ -370,8 +602,8 @@ class XmiVisitor(Visitor):
     def visit_relation(self, context, relation): 
         rel_elem = self._packaged_element(context, self._get_parent_elem(context, relation), relation, self._get_rel_type(relation))
 
-        src_obj = context.sofa_root.get_by_qname(relation.source.name)
-        tgt_obj = context.sofa_root.get_by_qname(relation.target.name)
+        src_obj = relation.source.ref
+        tgt_obj = relation.target.ref
 
         src_endpoint = XmiVisitor.RelationEndPoint(relation, rel_elem, src_obj, self._lookup(src_obj))
         tgt_endpoint = XmiVisitor.RelationEndPoint(relation, rel_elem, tgt_obj, self._lookup(tgt_obj))
@@ -388,26 +620,20 @@ class XmiVisitor(Visitor):
 
         self._common_aspects(context, rel_elem, relation)
 
+    def _endpoint_association_end(self, context, endpoint: RelationEndPoint, role):
+        self._association_end(context, endpoint.endpoint_elem, endpoint.relation, role)
+
     def _connection_relationship_ends(self, context, relation, rel_elem, src_endpoint: RelationEndPoint, tgt_endpoint: RelationEndPoint):
-        # Target endpoint has an ownedAttribute that refers to the source obj
-        src_owned_attr_pointing_to_tgt = self._owned_association_attribute(context, src_endpoint.endpoint_elem, tgt_endpoint.endpoint_obj, relation)
-        # Relation now needs to point to that attribute on one end
-        self._member_end(rel_elem, src_owned_attr_pointing_to_tgt.attrib[f"{XMI}id"])
-        
-        match relation.type:
-            case RelationType.AGGREGATION:
-                src_owned_attr_pointing_to_tgt.set("aggregation", "shared")
-            case RelationType.COMPOSITION:
-                src_owned_attr_pointing_to_tgt.set("aggregation", "composite")
-            case _:
-                src_owned_attr_pointing_to_tgt.set("aggregation", "none")
+        self._endpoint_association_end(context, src_endpoint, RelationRole.SOURCE)
+        # Relation now needs to point to that attribute on one end
+        self._member_end(rel_elem, self._end_id(relation, RelationRole.SOURCE))
 
         if relation.is_bidirectional():
-            tgt_owned_attr_pointing_to_tgt = self._owned_association_attribute(context, tgt_endpoint.endpoint_elem, src_endpoint.endpoint_obj, relation)
-            self._member_end(rel_elem, tgt_owned_attr_pointing_to_tgt.attrib[f"{XMI}id"])
+            self._endpoint_association_end(context, tgt_endpoint, RelationRole.TARGET)
+            self._member_end(rel_elem, self._end_id(relation, RelationRole.TARGET))
         else:
             # Additional member points to ownedElem of the relation itself.
-            rel_owned_end_elem = self._owned_end(context, rel_elem, relation, src_endpoint.endpoint_obj.id)
+            rel_owned_end_elem = self._owned_end(context, rel_elem, relation, self._ref_id(src_endpoint.endpoint_obj))
             self._member_end(rel_elem, rel_owned_end_elem.attrib[f"{XMI}id"])
 
     def visit_interface(self, context, interface): 
@@ -440,7 +666,38 @@ class XmiVisitor(Visitor):
     
     def visit_capability(self, context, capability): ...
 
+    def written_ids(self, context, sofa_root):
+        """
+        Returns the IDs given to the model elements, by qualified name, in the format of ``IdExporter``,
+        so that the XMI need not be parsed again to keep the IDs. Only the packaged elements (see 
+        ``PACKAGED_TYPES``) are included; unlike ``IdExporter``, the elements they own, such as attributes 
+        and generalizations, are left out. With Sparx EA, the names are qualified by 
+        the outer package, which is included. Names shared by several elements are left out, as they 
+        cannot tell the elements apart.
+        """
+        ids = {}
+        prefix = self._ids_prefix(context)
+        if context.is_sparx_ea():
+            ids[context.name()] = self._outer_id
+        elems = {}
+        for elem in sofa_root.model_elements():
+            if not isinstance(elem, self.PACKAGED_TYPES): continue
+            qname = self._qname(elem)
+            # The same element may be listed more than once.
+            if elems.setdefault(qname, elem) is not elem:
+                elems[qname] = None
+        for qname, elem in elems.items():
+            if elem is None: continue
+            ids[prefix + qname] = self._ref_id(elem)
+        return ids
+
+    def _write_ids(self, context, sofa_root):
+        ids_out_file = getattr(context, "ids_out_file", None)
+        if ids_out_file:
+            write_ids(self.written_ids(context, sofa_root), ids_out_file, getattr(context, "manifest", None))
+
     def visit_end(self, context, sofa_root): 
-        # Write to the file. 
+        # Write to the file. 
         # TODO: Should it be here? Probably not.
         context.flush()
+        self._write_ids(context, sofa_root)
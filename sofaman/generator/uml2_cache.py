@@ -0,0 +1,181 @@
+"""
+Module that generates XMI code from the Sofa model incrementally, reusing the XMI of the elements
+that did not change since the previous generation.
+"""
+import hashlib
+import json
+import os
+from importlib import metadata
+from sofaman.generator.generator import FileContext
+from sofaman.generator.uml2_stream import XmiStreamVisitor
+
+def _sofaman_version():
+    try:
+        return metadata.version("sofaman")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+def _digest(value):
+    content = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+class XmiFragmentCache:
+    """
+    The serialized XMI fragments of the elements, keyed by the structural hash of each element
+    (see ``XmiCachedVisitor._fragment_key``), along with the IDs assigned to the elements,
+    by qualified name. The cache is stored in a JSON file, and is discarded as a whole when its
+    header (sofaman version, XMI flavor and formatting, IDs file) does not match the current one.
+    With a manifest (see ``OutputManifest``), the file is only replaced if its content changed.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, cache_file, header, manifest = None):
+        self.cache_file = cache_file
+        self.manifest = manifest
+        self.header = {"format": self.FORMAT, **header}
+        # Qualified name -> ID, of the previous and of the current generation.
+        self.ids = {}
+        self.new_ids = {}
+        # Key -> [fragment, [stereotype applications]], as latin-1 strings.
+        self._fragments = {}
+        self._new_fragments = {}
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file): return
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return # Unreadable, so generated again
+        if data.get("header") != self.header: return
+        self.ids = data["ids"]
+        self._fragments = data["fragments"]
+
+    def get(self, key):
+        """
+        Returns the fragment and the stereotype applications of the given key, or None.
+        """
+        entry = self._fragments.get(key) or self._new_fragments.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._new_fragments[key] = entry
+        fragment, apps = entry
+        return fragment.encode("latin-1"), [app.encode("latin-1") for app in apps]
+
+    def put(self, key, fragment, apps):
+        """
+        Stores the fragment and the stereotype applications of the given key.
+        """
+        self._new_fragments[key] = [fragment.decode("latin-1"), [app.decode("latin-1") for app in apps]]
+
+    def save(self):
+        """
+        Stores the IDs and the fragments of the current generation. Fragments that were
+        not used are dropped.
+        """
+        if not self.cache_file: return
+        # Encoded at once, which is much faster than json.dump for large caches.
+        content = json.dumps({"header": self.header, "ids": self.new_ids, "fragments": self._new_fragments})
+        with FileContext(self.cache_file, self.manifest) as f:
+            f.write(content)
+
+class XmiCachedVisitor(XmiStreamVisitor):
+    """
+    Streaming XMI visitor that keeps the XMI fragment of each element (the element, with
+    its relation ends and stereotype applications) in a cache next to the output, by default
+    ``<output>.cache``. On the next generation, the fragments of the unchanged elements are
+    reused, and only the changed elements are generated again.
+
+    The IDs of the model elements are random, so the elements keep the IDs they were given
+    in the previous generation (by qualified name); otherwise no fragment could be reused.
+    The key of a fragment covers the element itself and everything its XMI refers to: the IDs of
+    referenced elements and the relations whose ends it owns. So an element is generated again
+    when any of its relations changes.
+    """
+
+    # Key of the ID of the outer package of Sparx EA, which is not a model element, in the IDs
+    OUTER_PACKAGE = "<outer package>"
+
+    def __init__(self, cache_file = None):
+        super().__init__()
+        self.cache_file = cache_file
+        self.cache = None
+
+    def visit_root(self, context, sofa_root):
+        cache_file = self.cache_file
+        if cache_file is None and isinstance(context, FileContext):
+            cache_file = f"{context.out_file}.cache"
+        self.cache = XmiFragmentCache(cache_file, self._header(context), getattr(context, "manifest", None))
+        self._adopt_ids(sofa_root, self.cache.ids)
+        # Explicit IDs take precedence over the cached ones.
+        super().visit_root(context, sofa_root)
+        self.cache.new_ids.update(self._adopt_ids(sofa_root, {}))
+
+    def _outer_package(self, context):
+        # Keeps its ID as well, so that unchanged models give the same XMI.
+        package = super()._outer_package(context)
+        if package.id not in self._adopted_ids and self.OUTER_PACKAGE in self.cache.ids:
+            self._adopted_ids[package.id] = self.cache.ids[self.OUTER_PACKAGE]
+        self.cache.new_ids[self.OUTER_PACKAGE] = self._ref_id(package)
+        return package
+
+    def _header(self, context):
+        return {"sofaman": _sofaman_version(), "sparx_ea": context.is_sparx_ea(),
+                "pretty_print": context.pretty_print, "ids": self._ids_digest(context.ids) if context.ids else None}
+
+    def _ids_digest(self, ids):
+        # Stores of IDs that are not loaded have a digest of their own.
+        if hasattr(ids, "digest"): return ids.digest()
+        return _digest(ids if isinstance(ids, dict) else dict(ids.items()))
+
+    def _type_ref_id(self, typed):
+        type_ref = getattr(typed, "type_ref", None)
+        return self._ref_id(type_ref) if type_ref is not None else None
+
+    def _fragment_key(self, method, elem, depth):
+        parts = [method, depth, self._ref_id(elem), self._qname(elem), elem.struct.properties]
+        if elem.parent_package:
+            parts.append(self._ref_id(elem.parent_package))
+        parts.append([self._type_ref_id(attr) for attr in elem.attributes() or []])
+        for op in elem.operations() or []:
+            parts.append([self._type_ref_id(param) for param in op.parameters])
+        if method == "visit_relation":
+            parts.extend([elem.type.name, self._ref_id(elem.source.ref), self._ref_id(elem.target.ref)])
+        # Relation ends placed in the element
+        for relation, role in self._plan.ends.get(elem.id, []):
+            parts.append([self._ref_id(relation), role, relation.type.name,
+                          self._ref_id(relation.source.ref), self._ref_id(relation.target.ref),
+                          relation.struct.properties])
+        return _digest(parts)
+
+    def _write_element(self, context, method, elem):
+        depth = self._writer.depth()
+        key = self._fragment_key(method, elem, depth)
+        cached = self.cache.get(key)
+        if cached is None:
+            first_app = len(self._stereotype_apps)
+            self._build_element(context, method, elem)
+            fragment = self._writer.fragment_bytes(self._holder, depth)
+            del self._holder[:]
+            # Serialized, so that they can be stored as well.
+            for i in range(first_app, len(self._stereotype_apps)):
+                order, holder = self._stereotype_apps[i]
+                self._stereotype_apps[i] = (order, self._writer.fragment_bytes(holder, 1))
+            apps = [app for _, app in self._stereotype_apps[first_app:]]
+            self.cache.put(key, fragment, apps)
+        else:
+            fragment, apps = cached
+            rank = self._plan.rank[elem.id]
+            for app in apps:
+                self._stereotype_apps.append(((rank, len(self._stereotype_apps)), app))
+        self._writer.write_bytes(fragment)
+
+    def visit_end(self, context, sofa_root):
+        super().visit_end(context, sofa_root)
+        self.cache.save()
@@ -0,0 +1,47 @@
+"""
+Module that generates XMI code from the Sofa model, building the top-level packages in parallel.
+"""
+import io
+from sofaman.generator.generator import fork_map
+from sofaman.generator.uml2_stream import XmiStreamVisitor, XmiStreamWriter
+
+class XmiParallelVisitor(XmiStreamVisitor):
+    """
+    Streaming XMI visitor that builds the fragments of the top-level packages in a pool of
+    processes (see ``fork_map``). The fragments are then written in order, followed by the 
+    stereotype applications collected from all the fragments.
+
+    All the references between fragments use the IDs of the model elements, or IDs derived from
+    them (see ``XmiVisitor._end_id``), so they are the same in every process. Relation ends are placed
+    by the plan (see ``XmiStreamPlan``), so relations across packages need no further processing.
+    """
+
+    def __init__(self, workers = None):
+        super().__init__()
+        self.workers = workers
+
+    def visit_package(self, context, package):
+        if self._written: return
+        packages = self._plan.child_packages.get(None, [])
+        self._written.update(map(lambda p: p.id, packages))
+
+        depth = self._writer.depth()
+        fragments = fork_map(lambda pkg: self._package_fragment(context, pkg, depth), packages, self.workers)
+        for content, apps in fragments:
+            self._writer.write_bytes(content)
+            self._stereotype_apps.extend(apps)
+
+    def _package_fragment(self, context, package, depth):
+        # Writes to a buffer instead of the output, usually in a worker.
+        saved = (self._writer, self._element_holder, self._stereotype_apps)
+        writer = self._writer
+        buffer = io.BytesIO()
+        self._writer = XmiStreamWriter(buffer, writer.nsmap, writer.pretty_print, depth)
+        self._element_holder = self._writer.holder()
+        self._stereotype_apps = []
+        try:
+            self._write_package(context, package)
+            apps = [(order, self._writer.fragment_bytes(holder, 1)) for order, holder in self._stereotype_apps]
+        finally:
+            self._writer, self._element_holder, self._stereotype_apps = saved
+        return buffer.getvalue(), apps
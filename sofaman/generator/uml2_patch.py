@@ -0,0 +1,194 @@
+"""
+Module that patches the XMI of a previous generation with the changes of the Sofa model,
+instead of generating the whole XMI again.
+"""
+import os
+import shutil
+import tempfile
+from itertools import chain
+from lxml import etree
+from sofaman.generator.generator import Generator
+from sofaman.generator.uml2 import XmiContext, XmiFlavor, NS_XMI, UML, XMI
+from sofaman.generator.uml2_stream import XmiStreamVisitor
+from sofaman.ir.model import Relation
+
+PACKAGED_ELEMENT = UML + "packagedElement"
+_XMI_IDS = etree.XPath(".//@xmi:id", namespaces={"xmi": NS_XMI})
+
+def read_xmi_ids(xmi_file, outer_levels = 0):
+    """
+    Reads the IDs of the packaged elements of the given XMI file by qualified name, without
+    building the whole DOM. The names of the outer packages (such as the one of Sparx EA)
+    are not part of the qualified names. Ambiguous names are left out.
+    """
+    ids = {}
+    duplicates = set()
+    names = []
+    for event, elem in etree.iterparse(xmi_file, events=("start", "end"), tag=PACKAGED_ELEMENT):
+        if event == "start":
+            names.append(elem.get("name"))
+            continue
+        if len(names) > outer_levels:
+            qname = ".".join(names[outer_levels:])
+            if qname in ids:
+                duplicates.add(qname)
+            ids[qname] = elem.get(XMI + "id")
+        names.pop()
+        # Contained elements are done, so only the ancestors are kept.
+        elem.getparent().remove(elem)
+    for qname in duplicates:
+        del ids[qname]
+    return ids
+
+class XmiFragmentReader:
+    """
+    Reads the packaged elements (other than packages) and the stereotype applications of an
+    XMI file incrementally. The elements are detached from the document as they are read, so
+    that only the elements that are not requested yet are kept in memory.
+    """
+
+    def __init__(self, xmi_file, wanted):
+        self.xmi_file = xmi_file
+        # IDs of the elements that will be requested; the others are dropped.
+        self.wanted = wanted
+        self._elements = self._read()
+        self._pending = {}
+        self._apps = []
+
+    def fragment(self, id):
+        """
+        Returns the element with the given ID (which must be wanted), or None if it is not in the file.
+        The file is read up to the element; the wanted elements before it are kept for later requests.
+        """
+        elem = self._pending.pop(id, None)
+        while elem is None:
+            elem = next(self._elements, None)
+            if elem is None: return None
+            if elem.get(XMI + "id") != id:
+                self._pending[elem.get(XMI + "id")] = elem
+                elem = None
+        return elem
+
+    def stereotype_apps(self):
+        """
+        Reads the rest of the file, and returns the stereotype applications in their order.
+        """
+        for _ in self._elements: ... # Requested elements are done.
+        self._pending = {}
+        return self._apps
+
+    def _read(self):
+        # Blank text is ignored, so that the elements can be written with any indentation.
+        events = etree.iterparse(self.xmi_file, tag=PACKAGED_ELEMENT, remove_blank_text=True)
+        for _, elem in events:
+            elem.getparent().remove(elem)
+            if elem.get(XMI + "id") in self.wanted:
+                yield elem
+        # Other children of the root are the model and its documentation.
+        self._apps = [elem for elem in events.root if elem.tag not in (UML + "Model", XMI + "Documentation")]
+
+class XmiPatcher(XmiStreamVisitor):
+    """
+    Streaming XMI visitor that patches the XMI file of a previous generation with the changes of
+    the model (see ``SofaRoot.diff``). The elements keep the IDs they have in the previous file.
+    Unchanged elements are copied from the previous file, and only the added and modified elements
+    are generated, along with the elements that hold the ends of the changed relations. Removed
+    elements are left out. The result is the same as that of a full generation.
+
+    The previous file, generated by sofaman with the same XMI flavor, is read incrementally twice:
+    first for the IDs (see ``read_xmi_ids``), then for the elements to copy (see ``XmiFragmentReader``).
+    The elements are written in the order of the model; when it matches the previous file,
+    the copied elements are only kept in memory until they are written.
+    """
+
+    def __init__(self, xmi_file, change_set):
+        super().__init__()
+        self.xmi_file = xmi_file
+        self.change_set = change_set
+        self._reader = None
+        # IDs of the model elements that are generated
+        self._generated_ids = set()
+        # XMI ID -> rank of the copied element that contains it
+        self._copied_ranks = {}
+        self.copied = 0
+        self.generated = 0
+
+    def visit_root(self, context, sofa_root):
+        super().visit_root(context, sofa_root)
+        # Sparx EA has an outer package, which is not part of the qualified names.
+        outer_levels = 1 if context.contentRoot.tag == PACKAGED_ELEMENT else 0
+        self._adopt_ids(sofa_root, read_xmi_ids(self.xmi_file, outer_levels))
+
+        members = [elem for elems in self._plan.members.values() for _, elem in elems]
+        self._generated_ids = self._elements_to_generate(sofa_root, members)
+        wanted = set(self._ref_id(elem) for elem in members if elem.id not in self._generated_ids)
+        self._reader = XmiFragmentReader(self.xmi_file, wanted)
+
+    def _elements_to_generate(self, sofa_root, members):
+        generated = set(map(lambda elem: elem.id, chain(self.change_set.added, self.change_set.modified)))
+        relations = list(filter(lambda elem: isinstance(elem, Relation), self.change_set.elements()))
+
+        # Elements without an ID in the previous file, and the elements that refer to them.
+        new_ids = set(elem.id for elem in members if elem.id not in self._adopted_ids)
+        if new_ids:
+            generated.update(new_ids)
+            for elem in members:
+                if isinstance(elem, Relation):
+                    if {elem.id, getattr(elem.source.ref, "id", None), getattr(elem.target.ref, "id", None)} & new_ids:
+                        generated.add(elem.id)
+                        relations.append(elem)
+                elif any(getattr(attr.type_ref, "id", None) in new_ids for attr in elem.attributes() or []):
+                    generated.add(elem.id)
+
+        # The ends of the relations are placed in the related elements.
+        for relation in relations:
+            for endpoint in (relation.source, relation.target):
+                if endpoint.ref is None: continue
+                # Removed relations refer to the elements of the old model.
+                ref = sofa_root.get_by_qname(endpoint.ref.get_qname())
+                if ref is not None: generated.add(ref.id)
+        return generated
+
+    def _write_element(self, context, method, elem):
+        fragment = None
+        if elem.id not in self._generated_ids:
+            fragment = self._reader.fragment(self._ref_id(elem))
+        if fragment is None:
+            self.generated += 1
+            super()._write_element(context, method, elem)
+            return
+
+        self.copied += 1
+        rank = self._plan.rank[elem.id]
+        for id in _XMI_IDS(fragment):
+            self._copied_ranks[id] = rank
+        self._element_holder.append(fragment)
+        self._writer.write_fragments(self._element_holder)
+        del self._element_holder[:]
+
+    def _write_stereotype_apps(self):
+        # Applications of the copied elements, in the order of the previous file.
+        for app in self._reader.stereotype_apps():
+            bases = [value for name, value in app.attrib.items() if name.startswith("base_")]
+            rank = next((self._copied_ranks[base] for base in bases if base in self._copied_ranks), None)
+            # Otherwise the element is removed or generated.
+            if rank is None: continue
+            holder = self._writer.holder()
+            holder.append(app)
+            self._stereotype_apps.append(((rank, len(self._stereotype_apps)), holder))
+        super()._write_stereotype_apps()
+
+def patch_xmi(xmi_file, sofa_root, change_set, mode = XmiFlavor.SPARX_EA, pretty_print = True):
+    """
+    Patches the given XMI file in place with the changes of the model (see ``XmiPatcher``).
+    The patched XMI is written to a temporary file next to it, which then replaces it.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(xmi_file)))
+    try:
+        # Same file name, as the outer package is named after the file.
+        out_file = os.path.join(tmp_dir, os.path.basename(xmi_file))
+        with XmiContext(out_file, mode=mode, pretty_print=pretty_print, compress=xmi_file.endswith(".gz")) as context:
+            Generator().generate(sofa_root, context, XmiPatcher(xmi_file, change_set))
+        os.replace(out_file, xmi_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
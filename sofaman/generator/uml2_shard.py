@@ -0,0 +1,66 @@
+"""
+Module that generates XMI code from the Sofa model as a set of documents, one per package.
+"""
+from lxml.etree import SubElement
+from sofaman.generator.generator import FileContext, fork_map
+from sofaman.generator.uml2 import UML, XMI
+from sofaman.generator.uml2_stream import XmiStreamVisitor
+
+class XmiShardVisitor(XmiStreamVisitor):
+    """
+    Streaming XMI visitor that writes each package to a separate XMI document (a shard), similar
+    to controlled packages. The documents refer to the packages directly below them through proxies
+    (``href``) to their shards. So each shard contains only the elements of its own package, along 
+    with their stereotype applications, and only the shards of changed packages need to be imported again.
+    In every shard, the package is placed directly in the model (in the outer package for Sparx EA);
+    the package that owns it is given by the proxy in the document of the owner.
+
+    Relation ends are written in the shard of the element that owns them, and refer to the 
+    relation by its ID, across shards if necessary.
+
+    When the output is stored in files, the shards of the top-level packages are written 
+    in parallel (see ``fork_map``).
+    """
+
+    def __init__(self, workers = None):
+        super().__init__()
+        self.workers = workers
+
+    def visit_package(self, context, package):
+        if self._written: return
+        packages = self._plan.child_packages.get(None, [])
+        self._written.update(map(lambda p: p.id, packages))
+        for pkg in packages:
+            self._write_proxy(context, pkg)
+        # Shards in memory must be written by this process.
+        workers = self.workers if isinstance(context, FileContext) else 1
+        list(fork_map(lambda pkg: self._write_shard(context, pkg), packages, workers))
+
+    def _write_package(self, context, package):
+        # In the document of the parent package, only a proxy to the shard.
+        self._write_proxy(context, package)
+        self._write_shard(context, package)
+
+    def _shard_name(self, context, package):
+        return f"{context.name()}.{package.get_qname()}"
+
+    def _write_proxy(self, context, package):
+        holder = self._writer.holder()
+        elem = SubElement(holder, UML + "packagedElement")
+        elem.set(XMI + "type", "uml:Package")
+        shard_file = context.shard_file_name(self._shard_name(context, package))
+        elem.set("href", f"{shard_file}#{self._ref_id(package)}")
+        self._writer.write_fragments(holder)
+
+    def _write_shard(self, context, package):
+        shard = context.shard(self._shard_name(context, package))
+        saved = (self._writer, self._stereotype_apps)
+        self._writer = self._create_writer(context, shard)
+        self._stereotype_apps = []
+        try:
+            self._start_document(context)
+            super()._write_package(context, package)
+            self._end_document()
+        finally:
+            shard.close()
+            self._writer, self._stereotype_apps = saved
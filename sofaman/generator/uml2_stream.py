@@ -0,0 +1,343 @@
+"""
+Module that generates XMI code from the Sofa model incrementally, without building the whole DOM.
+"""
+from copy import deepcopy
+from lxml import etree
+from lxml.etree import Element, SubElement
+from sofaman.generator.uml2 import XmiVisitor, RelationRole, NS_MAP, XMI
+from sofaman.ir.model import RelationType, Visitor
+
+class XmiStreamWriter:
+    """
+    Writes XML incrementally to a binary stream. Container elements (such as root, model and packages)
+    are written as separate start and end tags, all other elements are written as complete fragments
+    as soon as they are built. The output is the same as that of the serialized DOM.
+    """
+
+    INDENT = b"  "
+
+    def __init__(self, stream, nsmap, pretty_print = True, depth = 0):
+        self.stream = stream
+        self.nsmap = nsmap
+        self.pretty_print = pretty_print
+        # Elements opened by another writer, when writing a part of the document (see depth).
+        self._open_tags = [None] * depth
+        self._ns_decls = [(f' xmlns:{prefix}="{uri}"' if prefix else f' xmlns="{uri}"').encode() 
+                          for prefix, uri in nsmap.items()]
+        # Start tag that is not written yet, as the element may remain empty.
+        self._pending = None
+
+    def holder(self):
+        """
+        Creates an element in which the fragments are built. It declares the namespaces
+        of the document, so that the fragments do not need to.
+        """
+        return Element(XMI + "XMI", nsmap=self.nsmap)
+
+    def start(self, elem):
+        """
+        Writes the start tag of the given element. The children of the element are
+        returned, so that they can be written separately.
+        """
+        self._write_pending()
+        # Serialized in place, in order to keep the prefix chosen in the document. 
+        # Containers are written when they have few children, so this is cheap.
+        content = etree.tostring(elem)
+        start_tag = content[:content.index(b">")].removesuffix(b"/")
+        if self._open_tags:
+            # The namespaces are already declared by the document root.
+            for ns_decl in self._ns_decls:
+                start_tag = start_tag.replace(ns_decl, b"")
+        tag_end = min(filter(lambda i: i > 0, (start_tag.find(b" "), start_tag.find(b"\n"), len(start_tag))))
+        self._pending = start_tag
+        self._open_tags.append(start_tag[1:tag_end])
+        return list(elem)
+
+    def end(self):
+        """
+        Writes the end tag of the last started element.
+        """
+        tag = self._open_tags.pop()
+        indent = self._indent(len(self._open_tags))
+        if self._pending is not None:
+            # Nothing was written inside, so it is an empty element.
+            self.stream.write(indent + self._pending + b"/>" + self._newline())
+            self._pending = None
+        else:
+            self.stream.write(indent + b"</" + tag + b">" + self._newline())
+
+    def write(self, elem):
+        """
+        Writes the given element as a complete fragment.
+        """
+        holder = self.holder()
+        holder.append(elem)
+        self.write_fragments(holder)
+
+    def write_fragments(self, holder):
+        """
+        Writes all the children of the given holder (see ``holder``) as complete fragments.
+        """
+        if len(holder) == 0: return
+        self.write_bytes(self.fragment_bytes(holder, len(self._open_tags)))
+
+    def write_bytes(self, content):
+        """
+        Writes already serialized content (see ``fragment_bytes``).
+        """
+        self._write_pending()
+        self.stream.write(content)
+
+    def fragment_bytes(self, holder, depth):
+        """
+        Serializes the children of the given holder, as if they were written at the given depth.
+        """
+        content = self._inner(holder)
+        if not self.pretty_print:
+            return content
+        # Serialized with one level of indentation, as children of the holder.
+        content = content[1:] # Leading newline
+        if depth > 1:
+            indent = self._indent(depth - 1)
+            content = indent + content[:-1].replace(b"\n", b"\n" + indent) + b"\n"
+        return content
+
+    def depth(self):
+        """
+        Returns the number of open elements.
+        """
+        return len(self._open_tags)
+
+    def _inner(self, holder):
+        content = etree.tostring(holder, pretty_print=self.pretty_print)
+        return content[content.index(b">") + 1:content.rindex(b"</")]
+
+    def _write_pending(self):
+        if self._pending is None: return
+        indent = self._indent(len(self._open_tags) - 1)
+        self.stream.write(indent + self._pending + b">" + self._newline())
+        self._pending = None
+
+    def _indent(self, depth):
+        return self.INDENT * depth if self.pretty_print else b""
+
+    def _newline(self):
+        return b"\n" if self.pretty_print else b""
+
+class XmiStreamPlan(Visitor):
+    """
+    Index of the model that allows to write the XMI in a single pass: the package tree,
+    the members of each package, and the relation ends that are placed inside the related
+    elements. Relation ends are known upfront, so no element needs to be revisited.
+    """
+
+    def __init__(self, sofa_root):
+        # Package id (None for the top level) -> packages / (visit method, element)
+        self.child_packages = {}
+        self.members = {}
+        # Element id -> [(relation, role)]; role is None for generalizations.
+        self.ends = {}
+        # Element id -> order in which the DOM engine creates the element.
+        self.rank = {}
+        sofa_root.visit(None, self)
+
+    def _parent_id(self, elem):
+        return elem.parent_package.id if elem.parent_package else None
+
+    def _add_member(self, method, elem):
+        self.rank[elem.id] = len(self.rank)
+        self.members.setdefault(self._parent_id(elem), []).append((method, elem))
+
+    def visit_root(self, context, sofa_root): ...
+
+    def visit_diagram(self, context, diagram): ...
+
+    def visit_package(self, context, package):
+        if package.id in self.rank: return
+        # Parents are created first, even if they are declared later.
+        if package.parent_package: self.visit_package(context, package.parent_package)
+        self.rank[package.id] = len(self.rank)
+        self.child_packages.setdefault(self._parent_id(package), []).append(package)
+
+    def visit_stereotype_profile(self, context, stereotype_profile): ...
+
+    def visit_primitive(self, context, primitive):
+        self._add_member("visit_primitive", primitive)
+
+    def visit_actor(self, context, actor):
+        self._add_member("visit_actor", actor)
+
+    def visit_component(self, context, component):
+        self._add_member("visit_component", component)
+
+    def visit_relation(self, context, relation):
+        self._add_member("visit_relation", relation)
+        match relation.type:
+            case RelationType.INHERITANCE:
+                self.ends.setdefault(relation.source.ref.id, []).append((relation, None))
+            case RelationType.REALIZATION | RelationType.INFORMATION_FLOW:
+                ... # Only refer to the endpoints
+            case _:
+                self.ends.setdefault(relation.source.ref.id, []).append((relation, RelationRole.SOURCE))
+                if relation.is_bidirectional():
+                    self.ends.setdefault(relation.target.ref.id, []).append((relation, RelationRole.TARGET))
+
+    def visit_interface(self, context, interface):
+        self._add_member("visit_interface", interface)
+
+    def visit_class(self, context, clazz):
+        self._add_member("visit_class", clazz)
+
+    def visit_domain(self, context, domain): ...
+
+    def visit_capability(self, context, capability): ...
+
+    def visit_end(self, context, sofa_root): ...
+
+class XmiStreamVisitor(XmiVisitor):
+    """
+    XMI visitor that writes the XMI incrementally to the binary stream of the context,
+    instead of building the whole DOM. Each package is written with all its contents when it
+    is visited, and elements outside of packages are written as they are visited.
+    Only the stereotype applications, which are placed after the model, are kept until the end.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._plan = None
+        self._writer = None
+        self._holder = None
+        self._element_holder = None
+        self._rank = 0
+        self._stereotype_apps = []
+        self._written = set()
+
+    def _register(self, obj, elem):
+        ... # Elements are written as soon as they are complete, so they are not retained.
+
+    def _get_parent_elem(self, context, elem):
+        # The element is built detached and written when complete.
+        return self._holder
+
+    def _stereotype_elem(self, context, tag):
+        holder = self._writer.holder()
+        # Keep the order of the DOM engine, independent of the order of writing.
+        self._stereotype_apps.append(((self._rank, len(self._stereotype_apps)), holder))
+        return SubElement(holder, tag)
+
+    def _inheritance(self, context, relation, src_ep, tgt_ep):
+        ... # Written with the source element (see _write_ends)
+
+    def _endpoint_association_end(self, context, endpoint, role):
+        ... # Written with the endpoint element (see _write_ends)
+
+    def visit_root(self, context, sofa_root):
+        # Builds the skeleton of the document (root, model and outer package)
+        super().visit_root(context, sofa_root)
+        self._plan = XmiStreamPlan(sofa_root)
+        self._writer = self._create_writer(context)
+        self._element_holder = self._writer.holder()
+        self._start_document(context)
+
+    def _create_writer(self, context, output = None):
+        # The output context, if given, is the one of a separate document (see uml2_shard).
+        output = output or context
+        return XmiStreamWriter(output.xmi_stream(), context.root.nsmap, output.pretty_print)
+
+    def _start_document(self, context):
+        self._start_containers(context.root, [context.umlModel, context.contentRoot])
+
+    def _start_containers(self, elem, path):
+        for child in self._writer.start(elem):
+            if child in path:
+                self._start_containers(child, path)
+            else:
+                # A copy, the skeleton stays intact for other documents.
+                self._writer.write(deepcopy(child))
+
+    def visit_package(self, context, package):
+        top = package
+        while top.parent_package: top = top.parent_package
+        if top.id in self._written: return
+        self._written.add(top.id)
+        self._write_package(context, top)
+
+    def _write_package(self, context, package):
+        self._holder = self._writer.holder()
+        self._rank = self._plan.rank[package.id]
+        elem = self._packaged_element(context, self._holder, package, "Package")
+        for child in self._writer.start(elem):
+            self._writer.write(child)
+
+        for sub_package in self._plan.child_packages.get(package.id, []):
+            self._write_package(context, sub_package)
+        for method, member in self._plan.members.get(package.id, []):
+            self._write_element(context, method, member)
+
+        holder = self._writer.holder()
+        self._write_ends(context, holder, package)
+        self._writer.write_fragments(holder)
+        self._writer.end()
+
+    def _write_element(self, context, method, elem):
+        self._build_element(context, method, elem)
+        self._writer.write_fragments(self._holder)
+        del self._holder[:]
+
+    def _build_element(self, context, method, elem):
+        # The same holder is reused for all elements, as creating it is not cheap.
+        self._holder = self._element_holder
+        self._rank = self._plan.rank[elem.id]
+        getattr(XmiVisitor, method)(self, context, elem)
+        self._write_ends(context, self._holder[0], elem)
+
+    def _write_ends(self, context, parent, elem):
+        for relation, role in self._plan.ends.get(elem.id, []):
+            if role is None:
+                self._generalization(context, parent, relation, relation.target.ref)
+            else:
+                self._association_end(context, parent, relation, role)
+
+    def _write_if_top_level(self, context, method, elem):
+        # Elements inside packages are written together with the package.
+        if elem.parent_package is None:
+            self._write_element(context, method, elem)
+
+    def visit_primitive(self, context, primitive):
+        self._write_if_top_level(context, "visit_primitive", primitive)
+
+    def visit_actor(self, context, actor):
+        self._write_if_top_level(context, "visit_actor", actor)
+
+    def visit_component(self, context, component):
+        self._write_if_top_level(context, "visit_component", component)
+
+    def visit_relation(self, context, relation):
+        self._write_if_top_level(context, "visit_relation", relation)
+
+    def visit_interface(self, context, interface):
+        self._write_if_top_level(context, "visit_interface", interface)
+
+    def visit_class(self, context, clazz):
+        self._write_if_top_level(context, "visit_class", clazz)
+
+    def visit_end(self, context, sofa_root):
+        self._end_document()
+        context.close()
+        self._write_ids(context, sofa_root)
+
+    def _end_document(self):
+        # Close everything up to the root, then add the stereotype applications.
+        while self._writer.depth() > 1:
+            self._writer.end()
+        self._write_stereotype_apps()
+        self._writer.end()
+
+    def _write_stereotype_apps(self):
+        for _, app in sorted(self._stereotype_apps, key=lambda app: app[0]):
+            # Either a holder, or an application that is already serialized.
+            if isinstance(app, bytes):
+                self._writer.write_bytes(app)
+            else:
+                self._writer.write_fragments(app)
+        self._stereotype_apps = []
@@ -1,6 +1,7 @@
 """
 This is a mostly internal module that is used to build the intermediate representation from the AST.
 """
+import sys
 from sofaman.parser.sofa_parser import SofaParser
 from sofaman.ir.model import (IrContext, SofaRoot, KeyValue, Struct, 
                     Capability, Domain, Interface, Component, 
@@ -35,13 +36,13 @@ class SofaStructTransformer(Transformer):
         return args[0]
     
     def name(self, args):
-        return args[0].strip("\"")
+        return sys.intern(args[0].strip("\""))
     
     def multiline_scalar(self, args):
         return args[0]
 
     def vector_items(self, args):
-        return list(map(lambda s: s.strip(), args)) # TODO: This is not nice. Need to fix it at grammar level!!
+        return list(map(lambda s: sys.intern(s.strip()), args)) # TODO: This is not nice. Need to fix it at grammar level!!
 
     def vector(self, args):
         return self._as_flat_list(args)
@@ -78,7 +79,8 @@ class SofaStructTransformer(Transformer):
         return args[0]
 
     def _as_string(self, args):
-        return args.value
+        # Names and values recur throughout the model, so each is kept once (which pickling preserves).
+        return sys.intern(args.value)
 
 class SofaTransformer(SofaStructTransformer):
     """
@@ -7,6 +7,7 @@ from enum import Enum
 from pathlib import Path
 from typing import Protocol, List, runtime_checkable, Tuple
 from abc import abstractmethod
+import gc
 import uuid
 
 class IrContext:
@@ -152,6 +153,26 @@ class Named(Protocol):
     def __repr__(self):
         return self.get_name()
 
+# Type -> whether its objects are Named
+_named_types = {}
+
+def is_named(obj):
+    """
+    Returns whether the object is Named. Same as ``isinstance(obj, Named)``, but checked once per 
+    type, as the check of a runtime protocol is slow.
+    """
+    named = _named_types.get(type(obj))
+    if named is None:
+        named = _named_types[type(obj)] = isinstance(obj, Named)
+    return named
+
+def model_class(obj):
+    """
+    Returns the class of the model of the object. Snapshots decode elements into subclasses, which 
+    link them lazily (see ``sofaman.ir.snapshot``).
+    """
+    return getattr(type(obj), "model_class", type(obj))
+
 class KeyValue(Named):
     """
     Represents a key-value pair.
@@ -229,6 +250,13 @@ class Visibility(Enum):
     PUBLIC = "public"
     PROTECTED = "protected"
 
+def _unbound_state(obj, ref):
+    # The reference bound at link time is not pickled, as chains of references (e.g. attributes of 
+    # class types) would be pickled depth-first. The root binds it again (see SofaRoot.__setstate__).
+    state = obj.__dict__.copy()
+    state[ref] = None
+    return state
+
 class Attribute(SofaBase, Named, PropertyContainer):
     """
     Represents an attribute of a class, a component, interface etc.
@@ -241,6 +269,11 @@ class Attribute(SofaBase, Named, PropertyContainer):
         self.value = props.get("value", "")
         self.cardinality = Cardinality(props.get("cardinality", None))
         self.type = props.get("type", None)
+        # Bound at link time (see SofaRoot._bind_references)
+        self.type_ref = None
+
+    def __getstate__(self):
+        return _unbound_state(self, "type_ref")
 
     def get_name(self):
         return self.name
@@ -264,8 +297,13 @@ class Parameter(SofaBase, Named, PropertyContainer):
         PropertyContainer.__init__(self, props)
         self.name = name
         self.type = props.get("type", None)
+        # Bound at link time (see SofaRoot._bind_references)
+        self.type_ref = None
         self.direction = ParameterDirection(props.get("direction", ParameterDirection.IN.value))
 
+    def __getstate__(self):
+        return _unbound_state(self, "type_ref")
+
     def get_name(self):
         return self.name
 
@@ -305,6 +343,8 @@ class ArchElement(SofaBase, Named, PropertyContainer):
         PropertyContainer.__init__(self, struct.properties)
         self.struct = struct
         self.parent_package = None
+        self._attrs = None
+        self._ops = None
     
     def get_name(self):
         return self.struct.name
@@ -338,6 +378,9 @@ class ArchElement(SofaBase, Named, PropertyContainer):
         """
         Returns the attributes of the element.
         """
+        if self._attrs is not None:
+            return self._attrs
+
         props = self.struct.properties
 
         if not "attributes" in props: return None
@@ -348,12 +391,17 @@ class ArchElement(SofaBase, Named, PropertyContainer):
         for attr_name in attrs:
             attr_props = attrs[attr_name]
             ret.append(Attribute(attr_name, attr_props))
+        # Cached, as the references of the attributes are bound at link time
+        self._attrs = ret
         return ret
 
     def operations(self):
         """
         Returns the operations of the element.
         """
+        if self._ops is not None:
+            return self._ops
+
         props = self.struct.properties
 
         if not "operations" in props: return None
@@ -364,6 +412,8 @@ class ArchElement(SofaBase, Named, PropertyContainer):
         for op_name in ops:
             op_props = ops[op_name]
             ret.append(Operation(op_name, op_props))
+        # Cached, as the references of the parameters are bound at link time
+        self._ops = ret
         return ret
 
     def list_values(self, prop_name, value_class):
@@ -384,6 +434,14 @@ class ArchElement(SofaBase, Named, PropertyContainer):
                 raise AssertionError("Type of value must be str")
         return ret
 
+    def is_same(self, other):
+        """
+        Returns whether the other element is declared the same way as this one, ignoring the IDs.
+        """
+        return (model_class(self) is model_class(other) and self.get_qname() == other.get_qname()
+                and self.struct.inheritance == other.struct.inheritance
+                and self.struct.properties == other.struct.properties)
+
 
 class ArchElementList():
     """
@@ -518,6 +576,18 @@ class EndPoint:
         self.name = name
         self.port = port
         self.cardinality = cardinality
+        # The referenced element, bound at link time (see SofaRoot._bind_references)
+        self.ref = None
+
+    def __getstate__(self):
+        return _unbound_state(self, "ref")
+
+    def is_same(self, other):
+        """
+        Returns whether the other end point refers to the same element and port.
+        """
+        port, other_port = (p.get_name() if p else None for p in (self.port, other.port))
+        return self.name == other.name and port == other_port
 
 class Relation(ArchElement): 
     """
@@ -562,6 +632,10 @@ class Relation(ArchElement):
         return (self.type == RelationType.INFORMATION_FLOW 
             or self.type == RelationType.BI_INFO_FLOW)
 
+    def is_same(self, other):
+        return (super().is_same(other) and self.type == other.type
+                and self.source.is_same(other.source) and self.target.is_same(other.target))
+
 class Relations(ArchElementList): 
     """
     Represents a list of relations.
@@ -596,6 +670,11 @@ class StereotypeReference(Named):
         else:
             self.profile = profile
             self.name = name
+        # The referenced profile, bound at link time (see SofaRoot._bind_references)
+        self.profile_ref = None
+
+    def __getstate__(self):
+        return _unbound_state(self, "profile_ref")
 
     def get_name(self):
         return self.name
@@ -740,6 +819,19 @@ class Domain(ArchElement):
         """
         return self.list_values("capabilities", str) # TODO: May be CapabilityReference instead of str.
 
+class UnresolvedReference:
+    """
+    Represents a reference by name that could not be bound to an element.
+    """
+
+    def __init__(self, referrer, name, kind):
+        self.referrer = referrer
+        self.name = name
+        self.kind = kind
+
+    def __repr__(self):
+        return f"{self.kind} {self.name} referenced by {self.referrer}"
+
 # ----
 
 class Visitor(Protocol):
@@ -844,58 +936,180 @@ class ValidationError(Exception):
     """
     ...
 
+class ChangeSet:
+    """
+    Represents the elements that were added, removed or modified since the last validation.
+    A modified element is expected to keep its qualified name; a rename is a removal followed by an addition.
+    """
+
+    def __init__(self, added = None, removed = None, modified = None):
+        self.added = list(added or [])
+        self.removed = list(removed or [])
+        self.modified = list(modified or [])
+
+    def elements(self):
+        """
+        Returns all the changed elements.
+        """
+        yield from self.added
+        yield from self.removed
+        yield from self.modified
+
+    def is_empty(self):
+        """
+        Returns whether there are no changes.
+        """
+        return not (self.added or self.removed or self.modified)
+
 class Validator:
     """
     Validates that the sofa model is semantically correct and complete.
+    The results of the last validation are kept, so that a subsequent validation 
+    of a change set only needs to re-check the relations affected by the change.
     """
 
+    def __init__(self):
+        # Relation id -> ValidationError (or None if the relation is valid)
+        self.results = None
+
     def validate(self, sofa_root):
         """
         Validates the sofa model.
         """
-        self._validate_relations(sofa_root)
+        self.results = {}
+        self._validate_relations(sofa_root, sofa_root.relations)
+        self._raise_errors(sofa_root)
+
+    def validate_changes(self, sofa_root, change_set: ChangeSet):
+        """
+        Validates only the relations affected by the given change set. Results of the 
+        untouched relations are taken over from the previous validation.
+        Falls back to a full validation if the model was not validated before.
+        The relations are checked against the ends bound by the root, which keeps them up to date
+        when children are appended or removed (see ``SofaRoot.append_child``). The re-checked
+        relations must still be bound to the elements of their names.
+        """
+        if self.results is None:
+            return self.validate(sofa_root)
+
+        for elem in change_set.removed:
+            if isinstance(elem, Relation):
+                self.results.pop(elem.id, None)
+
+        self._validate_relations(sofa_root, self._affected_relations(sofa_root, change_set))
+        self._raise_errors(sofa_root)
+
+    def _affected_relations(self, sofa_root, change_set: ChangeSet):
+        """
+        Returns the relations that need to be re-checked due to the change set.
+        """
+        removed_ids = set(map(lambda e: e.id, change_set.removed))
+        affected = {}
+        for elem in change_set.elements():
+            if isinstance(elem, Relation):
+                if elem.id not in removed_ids:
+                    affected[elem.id] = elem
+            elif isinstance(elem, ArchElement):
+                # Relations referring to the element by name (reverse references)
+                for rel in sofa_root.get_referrers(elem.get_qname()):
+                    if isinstance(rel, Relation): affected[rel.id] = rel
+        return affected.values()
+
+    def _raise_errors(self, sofa_root):
+        # Report in the order of the relations, which is the same as a full validation.
+        errors = []
+        for rel in sofa_root.relations:
+            error = self.results.get(rel.id, None)
+            if error: errors.append(error)
+        # Then the types and stereotypes not bound by the root, whose relation ends are checked above.
+        for unresolved in sofa_root.unresolved:
+            if unresolved.kind not in ("Source", "Target"):
+                errors.append(ValidationError(f"{unresolved}, but is not defined"))
+        
+        if not errors: return
+        if len(errors) == 1: raise errors[0]
+        # Report all of them at once
+        raise ValidationError("\n".join(map(str, errors)))
 
-    def _validate_relations(self, sofa_root):
+    def _validate_relations(self, sofa_root, relations):
         """
-        Validates the relations in the sofa model.
+        Validates the given relations in the sofa model.
         """
         
-        if not sofa_root.relations: return
+        if not relations: return
+
+        for rel in relations:
+            self.results[rel.id] = self._validate_relation(sofa_root, rel)
+
+    def _validate_relation(self, sofa_root, rel):
+        """
+        Validates a single relation. Returns the validation error, if any.
+        """
+        # Ensure the ends are bound to the elements named, as the validation of changes relies on them.
+        for endpoint in (rel.source, rel.target):
+            if endpoint.ref is not None and sofa_root.get_by_qname(endpoint.name) is not endpoint.ref:
+                return ValidationError(f"Relation {rel} references obj {endpoint.name}, but is bound to another element")
 
         # Ensure name and ports are defined when used in relations.
-        for rel in sofa_root.relations:
-            try:
-                source_def = sofa_root.get_by_qname(rel.source.name)
-            except KeyError:
-                raise ValidationError(f"Relation {rel} references obj {rel.source.name}, but is not defined")
-            
-            if not source_def: 
-                raise ValidationError(f"Relation {rel} references obj {rel.source.name}, but is not defined")
-            if isinstance(source_def, Component):
-                source_port = rel.source.port
-                if source_port and (source_def.ports() is None 
-                                    or not filter(lambda p: (p.get_name()), source_def.ports())): 
-                    raise ValidationError(f"Relation {rel} references source port {source_port}, but is not defined in {source_def}")
-
-            target_def = sofa_root.get_by_qname(rel.target.name)
-            if not target_def: 
-                raise ValidationError(f"Relation {rel} references obj {rel.target.name}, but is not defined")
-            if isinstance(target_def, Component):
-                target_port = rel.target.port
-                if target_port and (target_def.ports() is None
-                                    or not filter(lambda p: (p.get_name()), target_def.ports())): 
-                    raise ValidationError(f"Relation {rel} references target port {target_port}, but is not defined in {target_def}")
+        source_def = rel.source.ref
+        if not source_def: 
+            return ValidationError(f"Relation {rel} references obj {rel.source.name}, but is not defined")
+        if isinstance(source_def, Component):
+            source_port = rel.source.port
+            if source_port and (source_def.ports() is None 
+                                or not filter(lambda p: (p.get_name()), source_def.ports())): 
+                return ValidationError(f"Relation {rel} references source port {source_port}, but is not defined in {source_def}")
+
+        target_def = rel.target.ref
+        if not target_def: 
+            return ValidationError(f"Relation {rel} references obj {rel.target.name}, but is not defined")
+        if isinstance(target_def, Component):
+            target_port = rel.target.port
+            if target_port and (target_def.ports() is None
+                                or not filter(lambda p: (p.get_name()), target_def.ports())): 
+                return ValidationError(f"Relation {rel} references target port {target_port}, but is not defined in {target_def}")
+        return None
+
+
+def _members(elem):
+    # The element and what it owns, which refer to other elements by name
+    yield elem
+    if not isinstance(elem, ArchElement): return
+    yield from elem.attributes() or []
+    for op in elem.operations() or []:
+        yield op
+        yield from op.parameters
 
+def _typed_members(elem):
+    if not isinstance(elem, ArchElement): return
+    for member in _members(elem):
+        if isinstance(member, (Attribute, Parameter)) and member.type is not None:
+            yield member
 
 # ----
 class SofaRoot:
     """
     Represents the root of the sofa model. Contains all the elements and provide some convenience methods.
+
+    The root can be pickled, e.g. to send it to other processes. The elements are pickled once, along
+    with their packages, and the strings they share (see ``SofaTransformer``) are pickled once as well. 
+    The indexes by ID and of the referrers are not pickled, nor are the references bound by name 
+    (types, relation ends and stereotype profiles); they are rebuilt when unpickling. The index by 
+    name is pickled, as elements are indexed by their name as of the indexing, before they are linked 
+    to their packages.
     """
+
+    # Derived from the elements
+    _INDEXES = ("index_id", "index_referrers")
+
     def __init__(self):
         self.children = []
         self.index_id = {}
         self.index_name = {}
+        # Reverse references: qname -> relations, typed attributes and parameters referring to it
+        self.index_referrers = {}
+        self.unresolved = []
+        self.validator = Validator()
 
         # The following are for convenience
         # All the elements are already in children,
@@ -914,6 +1128,25 @@ class SofaRoot:
         self.domains = Domains([])
         self.capabilities = Capabilities([])
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for index in self._INDEXES:
+            del state[index]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for index in self._INDEXES:
+            setattr(self, index, {})
+        # The indexes make no garbage, while collections would go through all the objects just loaded.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._index(by_name=False)
+            self._bind_references()
+        finally:
+            if collecting: gc.enable()
+
     def add_children(self, children):
         """
         Sets the children.
@@ -930,6 +1163,38 @@ class SofaRoot:
         group = self._find_group(group_type)
         group.elems.append(child)
         self._index_child(child)
+        self._rebind_referrers(child)
+
+    def remove_child(self, child, group_type):
+        """
+        Removes a child from the group. Triggers re-indexing.
+        """
+        group = self._find_group(group_type)
+        group.elems.remove(child)
+        self._unindex_child(child)
+        self._rebind_referrers(child)
+
+    def _rebind_referrers(self, child):
+        if not is_named(child): return
+        # The unresolved references of the child and of its referrers are recorded again, and 
+        # removed children have none.
+        owned = set(map(lambda obj: getattr(obj, "id", None), _members(child)))
+        referrers = [] if isinstance(child, Relation) else self.get_referrers(child.get_qname())
+        referrers = [r for r in referrers if r.id not in owned]
+        rebound = set(map(lambda r: r.id, referrers))
+        self.unresolved = [u for u in self.unresolved if not self._is_rebound(u, owned, rebound)]
+        if isinstance(child, ArchElement) and child.id in self.index_id:
+            self._bind_element(child, self._profiles())
+        for referrer in referrers:
+            if isinstance(referrer, Relation):
+                self._bind_relation(referrer)
+            else:
+                referrer.type_ref = self._bind_type(referrer, referrer.type)
+
+    def _is_rebound(self, unresolved, owned, rebound):
+        referrer_id = getattr(unresolved.referrer, "id", None)
+        if referrer_id is None: return False
+        return referrer_id in owned or (referrer_id in rebound and unresolved.kind in ("Source", "Target", "Type"))
     
     def merge(self, other):
         """
@@ -955,11 +1220,27 @@ class SofaRoot:
 
         self.add_children(other.children)
 
-    def _index_child(self, child):
+    def _index_child(self, child, by_name = True):
         if hasattr(child, 'id'):
             self.index_id[child.id] = child
-        if isinstance(child, Named):
+        if by_name and is_named(child):
             self.index_name[child.get_qname()] = child
+        if isinstance(child, Relation):
+            for endpoint in (child.source, child.target):
+                self.index_referrers.setdefault(endpoint.name, {})[child.id] = child
+        for typed in _typed_members(child):
+            self.index_referrers.setdefault(typed.type, {})[typed.id] = typed
+
+    def _unindex_child(self, child):
+        if hasattr(child, 'id'):
+            self.index_id.pop(child.id, None)
+        if is_named(child) and self.index_name.get(child.get_qname(), None) is child:
+            self.index_name.pop(child.get_qname())
+        if isinstance(child, Relation):
+            for endpoint in (child.source, child.target):
+                self.index_referrers.get(endpoint.name, {}).pop(child.id, None)
+        for typed in _typed_members(child):
+            self.index_referrers.get(typed.type, {}).pop(typed.id, None)
 
     def _elaborate(self):
         self._create_intermediate_packages()
@@ -967,6 +1248,54 @@ class SofaRoot:
     def _link(self): 
         # Now link parent packages to all elems
         self._link_packages()
+        # Resolve the references by name once, so that 
+        # the consumers can use the bound elements directly.
+        self._bind_references()
+
+    def _bind_references(self):
+        # Linking happens after every import as well, at which point the model is 
+        # not complete. Therefore, unresolved references are only recorded here, 
+        # they are reported by the validator or the consumers.
+        self.unresolved = []
+        profiles = self._profiles()
+        for elem in self.model_elements():
+            if isinstance(elem, ArchElement):
+                self._bind_element(elem, profiles)
+
+    def _profiles(self):
+        return dict(map(lambda p: (p.get_name(), p), self.stereotype_profiles))
+
+    def _bind_element(self, elem, profiles):
+        if isinstance(elem, Relation):
+            self._bind_relation(elem)
+        self._bind_stereotypes(elem, profiles)
+        for attr in elem.attributes() or []:
+            attr.type_ref = self._bind_type(attr, attr.type)
+            self._bind_stereotypes(attr, profiles)
+        for op in elem.operations() or []:
+            self._bind_stereotypes(op, profiles)
+            for param in op.parameters:
+                param.type_ref = self._bind_type(param, param.type)
+                self._bind_stereotypes(param, profiles)
+
+    def _bind_relation(self, relation):
+        for endpoint, kind in ((relation.source, "Source"), (relation.target, "Target")):
+            endpoint.ref = self.get_by_qname(endpoint.name)
+            if endpoint.ref is None:
+                self.unresolved.append(UnresolvedReference(relation, endpoint.name, kind))
+
+    def _bind_type(self, referrer, type_name):
+        if type_name is None: return None
+        type_ref = self.get_by_qname(type_name)
+        if type_ref is None:
+            self.unresolved.append(UnresolvedReference(referrer, type_name, "Type"))
+        return type_ref
+
+    def _bind_stereotypes(self, obj, profiles):
+        for stereo in obj.stereotypes() or []:
+            stereo.profile_ref = profiles.get(stereo.profile, None)
+            if stereo.profile_ref is None or stereo.name not in stereo.profile_ref.stereotypes:
+                self.unresolved.append(UnresolvedReference(obj, f"{stereo.profile}.{stereo.name}", "Stereotype"))
 
     def _link_packages(self):
         for elem in self.model_elements():
@@ -1008,9 +1337,9 @@ class SofaRoot:
             for elem in child.elems:
                 yield elem
 
-    def _index(self):
+    def _index(self, by_name = True):
         for elem in self.model_elements():
-            self._index_child(elem)
+            self._index_child(elem, by_name)
 
     def _find_group(self, group_type):
         for i in self.children:
@@ -1029,12 +1358,47 @@ class SofaRoot:
         Returns the element by fully qualified name.
         """
         return self.index_name.get(qname, None)
+
+    def get_referrers(self, qname):
+        """
+        Returns the relations, typed attributes and parameters that refer to the element with 
+        the given fully qualified name.
+        """
+        return list(self.index_referrers.get(qname, {}).values())
         
-    def validate(self):
+    def diff(self, old_root):
         """
-        Validates the model.
+        Returns the changes from the old model to this one, matching the elements by fully 
+        qualified name. Added and modified elements are those of this model, removed elements 
+        are those of the old model.
         """
-        Validator().validate(self)
+        old_elems = {}
+        for elem in old_root.model_elements():
+            if isinstance(elem, ArchElement):
+                old_elems[elem.get_qname()] = elem
+
+        change_set = ChangeSet()
+        seen = set()
+        for elem in self.model_elements():
+            if not isinstance(elem, ArchElement) or elem.id in seen: continue
+            seen.add(elem.id)
+            old_elem = old_elems.pop(elem.get_qname(), None)
+            if old_elem is None:
+                change_set.added.append(elem)
+            elif not elem.is_same(old_elem):
+                change_set.modified.append(elem)
+        change_set.removed.extend(old_elems.values())
+        return change_set
+
+    def validate(self, change_set: ChangeSet = None):
+        """
+        Validates the model. If a change set is given, only the parts of the model 
+        affected by the change set are validated again.
+        """
+        if change_set is None:
+            self.validator.validate(self)
+        else:
+            self.validator.validate_changes(self, change_set)
 
     def visit(self, context, visitor: Visitor):
         """
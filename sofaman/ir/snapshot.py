@@ -0,0 +1,398 @@
+"""
+Binary snapshot of the sofa model, which is memory-mapped and decoded lazily when read, so that
+the model built once can be handed to several generation jobs cheaply.
+
+The snapshot consists of a header (magic, version and the offset and length of each section),
+followed by the sections, all little-endian:
+
+* strings: the number of strings, the offsets of the strings (and of the end of the last one)
+  in the data that follows, and the data in UTF-8. Each string is stored once.
+* groups: the first and last element rows of each group of the root (see ``GROUPS``).
+* elements: a row per element (see ``ELEMENT_ROW``), in the order of visiting.
+* relations: a row per relation (see ``RELATION_ROW``), in the order of the relations group.
+* qnames, ids: the element rows sorted by qualified name and by ID, for binary search.
+"""
+import bisect
+import json
+import mmap
+import struct
+from sofaman.ir.model import (ArchElement, Struct, KeyValue, Diagram, Package, StereoTypeProfile, Domain,
+                              Capability, Actor, Primitive, Interface, Class, Component, Relation,
+                              RelationType, Port, Attribute, Parameter, EndPoint, SofaRoot, model_class)
+
+MAGIC = b"SOFASNAP"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<QQ")
+SECTIONS = ("strings", "groups", "elements", "relations", "qnames", "ids")
+
+# Group of the root -> element class, in the order of visiting
+GROUPS = {
+    "diagrams": Diagram,
+    "packages": Package,
+    "stereotype_profiles": StereoTypeProfile,
+    "domains": Domain,
+    "capabilities": Capability,
+    "actors": Actor,
+    "primitives": Primitive,
+    "interfaces": Interface,
+    "classes": Class,
+    "components": Component,
+    "relations": Relation,
+}
+_CLASSES = list(GROUPS.values())
+RELATION_TYPES = list(RelationType)
+
+# Group, ID, name, qualified name, parent package row, data (as JSON)
+ELEMENT_ROW = struct.Struct("<BxxxIIIiI")
+# Element row, type, then name, port and element row of the source and of the target
+RELATION_ROW = struct.Struct("<IBxxxIIiIIi")
+GROUP_ROW = struct.Struct("<II")
+INDEX_ROW = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+# No string, no element
+NONE = 0xFFFFFFFF
+NO_ROW = -1
+
+class _StringTable:
+    """
+    Strings of the snapshot being written, each stored once.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.data = bytearray()
+        self.offsets = [0]
+
+    def add(self, value):
+        if value is None: return NONE
+        index = self.index.get(value)
+        if index is None:
+            index = self.index[value] = len(self.offsets) - 1
+            self.data += value.encode("utf-8")
+            self.offsets.append(len(self.data))
+        return index
+
+    def to_bytes(self):
+        count = len(self.offsets) - 1
+        offsets = b"".join(OFFSET.pack(offset) for offset in self.offsets)
+        return INDEX_ROW.pack(count) + offsets + bytes(self.data)
+
+class _Pending:
+    """
+    Link to an element of the snapshot that is not decoded yet, by row or by qualified name.
+    """
+    __slots__ = ("snapshot", "row", "qname")
+
+    def __init__(self, snapshot, row = NO_ROW, qname = None):
+        self.snapshot = snapshot
+        self.row = row
+        self.qname = qname
+
+    def resolve(self):
+        if self.qname is not None: return self.snapshot.get_by_qname(self.qname)
+        return self.snapshot._element(self.row)
+
+class _Link:
+    """
+    Attribute linking an object to an element of the snapshot, decoded when the attribute is first read.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner = None):
+        if obj is None: return self
+        value = obj.__dict__.get(self.name)
+        if type(value) is _Pending:
+            value = obj.__dict__[self.name] = value.resolve()
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+def _linked(clazz, *links):
+    # Same name as the class of the model, which generators may write (e.g. the base of stereotypes in XMI)
+    return type(clazz.__name__, (clazz,), {"__module__": __name__, "model_class": clazz,
+                                           **{link: _Link() for link in links}})
+
+# Class of the model -> class decoded from the snapshot
+_LINKED = {clazz: _linked(clazz, "parent_package") for clazz in GROUPS.values() if issubclass(clazz, ArchElement)}
+_LINKED.update({clazz: _linked(clazz, link) for clazz, link in ((EndPoint, "ref"), (Attribute, "type_ref"),
+                                                                 (Parameter, "type_ref"))})
+
+def _data(elem):
+    # What is needed to rebuild the element, other than its names and links
+    if isinstance(elem, Diagram):
+        return elem.diagram.value if isinstance(elem.diagram, KeyValue) else None
+    if isinstance(elem, StereoTypeProfile):
+        return elem.stereotypes
+    return [elem.struct.inheritance, elem.struct.properties]
+
+def _name(elem):
+    if isinstance(elem, ArchElement): return elem.struct.name
+    return elem.get_name()
+
+def write_snapshot(sofa_root, snapshot_file):
+    """
+    Writes the snapshot of the given model to the file (see ``SnapshotRoot`` to read it).
+    """
+    strings = _StringTable()
+    elems = []
+    groups = bytearray()
+    for group in GROUPS:
+        start = len(elems)
+        elems.extend(getattr(sofa_root, group))
+        groups += GROUP_ROW.pack(start, len(elems))
+    # Diagrams have no ID, so rows are found by identity.
+    rows = {id(elem): row for row, elem in enumerate(elems)}
+    row_of = lambda elem: rows.get(id(elem), NO_ROW) if elem is not None else NO_ROW
+
+    elements = bytearray()
+    relations = bytearray()
+    qnames = {}
+    ids = {}
+    group_codes = {clazz: code for code, clazz in enumerate(GROUPS.values())}
+    for row, elem in enumerate(elems):
+        elem_id = getattr(elem, "id", None)
+        qname = elem.get_qname()
+        parent = row_of(elem.parent_package) if isinstance(elem, ArchElement) else NO_ROW
+        data = json.dumps(_data(elem), ensure_ascii=False, separators=(",", ":"))
+        elements += ELEMENT_ROW.pack(group_codes[model_class(elem)], strings.add(elem_id), strings.add(_name(elem)),
+                                     strings.add(qname), parent, strings.add(data))
+        # The last element of a name wins, as in the index of the root.
+        qnames[qname] = row
+        if elem_id is not None: ids[elem_id] = row
+        if isinstance(elem, Relation):
+            ends = []
+            for endpoint in (elem.source, elem.target):
+                port = endpoint.port.get_name() if endpoint.port else None
+                ends.extend((strings.add(endpoint.name), strings.add(port), row_of(endpoint.ref)))
+            relations += RELATION_ROW.pack(row, RELATION_TYPES.index(elem.type), *ends)
+
+    sort = lambda index: b"".join(INDEX_ROW.pack(index[key]) for key in sorted(index, key=lambda k: k.encode("utf-8")))
+    sections = [strings.to_bytes(), groups, elements, relations, sort(qnames), sort(ids)]
+
+    with open(snapshot_file, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(sections)))
+        offset = HEADER.size + SECTION.size * len(sections)
+        for section in sections:
+            f.write(SECTION.pack(offset, len(section)))
+            offset += len(section)
+        for section in sections:
+            f.write(section)
+
+class _Group:
+    """
+    Elements of a group of the snapshot, decoded when accessed.
+    """
+
+    def __init__(self, snapshot, start, end):
+        self.snapshot = snapshot
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.snapshot._element(self.start + i) for i in range(*index.indices(len(self)))]
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self): raise IndexError(index)
+        return self.snapshot._element(self.start + index)
+
+    def __iter__(self):
+        for row in range(self.start, self.end):
+            yield self.snapshot._element(row)
+
+class _Index:
+    """
+    Sorted index of the snapshot, as a sequence of the keys of the rows (for ``bisect``).
+    """
+
+    def __init__(self, snapshot, section, field):
+        self.snapshot = snapshot
+        self.offset, length = section
+        self.length = length // INDEX_ROW.size
+        self.field = field
+
+    def row(self, index):
+        return INDEX_ROW.unpack_from(self.snapshot._map, self.offset + index * INDEX_ROW.size)[0]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.snapshot._string_bytes(self.snapshot._row(self.row(index))[self.field])
+
+    def find(self, key):
+        key = key.encode("utf-8")
+        index = bisect.bisect_left(self, key)
+        if index < self.length and self[index] == key: return self.row(index)
+        return None
+
+class SnapshotRoot:
+    """
+    Model read from a snapshot (see ``write_snapshot``). The file is memory-mapped, so opening it
+    only reads the header, and the elements are decoded when they are accessed, by ``get_by_id``,
+    ``get_by_qname``, the groups (such as ``classes``) or ``model_elements``. Decoded elements are
+    kept, and linked as in the root: to their parent package, the relations to their source and
+    target, the attributes and parameters to their type, and the stereotypes to their profile. The
+    linked elements (but the profiles) are decoded when the link is first read, so decoding an
+    element does not decode the elements it leads to.
+
+    It can be visited in place of the root (see ``SofaRoot.visit``). The model is expected to be
+    validated before the snapshot is written. Use it as a context manager, or ``close`` it.
+    """
+
+    def __init__(self, snapshot_file):
+        self.snapshot_file = snapshot_file
+        with open(snapshot_file, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise AssertionError(f"{snapshot_file} is not a snapshot of version {VERSION}")
+        self._sections = {}
+        for index, name in enumerate(SECTIONS[:count]):
+            self._sections[name] = SECTION.unpack_from(self._map, HEADER.size + index * SECTION.size)
+
+        strings, _ = self._sections["strings"]
+        self._string_count = INDEX_ROW.unpack_from(self._map, strings)[0]
+        self._string_offsets = strings + INDEX_ROW.size
+        self._string_data = self._string_offsets + (self._string_count + 1) * OFFSET.size
+        self._elements, _ = self._sections["elements"]
+        self._relations, _ = self._sections["relations"]
+
+        groups, _ = self._sections["groups"]
+        for index, group in enumerate(GROUPS):
+            start, end = GROUP_ROW.unpack_from(self._map, groups + index * GROUP_ROW.size)
+            setattr(self, group, _Group(self, start, end))
+        self._relation_start = self.relations.start
+        self._qnames = _Index(self, self._sections["qnames"], 3)
+        self._ids = _Index(self, self._sections["ids"], 1)
+        # Row -> decoded element
+        self._decoded = {}
+        # Qualified name -> row (or None), of the names looked up
+        self._qname_rows = {}
+        self._profiles = None
+
+    def _string_bytes(self, index):
+        if index == NONE: return None
+        start, end = struct.unpack_from("<QQ", self._map, self._string_offsets + index * OFFSET.size)
+        return self._map[self._string_data + start:self._string_data + end]
+
+    def _string(self, index):
+        value = self._string_bytes(index)
+        return value.decode("utf-8") if value is not None else None
+
+    def _row(self, row):
+        return ELEMENT_ROW.unpack_from(self._map, self._elements + row * ELEMENT_ROW.size)
+
+    def _element(self, row):
+        elem = self._decoded.get(row)
+        if elem is not None or row == NO_ROW: return elem
+
+        group, id, name, _, parent, data = self._row(row)
+        clazz = _LINKED.get(_CLASSES[group], _CLASSES[group])
+        data = json.loads(self._string(data))
+        name = self._string(name)
+        if clazz is Diagram:
+            self._decoded[row] = elem = Diagram(KeyValue(name, data) if data is not None else name)
+            return elem
+        if clazz is StereoTypeProfile:
+            elem = StereoTypeProfile(name, data)
+        elif clazz is _LINKED[Relation]:
+            offset = self._relations + (row - self._relation_start) * RELATION_ROW.size
+            _, type, source_name, source_port, source_ref, target_name, target_port, target_ref = \
+                RELATION_ROW.unpack_from(self._map, offset)
+            elem = Relation(RELATION_TYPES[type], self._string(source_name), self._port(source_port),
+                            self._string(target_name), self._port(target_port), Struct(name, *data))
+        else:
+            elem = clazz(Struct(name, *data))
+        elem.id = self._string(id)
+        # Kept before it is linked, as the links may lead back to it.
+        self._decoded[row] = elem
+        if clazz is StereoTypeProfile: return elem
+        elem.parent_package = self._link(parent)
+        if clazz is _LINKED[Relation]:
+            for endpoint, ref in ((elem.source, source_ref), (elem.target, target_ref)):
+                endpoint.__class__ = _LINKED[EndPoint]
+                endpoint.ref = self._link(ref)
+        self._bind_references(elem)
+        return elem
+
+    def _link(self, row):
+        # Decoded when read, so that decoding an element does not decode all the elements it leads to
+        if row == NO_ROW: return None
+        return self._decoded.get(row) or _Pending(self, row)
+
+    def _port(self, index):
+        return Port(self._string(index)) if index != NONE else None
+
+    def _bind_references(self, elem):
+        self._bind_stereotypes(elem)
+        for attr in elem.attributes() or []:
+            self._bind_type(attr)
+            self._bind_stereotypes(attr)
+        for op in elem.operations() or []:
+            self._bind_stereotypes(op)
+            for param in op.parameters:
+                self._bind_type(param)
+                self._bind_stereotypes(param)
+
+    def _bind_type(self, obj):
+        obj.__class__ = _LINKED[type(obj)]
+        obj.type_ref = _Pending(self, qname=obj.type) if obj.type is not None else None
+
+    def _bind_stereotypes(self, obj):
+        stereotypes = obj.stereotypes()
+        if not stereotypes: return
+        if self._profiles is None:
+            self._profiles = {profile.get_name(): profile for profile in self.stereotype_profiles}
+        for stereo in stereotypes:
+            stereo.profile_ref = self._profiles.get(stereo.profile, None)
+
+    def __len__(self):
+        return self.relations.end
+
+    def get_by_id(self, id):
+        """
+        Returns the element by id.
+        """
+        row = self._ids.find(id)
+        if row is None: raise KeyError(id)
+        return self._element(row)
+
+    def get_by_qname(self, qname):
+        """
+        Returns the element by fully qualified name.
+        """
+        # Types and packages are looked up again and again.
+        row = self._qname_rows.get(qname, NONE)
+        if row == NONE: row = self._qname_rows[qname] = self._qnames.find(qname)
+        return self._element(row) if row is not None else None
+
+    def model_elements(self):
+        """
+        Returns all the model elements, in the order of visiting.
+        """
+        for row in range(len(self)):
+            yield self._element(row)
+
+    # Visits the groups, as the root does.
+    visit = SofaRoot.visit
+
+    def close(self):
+        """
+        Releases the mapping of the file. Decoded elements remain usable, but their links that were
+        not read yet can no longer be decoded.
+        """
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
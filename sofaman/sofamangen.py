@@ -3,14 +3,36 @@ CLI for generating architectural diagram/model files from a given Sofa model fil
 """
 
 import json
+import os
 import sys
+from contextlib import ExitStack
 
 import click
 
 from sofaman.sofa import Sofa
+from sofaman.ir.model import ValidationError
+from sofaman.generator.generator import FanOutVisitor, FileContext, OutputManifest
 from sofaman.generator.uml2 import XmiVisitor, XmiContext, XmiFlavor
-from sofaman.generator.plantuml import PumlVisitor, PumlContext
-from sofaman.tools.export.id_export import IdExporter
+from sofaman.generator.uml2_stream import XmiStreamVisitor
+from sofaman.generator.uml2_parallel import XmiParallelVisitor
+from sofaman.generator.uml2_shard import XmiShardVisitor
+from sofaman.generator.uml2_cache import XmiCachedVisitor
+from sofaman.generator.plantuml import PumlVisitor, PumlDiagramVisitor, PumlContext
+from sofaman.generator.plantuml_split import PumlSplitVisitor
+from sofaman.generator.plantuml_template import PumlTemplateVisitor
+from sofaman.generator.ndjson import NdjsonVisitor
+from sofaman.tools.export.id_export import IdExporter, BackgroundIds, IdExtractionError
+from sofaman.tools.export.id_store import read_ids
+
+XMI_ENGINES = {
+    "dom": XmiVisitor,
+    "stream": XmiStreamVisitor,
+    "parallel": XmiParallelVisitor,
+    "shard": XmiShardVisitor,
+    "cached": XmiCachedVisitor
+}
+
+OUTPUT_TYPES = ["xmi", "puml", "json"]
 
 class SofaException(Exception): 
     """
@@ -27,46 +49,145 @@ def main():
     ...
 
 @main.command()
-@click.option('--type', default="xmi", help='The type of the output file (possible values: xmi, puml)')
-@click.option('--ids_file', help='The id file to use')
+@click.option('--type', multiple=True, default=["xmi"], 
+              help='The type of the output file (possible values: xmi, puml, json). Repeat it for several outputs')
+@click.option('--ids_file', help='The id file to use, JSON or a SQLite database written by export')
+@click.option('--ids_from_xmi', type=click.Path(exists=True), 
+              help='An XMI file to take the IDs from, as export does, extracted while the model is parsed')
+@click.option('--write_ids', is_flag=True, 
+              help='Also writes the IDs of the packaged XMI elements to <output>.ids.json, in the format of export, '
+                   'to be used as --ids_file by the next generation')
+@click.option('--xmi_engine', default="dom", type=click.Choice(list(XMI_ENGINES.keys())), 
+              help='How XMI is generated: "dom" builds the whole document in memory, "stream" writes it incrementally, '
+                   '"parallel" writes it incrementally and builds the top-level packages in parallel, '
+                   '"shard" writes one file per package next to the output file, which refers to them, '
+                   '"cached" writes it incrementally and reuses the XMI of unchanged elements from <output>.cache')
+@click.option('--compact', is_flag=True, help='Writes XMI without indentation')
+@click.option('--gzip', 'compress', is_flag=True, help='Compresses the XMI output with gzip')
+@click.option('--threads', is_flag=True, help='Generates several outputs in separate threads')
+@click.option('--diagrams', is_flag=True, 
+              help='Also writes a PlantUML file per declared diagram, <output>.<diagram>.puml, with its members only')
+@click.option('--max_nodes', type=int, 
+              help='Splits PlantUML output into parts of at most this many nodes, <output>.part<n>.puml, '
+                   'and writes an index of the parts to the output file')
+@click.option('--max_edges', type=int, help='Splits PlantUML output into parts of at most this many edges')
+@click.option('--bundle', type=click.Choice(list(PumlVisitor.BUNDLE_LABELS)), 
+              help='Draws the PlantUML relations of a type between two elements as one edge, labeled with their '
+                   'count or names, and opposite associations and flows as one bidirectional edge')
+@click.option('--puml_templates', type=click.Path(exists=True), 
+              help='A JSON file of PlantUML templates by kind (header, footer, class, relation, ...), e.g. to add skinparams')
+@click.option('--no_manifest', is_flag=True, 
+              help=f'Always rewrites the output files; by default, files whose content did not change are left '
+                   f'untouched, using the hashes in {OutputManifest.FILE_NAME} next to them')
 @click.argument('input', type=click.Path(exists=True))
-@click.argument('output', type=click.Path())
-def generate(input, output, type, ids_file=None):
+@click.argument('output', type=click.Path(), nargs=-1, required=True)
+def generate(input, output, type, ids_file=None, ids_from_xmi=None, write_ids=False, xmi_engine="dom", compact=False, compress=False, threads=False, 
+             diagrams=False, max_nodes=None, max_edges=None, bundle=None, puml_templates=None, no_manifest=False):
     """
-    Generates architectural diagram/model files from a given Sofa model file. Supports XMI and PlantUML.
+    Generates architectural diagram/model files from a given Sofa model file. Supports XMI, PlantUML, 
+    and the whole model as newline-delimited JSON (json).
+    Several outputs are generated from a single build of the model, e.g. 
+    ``--type xmi --type puml model.xmi model.puml``.
 
     \b
     Arguments:
         input    The input Sofa model file.
-        output   The output file to be generated.
+        output   The output file(s) to be generated, one per type.
     """
     try: 
-        _build(input, output, type, ids_file)
+        _build(input, output, type, ids_file, ids_from_xmi, write_ids, xmi_engine, compact, compress, threads, diagrams, (max_nodes, max_edges), 
+               bundle, puml_templates, not no_manifest)
     except SofaException as e:
         print(f"Error: {e}")
         sys.exit(1)
 
-def _build(input, output, type, ids_file=None):
+def _build(input, outputs, types, ids_file=None, ids_from_xmi=None, write_ids=False, xmi_engine="dom", compact=False, compress=False, threads=False, 
+           diagrams=False, budget=(None, None), bundle=None, templates_file=None, manifest=True):
     """
     Builds the architectural diagram/model files from a given Sofa model file.
     """
-    context = None
-    visitor = None
-    match type:
-        case "xmi":
-            context = XmiContext(output, mode=XmiFlavor.SPARX_EA)
-            visitor = XmiVisitor()
-        case "puml":
-            context = PumlContext(output)
-            visitor = PumlVisitor()
-        case _:
+    for type in types:
+        if type not in OUTPUT_TYPES:
             raise SofaException(f"Unknown type {type}")
-    
+    if len(outputs) != len(types):
+        raise SofaException(f"Expected one output per type, got {len(types)} type(s) and {len(outputs)} output(s)")
+    if diagrams and budget != (None, None):
+        raise SofaException("Diagrams cannot be split into parts")
+    if templates_file and (diagrams or budget != (None, None)):
+        raise SofaException("Templates apply to single PlantUML diagrams only")
+    if ids_file and ids_from_xmi:
+        raise SofaException("IDs are taken either from an ID file or from an XMI file")
+    if ids_from_xmi and "xmi" not in types:
+        raise SofaException("IDs from an XMI file apply to XMI outputs only")
+
+    try:
+        _build_targets(input, outputs, types, ids_file, ids_from_xmi, write_ids, xmi_engine, compact, compress, threads, 
+                       diagrams, budget, bundle, templates_file, manifest)
+    except (IdExtractionError, ValidationError) as e:
+        raise SofaException(str(e))
+
+def _build_targets(input, outputs, types, ids_file, ids_from_xmi, write_ids, xmi_engine, compact, compress, threads, 
+                   diagrams, budget, bundle, templates_file, manifest):
+    """
+    Builds the outputs, once the options are checked (see ``_build``).
+    """
+    ids = None
     if ids_file:
-        with open(ids_file, 'r') as f:
-            context.ids = json.load(f)
+        ids = read_ids(ids_file)
+    elif ids_from_xmi:
+        # Extracted while the model is parsed, and waited for by the XMI visitors (see XmiVisitor.visit_root).
+        ids = BackgroundIds(ids_from_xmi)
+        if any(_same_file(ids_from_xmi, output) for output in outputs):
+            # The output is written over, so the IDs are needed before.
+            ids.result()
 
-    Sofa().build(input, context, visitor)
+    templates = None
+    if templates_file:
+        with open(templates_file, 'r') as f:
+            templates = json.load(f)
+
+    with ExitStack() as stack:
+        targets = []
+        # Manifest file -> manifest, saved after the contexts are closed
+        manifests = {}
+        for output, type in zip(outputs, types):
+            output_manifest = None
+            if manifest:
+                output_manifest = OutputManifest.next_to(output)
+                output_manifest = manifests.setdefault(output_manifest.manifest_file, output_manifest)
+                stack.enter_context(output_manifest)
+            context, visitor = _target(output, type, xmi_engine, compact, compress, diagrams, budget, bundle, templates, 
+                                       output_manifest)
+            stack.enter_context(context)
+            if ids is not None: context.ids = ids
+            if write_ids and type == "xmi": context.ids_out_file = f"{output}.ids.json"
+            targets.append((context, visitor))
+
+        if len(targets) == 1:
+            Sofa().build(input, *targets[0])
+        else:
+            Sofa().build(input, None, FanOutVisitor(targets, threads))
+
+def _same_file(path, other):
+    return os.path.exists(other) and os.path.samefile(path, other)
+
+def _target(output, type, xmi_engine, compact, compress, diagrams, budget, bundle, templates, manifest):
+    """
+    Creates the context and the visitor for the given output type.
+    """
+    match type:
+        case "xmi":
+            return (XmiContext(output, mode=XmiFlavor.SPARX_EA, pretty_print=not compact, compress=compress, manifest=manifest), 
+                    XMI_ENGINES[xmi_engine]())
+        case "puml":
+            context = PumlContext(output, manifest=manifest)
+            if diagrams: return context, PumlDiagramVisitor(bundle_relations=bundle)
+            max_nodes, max_edges = budget
+            if max_nodes or max_edges: return context, PumlSplitVisitor(max_nodes, max_edges, bundle_relations=bundle)
+            if templates: return context, PumlTemplateVisitor(templates, bundle_relations=bundle)
+            return context, PumlVisitor(bundle_relations=bundle)
+        case "json":
+            return FileContext(output, manifest=manifest), NdjsonVisitor()
 
 @main.command()
 @click.argument('input', type=click.Path(exists=True))
@@ -74,11 +195,13 @@ def _build(input, output, type, ids_file=None):
 def export(input, output):
     """
     Extracts IDs from the given XMI file, mapped to fully qualified names of XMI elements.
+    The IDs are written as JSON, or to a SQLite database if the output file name ends with 
+    .db, .sqlite or .sqlite3, which is looked up on demand when used as --ids_file.
 
     \b
     Arguments:
         input    The input XMI file.
-        output   The output JSON file.
+        output   The output JSON file or SQLite database.
     """
     try: 
         _export(input, output)
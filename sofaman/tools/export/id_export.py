@@ -1,5 +1,7 @@
-import json
+import threading
+from collections.abc import Mapping
 from lxml import etree
+from sofaman.tools.export.id_store import write_ids
 
 NS_UML = "http://schema.omg.org/spec/UML/2.1"
 NS_XMI = "http://schema.omg.org/spec/XMI/2.1"
@@ -14,41 +16,102 @@ NS_MAP = {
 class IdExporter:
     """
     Extracts IDs from the given XMI input file, mapped to fully qualified names of XMI elements into a given JSON output file.
+    The qualified name of an element is made of the names of its named ancestors (other than the root) and its own.
     """
 
     def __init__(self, input):
         self.input_file = input
-        self.ids = self._extract_ids(self._read().getroot(), "", {})
+        self.ids = self._extract_ids()
 
-    def _read(self):
+    def _extract_ids(self):
         """
-        Reads the input file and returns a DOM.
+        Extracts IDs from the file incrementally. Elements are dropped once they are read, 
+        so that only their ancestors are kept in memory, however large and deep the file is.
         """
-        return etree.parse(self.input_file)
-        
-    def _extract_ids(self, elem, parent_name, ids):
-        """
-        Extracts IDs from the dom.
-        """
-        for child in elem:
-            name = child.get("name")
-            if name:
-                qname = name
-                if parent_name:
-                    qname = parent_name + "." + name
+        ids = {}
+        # Qualified names of the open elements; the root has none.
+        qnames = []
+        for event, elem in etree.iterparse(self.input_file, events=("start", "end"), huge_tree=True):
+            if event == "end":
+                qnames.pop()
+                elem.clear(keep_tail=True)
+                # Earlier siblings are done as well.
+                parent = elem.getparent()
+                if parent is not None:
+                    del parent[:parent.index(elem)]
+                continue
 
-                id = child.get(XMI+"id")
+            if not qnames:
+                qnames.append("")
+                continue
+            parent_name = qnames[-1]
+            name = elem.get("name")
+            if name:
+                qname = parent_name + "." + name if parent_name else name
+                id = elem.get(XMI+"id")
                 if id:
                     ids[qname] = id
             else:
                 qname = parent_name
-
-            self._extract_ids(child, qname, ids)
+            qnames.append(qname)
         return ids
 
     def export(self, output_file):
         """
-        Exports the IDs from the XMI file.
+        Exports the IDs from the XMI file, as JSON or as a SQLite database (see ``write_ids``).
         """
-        with open(output_file, 'w') as file:
-            json.dump(self.ids, file, indent=4)
+        write_ids(self.ids, output_file)
+
+class IdExtractionError(AssertionError):
+    """
+    Error of the extraction of the IDs of an XMI file.
+    """
+    ...
+
+class BackgroundIds(Mapping):
+    """
+    IDs of the given XMI file (see ``IdExporter``), extracted in a background thread, so that the
+    extraction overlaps with other work, e.g. parsing the Sofa model. Accessing the IDs waits until 
+    they are extracted, and raises ``IdExtractionError`` if the extraction failed. The IDs must be accessed
+    before forking, as the thread does not run in the forked processes (see ``XmiVisitor.visit_root``).
+    """
+
+    def __init__(self, input):
+        self.input_file = input
+        self._ids = None
+        self._error = None
+        self._thread = threading.Thread(target=self._extract, name="sofaman-ids", daemon=True)
+        self._thread.start()
+
+    def _extract(self):
+        try:
+            self._ids = IdExporter(self.input_file).ids
+        except BaseException as e:
+            self._error = e
+
+    def result(self):
+        """
+        Returns the IDs as a dict, waiting for them to be extracted.
+        """
+        if self._ids is None:
+            self._thread.join()
+            if self._error is not None:
+                raise IdExtractionError(f"Cannot extract the IDs of {self.input_file}: {self._error}") from self._error
+            if self._ids is None:
+                raise AssertionError(f"The IDs of {self.input_file} were not extracted before forking")
+        return self._ids
+
+    def get(self, qname, default = None):
+        return self.result().get(qname, default)
+
+    def __getitem__(self, qname):
+        return self.result()[qname]
+
+    def __contains__(self, qname):
+        return qname in self.result()
+
+    def __len__(self):
+        return len(self.result())
+
+    def __iter__(self):
+        return iter(self.result())
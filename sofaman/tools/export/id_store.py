@@ -0,0 +1,142 @@
+"""
+Stores of the ID maps (fully qualified name -> XMI ID), as JSON files or as SQLite databases.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import uuid
+from collections.abc import ItemsView, Mapping
+from sofaman.generator.generator import FileContext
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+# Rows inserted at a time
+BATCH_SIZE = 10_000
+
+class _SqliteItems(ItemsView):
+    """
+    Items of the SQLite ID map, read with a single query.
+    """
+
+    def __iter__(self):
+        yield from self._mapping._connection().execute("SELECT qname, id FROM ids ORDER BY rowid")
+
+class SqliteIds(Mapping):
+    """
+    ID map stored in a SQLite database, which is opened read-only and looked up on demand, so that
+    the map need not be loaded as a whole. The IDs are kept in the order they were written.
+
+    The database is opened again in forked processes (see ``fork_map``), as a connection must not
+    be shared with them. Threads share the connection.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._conn = None
+        self._pid = None
+        self._len = None
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            uri = f"{pathlib.Path(os.path.abspath(self.db_file)).as_uri()}?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, qname, default = None):
+        row = self._connection().execute("SELECT id FROM ids WHERE qname = ?", (qname,)).fetchone()
+        return row[0] if row is not None else default
+
+    def __getitem__(self, qname):
+        id = self.get(qname)
+        if id is None: raise KeyError(qname)
+        return id
+
+    def __contains__(self, qname):
+        return self.get(qname) is not None
+
+    def __len__(self):
+        # Checked for every element (e.g. ``if context.ids``), so counted once.
+        if self._len is None:
+            self._len = self._connection().execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+        return self._len
+
+    def __iter__(self):
+        for (qname,) in self._connection().execute("SELECT qname FROM ids ORDER BY rowid"):
+            yield qname
+
+    def items(self):
+        return _SqliteItems(self)
+
+    def digest(self):
+        """
+        Returns the SHA-256 hash of the database, which changes with the IDs.
+        """
+        with open(self.db_file, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+    def close(self):
+        """
+        Closes the connection of this process, if any.
+        """
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._pid = None
+
+def is_sqlite(ids_file):
+    """
+    Returns whether the given ID file is a SQLite database, by its content.
+    """
+    with open(ids_file, "rb") as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+def read_ids(ids_file):
+    """
+    Reads the ID map of the given file: a SQLite database (see ``SqliteIds``), or else a JSON file,
+    which is loaded as a whole.
+    """
+    if is_sqlite(ids_file):
+        return SqliteIds(ids_file)
+    with open(ids_file, "r") as f:
+        return json.load(f)
+
+def _write_sqlite(ids, db_file, manifest):
+    # Written to a new file, which then replaces the old one.
+    path = pathlib.PurePath(os.path.abspath(db_file))
+    tmp_file = str(path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp"))
+    try:
+        conn = sqlite3.connect(tmp_file)
+        try:
+            # A new file, so there is nothing to recover on failure.
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute("CREATE TABLE ids (qname TEXT PRIMARY KEY, id TEXT NOT NULL)")
+            items = iter(ids.items())
+            while True:
+                batch = [item for _, item in zip(range(BATCH_SIZE), items)]
+                if not batch: break
+                conn.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?)", batch)
+            conn.commit()
+        finally:
+            conn.close()
+        if manifest is None:
+            os.replace(tmp_file, db_file)
+        else:
+            manifest.replace(tmp_file, db_file)
+    finally:
+        if os.path.exists(tmp_file): os.remove(tmp_file)
+
+def write_ids(ids, ids_file, manifest = None):
+    """
+    Writes the ID map to the given file, as a SQLite database if the file name ends with one
+    of ``SQLITE_SUFFIXES``, or else as JSON. With a manifest (see ``OutputManifest``), the file 
+    is only replaced if its content changed.
+    """
+    if pathlib.PurePath(ids_file).suffix.lower() in SQLITE_SUFFIXES:
+        _write_sqlite(ids, ids_file, manifest)
+        return
+    with FileContext(ids_file, manifest) as file:
+        json.dump(ids if isinstance(ids, dict) else dict(ids.items()), file, indent=4)
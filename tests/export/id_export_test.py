@@ -1,9 +1,11 @@
 import pytest
-import os.path
+import os
+import sys
 import lark
 import tests.test_cases.test_variations as test_variations
 
-from sofaman.tools.export.id_export import IdExporter
+from lxml import etree
+from sofaman.tools.export.id_export import IdExporter, BackgroundIds, IdExtractionError, NS_UML, NS_XMI, XMI
 
 class TestExport:
 
@@ -24,3 +26,69 @@ class TestExport:
         """
         ids = exporter.ids
         assert ids["full_all.Retail.CRM.CustomerDB"] == "6ff575dd-e7ef-4df0-9956-f502a40835de"
+
+    def test_same_as_dom(self, exporter):
+        """
+        Test that the IDs are those of the whole DOM, in the order of the document.
+        """
+        root = etree.parse("tests/test_cases/full_all.xmi").getroot()
+        ids = {}
+        for elem in root.iterdescendants(tag=etree.Element):
+            names = [a.get("name") for a in reversed(list(elem.iterancestors())) if a is not root and a.get("name")]
+            if elem.get("name") and elem.get(XMI + "id"):
+                ids[".".join(names + [elem.get("name")])] = elem.get(XMI + "id")
+        assert list(exporter.ids.items()) == list(ids.items())
+
+    def test_deep_nesting(self, tmp_path):
+        """
+        Test the extraction from packages nested deeper than the recursion limit.
+        """
+        depth = sys.getrecursionlimit() + 100
+        xmi_file = tmp_path / "deep.xmi"
+        with open(xmi_file, "w") as f:
+            f.write(f'<xmi:XMI xmlns:xmi="{NS_XMI}" xmlns:uml="{NS_UML}">')
+            for i in range(depth):
+                f.write(f'<packagedElement xmi:id="id{i}" name="p{i}">')
+            f.write("</packagedElement>" * depth + "</xmi:XMI>")
+
+        ids = IdExporter(str(xmi_file)).ids
+        assert len(ids) == depth
+        assert ids[".".join(f"p{i}" for i in range(depth))] == f"id{depth - 1}"
+
+class TestBackgroundIds:
+
+    def test_same_as_export(self):
+        """
+        Test that the IDs extracted in the background are those of the exporter.
+        """
+        ids = BackgroundIds("tests/test_cases/full_all.xmi")
+        exported = IdExporter("tests/test_cases/full_all.xmi").ids
+        assert ids.get("full_all.Retail.CRM.CustomerDB") == "6ff575dd-e7ef-4df0-9956-f502a40835de"
+        assert "full_all" in ids and "missing" not in ids
+        assert len(ids) == len(exported)
+        assert list(ids.items()) == list(exported.items())
+
+    def test_error(self, tmp_path):
+        """
+        Test that the error of the extraction is raised when the IDs are accessed.
+        """
+        xmi_file = tmp_path / "invalid.xmi"
+        xmi_file.write_text("<xmi:XMI")
+        ids = BackgroundIds(str(xmi_file))
+        with pytest.raises(IdExtractionError, match="invalid.xmi") as info:
+            ids.get("A")
+        assert isinstance(info.value.__cause__, etree.XMLSyntaxError)
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork")
+    def test_fork(self):
+        """
+        Test that the IDs accessed before forking are available in forked processes, without the thread.
+        """
+        ids = BackgroundIds("tests/test_cases/full_all.xmi")
+        assert len(ids) > 0
+        assert not ids._thread.is_alive()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if ids.get("full_all") == "17ff2979-398e-4b16-a62a-4a52387b3b01" else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
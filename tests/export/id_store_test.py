@@ -0,0 +1,116 @@
+import json
+import os
+import pytest
+
+from sofaman.generator.generator import OutputManifest
+from sofaman.tools.export.id_export import IdExporter
+from sofaman.tools.export.id_store import SqliteIds, is_sqlite, read_ids, write_ids
+
+IDS = {"m": "1", "m.b": "2", "m.a": "3", "m.a.C": "4"}
+
+class TestIdStore:
+
+    @pytest.fixture
+    def db_file(self, tmp_path):
+        db_file = str(tmp_path / "ids.db")
+        write_ids(IDS, db_file)
+        return db_file
+
+    def test_json(self, tmp_path):
+        """
+        Test that other files than SQLite databases are written and read as JSON.
+        """
+        ids_file = str(tmp_path / "ids.json")
+        write_ids(IDS, ids_file)
+        with open(ids_file) as f:
+            assert json.load(f) == IDS
+        assert not is_sqlite(ids_file)
+        assert read_ids(ids_file) == IDS
+
+    def test_sqlite(self, db_file):
+        """
+        Test the lookups in the SQLite database.
+        """
+        assert is_sqlite(db_file)
+        ids = read_ids(db_file)
+        assert isinstance(ids, SqliteIds)
+        assert ids.get("m.a.C") == "4"
+        assert ids["m.b"] == "2"
+        assert ids.get("m.x") is None
+        assert "m.a" in ids and "m.x" not in ids
+        with pytest.raises(KeyError):
+            ids["m.x"]
+        assert len(ids) == len(IDS)
+        ids.close()
+
+    def test_sqlite_order(self, db_file):
+        """
+        Test that the IDs are read in the order they were written.
+        """
+        ids = read_ids(db_file)
+        assert list(ids) == list(IDS)
+        assert list(ids.items()) == list(IDS.items())
+        assert dict(ids) == IDS
+        ids.close()
+
+    def test_sqlite_rewrite(self, db_file):
+        """
+        Test that the database is replaced when written again, and that no other file is left.
+        """
+        write_ids({"n": "5"}, db_file)
+        ids = read_ids(db_file)
+        assert dict(ids.items()) == {"n": "5"}
+        assert os.listdir(os.path.dirname(db_file)) == ["ids.db"]
+        ids.close()
+
+    @pytest.mark.parametrize("name", ["ids.json", "ids.db"])
+    def test_manifest(self, tmp_path, name):
+        """
+        Test that a file recorded in the manifest is only replaced when the IDs change.
+        """
+        ids_file = str(tmp_path / name)
+        def write(ids):
+            with OutputManifest.next_to(ids_file) as manifest:
+                write_ids(ids, ids_file, manifest)
+            return os.stat(ids_file).st_mtime_ns
+
+        write(IDS)
+        os.utime(ids_file, ns=(1, 1))
+        assert write(IDS) == 1
+        assert write(IDS | {"n": "5"}) != 1
+        assert dict(read_ids(ids_file).items()) == IDS | {"n": "5"}
+        assert sorted(os.listdir(tmp_path)) == [name, OutputManifest.FILE_NAME]
+
+    def test_sqlite_digest(self, db_file, tmp_path):
+        """
+        Test that the digest changes with the IDs.
+        """
+        other_file = str(tmp_path / "other.db")
+        write_ids(IDS | {"n": "5"}, other_file)
+        assert SqliteIds(db_file).digest() != SqliteIds(other_file).digest()
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork")
+    def test_sqlite_fork(self, db_file):
+        """
+        Test that forked processes open the database again.
+        """
+        ids = read_ids(db_file)
+        assert ids["m"] == "1"
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if ids["m.a.C"] == "4" and ids._conn is not None else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert ids["m.b"] == "2"
+        ids.close()
+
+    def test_export_sqlite(self, tmp_path):
+        """
+        Test that the exported database has the same IDs as the exporter.
+        """
+        exporter = IdExporter("tests/test_cases/full_all.xmi")
+        db_file = str(tmp_path / "ids.sqlite")
+        exporter.export(db_file)
+        ids = read_ids(db_file)
+        assert list(ids.items()) == list(exporter.ids.items())
+        ids.close()
@@ -0,0 +1,174 @@
+import pytest
+
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from sofaman.generator.generator import FileContext, BufferContext, BytesBufferContext, FanOutVisitor, OutputManifest, fork_map
+from sofaman.generator.plantuml import PumlVisitor
+from sofaman.generator.uml2 import XmiVisitor, XmiBufferContext
+from sofaman.generator.uml2_parallel import XmiParallelVisitor
+from sofaman.sofa import Sofa
+
+class TestFileContext:
+
+    def test_write_and_close(self, tmp_path):
+        out_file = tmp_path / "out.txt"
+        out_file.write_text("old content")
+        context = FileContext(str(out_file))
+        assert out_file.read_text() == ""
+        context.write("a")
+        context.write_ln("b")
+        context.close()
+        assert out_file.read_text() == "ab\n"
+        # Closing twice is harmless
+        context.close()
+
+    def test_context_manager(self, tmp_path):
+        out_file = tmp_path / "out.txt"
+        with FileContext(str(out_file)) as context:
+            context.write_ln("a")
+        assert out_file.read_text() == "a\n"
+        assert context.name() == "out"
+
+class TestOutputManifest:
+
+    def _write(self, out_file, content):
+        with OutputManifest.next_to(out_file) as manifest:
+            with FileContext(str(out_file), manifest) as context:
+                context.write(content)
+        return context
+
+    def _manifest(self, tmp_path):
+        return json.loads((tmp_path / OutputManifest.FILE_NAME).read_text())["files"]
+
+    def test_unchanged(self, tmp_path):
+        out_file = tmp_path / "out.txt"
+        assert self._write(out_file, "a").changed
+        mtime = out_file.stat().st_mtime_ns
+        assert not self._write(out_file, "a").changed
+        assert out_file.stat().st_mtime_ns == mtime
+        assert self._manifest(tmp_path)["out.txt"]["sha256"] == hashlib.sha256(b"a").hexdigest()
+        assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp") or f.endswith(".lock")]
+
+    def test_changed(self, tmp_path):
+        out_file = tmp_path / "out.txt"
+        self._write(out_file, "a")
+        assert self._write(out_file, "b").changed
+        assert out_file.read_text() == "b"
+        assert self._manifest(tmp_path)["out.txt"]["sha256"] == hashlib.sha256(b"b").hexdigest()
+
+    def test_changed_on_disk(self, tmp_path):
+        out_file = tmp_path / "out.txt"
+        self._write(out_file, "a")
+        out_file.write_text("edited")
+        # Not trusted, as the file changed since it was recorded
+        assert self._write(out_file, "a").changed
+        assert out_file.read_text() == "a"
+
+    def test_missing_manifest(self, tmp_path):
+        out_file = tmp_path / "out.txt"
+        out_file.write_text("a")
+        os.utime(out_file, ns=(1, 1))
+        # Compared with the content of the file
+        assert not self._write(out_file, "a").changed
+        assert out_file.stat().st_mtime_ns == 1
+
+    def test_failed_generation(self, tmp_path):
+        out_file = tmp_path / "out.txt"
+        self._write(out_file, "a")
+        with pytest.raises(ValueError):
+            with FileContext(str(out_file), OutputManifest.next_to(out_file)) as context:
+                context.write("incomplete")
+                raise ValueError()
+        assert out_file.read_text() == "a"
+        assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp") or f.endswith(".lock")]
+
+    def test_merge(self, tmp_path):
+        # Records of separate manifests (e.g. of forked workers) are merged.
+        first, second = OutputManifest.next_to(tmp_path / "a.txt"), OutputManifest.next_to(tmp_path / "b.txt")
+        for manifest, name in ((first, "a.txt"), (second, "b.txt")):
+            with FileContext(str(tmp_path / name), manifest) as context:
+                context.write(name)
+        second.save()
+        first.save()
+        assert self._manifest(tmp_path).keys() == {"a.txt", "b.txt"}
+
+class TestBufferContext:
+
+    def test_buffer(self):
+        context = BufferContext()
+        assert context.get_content() == ""
+        context.write("a")
+        context.write_ln("b")
+        assert context.get_content() == "ab\n"
+        context.write("c")
+        assert context.content == "ab\nc"
+
+    def test_bytes_buffer(self):
+        context = BytesBufferContext()
+        context.write("ä")
+        context.write(b"b")
+        assert context.get_content() == "ä".encode("utf-8") + b"b"
+        assert bytes(context.get_view()) == context.get_content()
+
+class _PumlBufferContext(BufferContext):
+    desc_as_notes = False
+
+    def name(self):
+        return "Test"
+
+class _FailingVisitor(PumlVisitor):
+    def visit_class(self, context, clazz):
+        raise AssertionError("Failed")
+
+class TestFanOutVisitor:
+
+    def _build(self, context, visitor):
+        Sofa().build("tests/test_cases/full_all.sofa", context, visitor)
+
+    @pytest.mark.parametrize("threaded", [False, True])
+    def test_same_as_separate(self, threaded):
+        puml, xmi = _PumlBufferContext(), XmiBufferContext("Test")
+        self._build(None, FanOutVisitor([(puml, PumlVisitor()), (xmi, XmiVisitor())], threaded))
+
+        separate_puml = _PumlBufferContext()
+        self._build(separate_puml, PumlVisitor())
+        assert puml.get_content() == separate_puml.get_content()
+        assert xmi.get_content().count(b"<packagedElement") > 10
+
+    @pytest.mark.parametrize("threaded", [False, True])
+    def test_error(self, threaded):
+        puml, failing = _PumlBufferContext(), _PumlBufferContext()
+        visitor = FanOutVisitor([(puml, PumlVisitor()), (failing, _FailingVisitor())], threaded)
+        with pytest.raises(AssertionError, match="Failed"):
+            self._build(None, visitor)
+
+class TestForkMap:
+
+    @pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="Requires fork")
+    def test_forked(self):
+        pids = list(fork_map(lambda i: os.getpid(), range(4), 2))
+        assert len(pids) == 4 and os.getpid() not in pids
+
+    def test_in_process_with_threads(self):
+        # Forking with other threads running could deadlock the workers.
+        done = threading.Event()
+        thread = threading.Thread(target=done.wait)
+        thread.start()
+        try:
+            assert list(fork_map(lambda i: os.getpid(), range(4), 2)) == [os.getpid()] * 4
+        finally:
+            done.set()
+            thread.join()
+
+    def test_threaded_fan_out(self, tmp_path, recwarn):
+        # Top-level packages are built in parallel.
+        sofa_file = tmp_path / "model.sofa"
+        sofa_file.write_text("package a\npackage b\nclass A:\n    package: a\nclass B:\n    package: b\n")
+        puml, xmi = _PumlBufferContext(), XmiBufferContext("Test")
+        visitor = FanOutVisitor([(puml, PumlVisitor()), (xmi, XmiParallelVisitor(workers=2))], True)
+        Sofa().build(str(sofa_file), None, visitor)
+        assert xmi.get_content().count(b"<packagedElement") == 4
+        assert not [w for w in recwarn if "multi-threaded" in str(w.message)]
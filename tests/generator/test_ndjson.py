@@ -0,0 +1,74 @@
+import json
+import pytest
+from textwrap import dedent
+
+from sofaman.generator.generator import Generator, BufferContext, FileContext
+from sofaman.generator.ndjson import NdjsonVisitor, load_ndjson
+from sofaman.ir.model import IrContext, RelationType
+from sofaman.ir.ir import SofaIR
+
+def _build(content):
+    return SofaIR().build(IrContext(SofaIR()), content)
+
+def _records(sofa_root):
+    context = BufferContext()
+    Generator().generate(sofa_root, context, NdjsonVisitor())
+    return [json.loads(line) for line in context.content.splitlines()]
+
+class TestNdjson:
+
+    def test_records(self):
+        sofa_root = _build(dedent("""
+            package a.b
+            class A:
+                package: a.b
+                description: The A
+                attributes:
+                    name:
+                        cardinality: 1
+                        type: string
+            component C:
+                ports: [443]
+            relation A associates C@443
+        """))
+        records = _records(sofa_root)
+        assert records[0] == {"kind": "model", "format": 1}
+        kinds = [r["kind"] for r in records[1:]]
+        assert kinds == ["package", "package", "class", "component", "relation"]
+
+        clazz = next(r for r in records if r["kind"] == "class")
+        package = sofa_root.get_by_qname("a.b")
+        assert clazz["qname"] == "a.b.A"
+        assert clazz["package_id"] == package.id
+        assert clazz["properties"]["attributes"]["name"]["type"] == "string"
+        assert list(clazz) == ["kind", "id", "name", "qname", "package_id", "inheritance", "properties"]
+
+        relation = records[-1]
+        assert relation["type"] == RelationType.ASSOCIATION.value
+        assert relation["source"] == {"name": "A", "port": None, "ref_id": sofa_root.get_by_qname("A").id}
+        assert relation["target"] == {"name": "C", "port": "443", "ref_id": sofa_root.get_by_qname("C").id}
+
+    def test_load(self, tmp_path):
+        sofa_root = IrContext(SofaIR()).build("tests/test_cases/full_all.sofa")
+        out_file = tmp_path / "full_all.ndjson"
+        with FileContext(str(out_file)) as context:
+            Generator().generate(sofa_root, context, NdjsonVisitor())
+
+        loaded = load_ndjson(str(out_file))
+        assert loaded.diff(sofa_root).is_empty()
+        assert len(loaded.unresolved) == len(sofa_root.unresolved)
+        loaded.validate()
+        # Same elements, with the same IDs
+        assert _records(loaded) == _records(sofa_root)
+        relation = loaded.relations[0]
+        assert relation.source.ref is loaded.get_by_id(relation.source.ref.id)
+
+    def test_load_invalid(self, tmp_path):
+        in_file = tmp_path / "model.ndjson"
+        in_file.write_text('{"kind": "model", "format": 1}\n{"kind": "unknown"}\n')
+        with pytest.raises(AssertionError, match="Unknown kind of record unknown"):
+            load_ndjson(str(in_file))
+
+        in_file.write_text('{"kind": "class"}\n')
+        with pytest.raises(AssertionError, match="not a Sofa NDJSON file"):
+            load_ndjson(str(in_file))
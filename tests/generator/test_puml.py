@@ -2,7 +2,10 @@ import pytest
 from textwrap import dedent
 
 from sofaman.generator.generator import BufferContext, Generator
-from sofaman.generator.plantuml import PumlVisitor
+from sofaman.generator.plantuml import PumlVisitor, PumlDiagramVisitor, PumlContext
+from sofaman.generator.plantuml_split import PumlSplitVisitor
+from sofaman.generator.plantuml_template import PumlTemplateVisitor
+from sofaman.sofa import Sofa
 import sofaman.parser.sofa_parser as parser
 from sofaman.ir.ir import SofaIR
 from sofaman.ir.model import IrContext
@@ -15,12 +18,18 @@ class _Setup:
 
 class _PumlContext(BufferContext):
 
-    def __init__(self, desc_as_notes = True):
+    def __init__(self, desc_as_notes = True, name = "Test"):
         super().__init__()
         self.desc_as_notes = desc_as_notes
+        self._name = name
+        self.diagrams = {}
 
     def name(self):
-        return "Test"
+        return self._name
+
+    def diagram(self, name):
+        context = self.diagrams[name] = _PumlContext(self.desc_as_notes, f"{self._name}.{name}")
+        return context
 
 class TestPumlGenerator:
 
@@ -30,12 +39,12 @@ class TestPumlGenerator:
         sofa_ir = SofaIR()
         return _Setup(sofa_parser, sofa_ir)
     
-    def _generate(self, setup : _Setup, sofa_lang_fn):
+    def _generate(self, setup : _Setup, sofa_lang_fn, visitor = None):
         tree = setup.sofa_parser.parse(sofa_lang_fn())
         sofa_root = setup.sofa_ir._build(IrContext(setup.sofa_ir), tree)
         setup.sofa_root = sofa_root
         context = _PumlContext()
-        visitor = PumlVisitor()
+        visitor = visitor or PumlVisitor()
         Generator().generate(sofa_root, context, visitor)
         return context.content
 
@@ -45,6 +54,24 @@ class TestPumlGenerator:
                                 @startuml Test
                                 allowmixing
 
+                                package A { 
+                                class Z 
+                                package B { 
+                                class X 
+                                }
+                                }
+                                package C { 
+                                class Y 
+                                }
+                                @enduml
+                        """)
+
+    def test_puml_package_per_element(self, setup): 
+        puml = self._generate(setup, test_variations.package_variations, PumlVisitor(group_packages=False))
+        assert f"\n{puml}" == dedent("""
+                                @startuml Test
+                                allowmixing
+
                                 package A.B { 
                                 class X  
                                 }
@@ -57,7 +84,89 @@ class TestPumlGenerator:
                                 @enduml
                         """)
 
-    def test_puml_diagram(self, setup): ... # Not implemented yet
+    def _bundled(self):
+        return dedent("""
+                class A
+                class B
+                relation A associates B
+                relation A associates B
+                relation B associates A
+                relation A composes B
+                relation A composes B
+                relation B flow A
+                relation A bi-flow B
+                relation B inherits A
+        """)
+
+    @pytest.mark.parametrize("labels, composition, association", [
+        ("count", "A *--> B : 2", "A <--> B : 3"), 
+        ("names", "A *--> B : A_COMPOSITION_B", "A <--> B : A_ASSOCIATION_B, B_ASSOCIATION_A")])
+    def test_puml_bundled_relations(self, setup, labels, composition, association):
+        puml = self._generate(setup, self._bundled, PumlVisitor(bundle_relations=labels))
+        relations = [line for line in puml.splitlines() if line.startswith(("A ", "B "))]
+        assert relations == [association, composition, 
+                             # Flows merged with a bidirectional flow the other way
+                             "B <..> A : 2" if labels == "count" else "B <..> A : B_INFORMATION_FLOW_A, A_BI_INFO_FLOW_B", 
+                             "B --|> A"]
+
+    def test_puml_bundle_unknown(self):
+        with pytest.raises(AssertionError):
+            PumlVisitor(bundle_relations="sum")
+
+    def test_puml_diagram(self, setup):
+        content = dedent("""
+                diagrams: [X, "Y Z", Empty]
+                class A:
+                    diagrams: [X]
+                class B:
+                    diagrams: [X, "Y Z"]
+                class C
+                relation A associates B
+                relation B composes C:
+                    diagrams: ["Y Z"]
+                relation A inherits C
+        """)
+        tree = setup.sofa_parser.parse(content)
+        sofa_root = setup.sofa_ir._build(IrContext(setup.sofa_ir), tree)
+        context = _PumlContext(desc_as_notes=False)
+        Generator().generate(sofa_root, context, PumlDiagramVisitor())
+
+        assert "class C" in context.content
+        assert context.diagrams.keys() == {"X", "Y_Z", "Empty"}
+        assert f"\n{context.diagrams['X'].content}" == dedent("""
+                                @startuml Test.X
+                                allowmixing
+
+                                class A 
+                                class B 
+                                A --> B
+
+                                @enduml
+                             """)
+        # Endpoints of a relation in the diagram are members too.
+        assert f"\n{context.diagrams['Y_Z'].content}" == dedent("""
+                                @startuml Test.Y_Z
+                                allowmixing
+
+                                class B 
+                                class C 
+                                B *--> C
+
+                                @enduml
+                             """)
+        assert context.diagrams["Empty"].content == "@startuml Test.Empty\nallowmixing\n\n@enduml\n"
+
+    def test_puml_diagram_files(self, tmp_path):
+        out_file = tmp_path / "model.puml"
+        with PumlContext(str(out_file)) as context:
+            Sofa().build("tests/test_cases/full_all.sofa", context, PumlDiagramVisitor(workers=2))
+
+        overview = (tmp_path / "model.Overview.puml").read_text()
+        assert "component CustomerDB" in overview
+        assert "443 ..> REST1" in overview
+        assert "class Person" not in overview
+        assert (tmp_path / "model.CRM_Ecosystem.puml").exists()
+        assert (tmp_path / "model.Technical_Architecture.puml").exists()
 
     def test_puml_stereotype(self, setup): 
         puml = self._generate(setup, test_variations.stereotype_variations)
@@ -188,3 +297,98 @@ class TestPumlGenerator:
     def test_puml_domain(self, setup): ... # Not implemented yet
 
     def test_puml_capability(self, setup): ... # Not implemented yet
+
+class TestPumlSplit:
+
+    CONTENT = dedent("""
+            package P1
+            package P2
+            class A:
+                package: P1
+            class B:
+                package: P1
+            class C:
+                package: P2
+            component D:
+                package: P2
+                ports: [443]
+            relation A associates B
+            relation B associates C
+            relation C associates D@443
+    """)
+
+    def _generate(self, visitor):
+        sofa_parser = parser.SofaParser()
+        sofa_ir = SofaIR()
+        sofa_root = sofa_ir._build(IrContext(sofa_ir), sofa_parser.parse(self.CONTENT))
+        context = _PumlContext(desc_as_notes=False)
+        Generator().generate(sofa_root, context, visitor)
+        return context
+
+    def test_within_budget(self):
+        context = self._generate(PumlSplitVisitor(max_nodes=4))
+        assert context.diagrams == {}
+        assert context.content == self._generate(PumlVisitor()).content
+
+    def test_split(self):
+        # Each package fits with the stub of the other one.
+        context = self._generate(PumlSplitVisitor(max_nodes=3))
+
+        assert f"\n{context.content}" == dedent("""
+                                @startuml Test
+                                rectangle "part1\\n2 elements\\nP1" as part1 [[Test.part1.puml]]
+                                rectangle "part2\\n2 elements\\nP2" as part2 [[Test.part2.puml]]
+                                part1 ..> part2 : 1
+                                @enduml
+                             """)
+        part1, part2 = context.diagrams["part1"].content, context.diagrams["part2"].content
+        assert "package P1 { \nclass A \nclass B \n}" in part1
+        assert "package P2 { \nclass C <<stub>> [[Test.part2.puml]]" in part1
+        assert "B --> C" in part1 and "C --> 443" not in part1
+        assert "package P1 { \nclass B <<stub>> [[Test.part1.puml]]" in part2
+        assert "component D  {\n    port 443\n}" in part2
+        assert "B --> C" in part2 and "C --> 443" in part2 and "A --> B" not in part2
+
+    def test_edge_budget(self):
+        context = self._generate(PumlSplitVisitor(max_nodes=10, max_edges=2))
+        assert context.diagrams.keys() == {"part1", "part2"}
+
+    def test_cluster_package(self):
+        # A package that does not fit is clustered by connectivity.
+        context = self._generate(PumlSplitVisitor(max_nodes=2))
+        parts = list(context.diagrams.values())
+        assert len(parts) == 4
+        for part in parts:
+            members = [line for line in part.content.splitlines() if line.startswith(("class", "component"))]
+            assert len([line for line in members if "<<stub>>" not in line]) == 1
+
+class TestPumlTemplate:
+
+    def _generate(self, visitor, desc_as_notes = True):
+        context = _PumlContext(desc_as_notes)
+        Sofa().build("tests/test_cases/full_all.sofa", context, visitor)
+        return context.content
+
+    @pytest.mark.parametrize("desc_as_notes", [True, False])
+    def test_default_templates(self, desc_as_notes):
+        assert self._generate(PumlTemplateVisitor(), desc_as_notes) == self._generate(PumlVisitor(), desc_as_notes)
+
+    def test_user_templates(self):
+        puml = self._generate(PumlTemplateVisitor({
+            "header": "@startuml {name}\nskinparam monochrome true\n!include <tupadr3/common>\n",
+            "actor": "\nactor {name} <<$person>>\n{note}",
+            "relation": "\n{source} {arrow} {target} : relates\n"}))
+
+        assert puml.startswith("@startuml Test\nskinparam monochrome true\n!include <tupadr3/common>\n")
+        assert "\nactor Client <<$person>>\n" in puml
+        assert "443 ..> REST1 : relates" in puml
+        assert puml.endswith("\n@enduml\n")
+
+    def test_small_batches(self, monkeypatch):
+        monkeypatch.setattr(PumlTemplateVisitor, "BATCH_SIZE", 2)
+        assert self._generate(PumlTemplateVisitor()) == self._generate(PumlVisitor())
+
+    @pytest.mark.parametrize("templates", [{"klass": "{name}"}, {"class": "{name.__class__}"}, {"relation": "{name}"}])
+    def test_invalid_templates(self, templates):
+        with pytest.raises(AssertionError):
+            PumlTemplateVisitor(templates)
@@ -1,8 +1,18 @@
+import gzip
+import json
+import re
 import pytest
 import lxml.etree as etree
 
 from sofaman.generator.generator import Generator
-from sofaman.generator.uml2 import NS_MAP, XmiVisitor, XMI, UML
+from sofaman.generator.uml2 import NS_MAP, XmiVisitor, XmiContext, XmiBufferContext, XmiFlavor, XMI, UML
+from sofaman.generator.uml2_stream import XmiStreamVisitor
+from sofaman.generator.uml2_parallel import XmiParallelVisitor
+from sofaman.generator.uml2_shard import XmiShardVisitor
+from sofaman.generator.uml2_cache import XmiCachedVisitor
+from sofaman.generator.uml2_patch import XmiPatcher, patch_xmi
+from sofaman.sofa import Sofa
+from sofaman.tools.export.id_export import IdExporter
 from sofaman.ir.model import IrContext
 import sofaman.parser.sofa_parser as parser
 from sofaman.ir.ir import SofaIR
@@ -330,3 +340,275 @@ class TestUml2Generator:
         elem = self._get_packaged_element_by_name(root, "A")
         assert elem.get(f"{XMI}type") == "uml:Interface"
         assert elem.get(f"{XMI}id") == "9fa622a6-d44f-409a-b09d-a6712fde2787"
+
+    def test_buffer_context(self, setup):
+        tree = setup.sofa_parser.parse(test_variations.class_variations())
+        sofa_root = setup.sofa_ir._build(IrContext(setup.sofa_ir), tree)
+        context = XmiBufferContext("Test", mode=XmiFlavor.SPARX_EA)
+        Generator().generate(sofa_root, context, XmiVisitor())
+        content = context.get_content()
+        assert isinstance(content, bytes)
+        root = etree.fromstring(content)
+        assert self._get_packaged_element_by_name(root, "Test").get(f"{XMI}type") == "uml:Package"
+        assert self._get_packaged_element_by_name(root, "B").get(f"{XMI}type") == "uml:Class"
+
+class TestXmiStreamGenerator:
+
+    UUID = re.compile(rb"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+    def _normalize(self, content):
+        # Random IDs are numbered in order of appearance.
+        seen = {}
+        return self.UUID.sub(lambda m: b"ID%d" % seen.setdefault(m.group(0), len(seen)), content)
+
+    def _generate(self, build, visitor, mode, pretty_print):
+        context = XmiBufferContext("Test", mode=mode, pretty_print=pretty_print)
+        build(context, visitor)
+        return self._normalize(context.get_content())
+
+    def _assert_same_as_dom(self, build):
+        for mode in (XmiFlavor.NORMAL, XmiFlavor.SPARX_EA):
+            for pretty_print in (True, False):
+                dom = self._generate(build, XmiVisitor(), mode, pretty_print)
+                stream = self._generate(build, XmiStreamVisitor(), mode, pretty_print)
+                assert stream == dom
+                parallel = self._generate(build, XmiParallelVisitor(workers=2), mode, pretty_print)
+                assert parallel == dom
+
+    @pytest.mark.parametrize("variations", [
+        test_variations.package_variations, test_variations.stereotype_variations, 
+        test_variations.actor_variations, test_variations.component_variations, 
+        test_variations.class_variations, test_variations.relation_variations,
+        test_variations.primitives_variations, test_variations.interface_variations])
+    def test_same_as_dom(self, variations):
+        def build(context, visitor):
+            sofa_ir = SofaIR()
+            sofa_root = sofa_ir._build(IrContext(sofa_ir), parser.SofaParser().parse(variations()))
+            Generator().generate(sofa_root, context, visitor)
+        self._assert_same_as_dom(build)
+
+    def test_full_same_as_dom(self):
+        self._assert_same_as_dom(lambda context, visitor: Sofa().build("tests/test_cases/full_all.sofa", context, visitor))
+
+    def test_file_context(self, tmp_path):
+        out_file = tmp_path / "model.xmi"
+        context = XmiContext(str(out_file), mode=XmiFlavor.SPARX_EA)
+        context.ids = {"A": "9fa622a6-d44f-409a-b09d-a6712fde2787"}
+        sofa_ir = SofaIR()
+        sofa_root = sofa_ir._build(IrContext(sofa_ir), parser.SofaParser().parse(test_variations.interface_variations()))
+        Generator().generate(sofa_root, context, XmiStreamVisitor())
+
+        root = etree.parse(str(out_file)).getroot()
+        elem = root.find(f".//{UML}packagedElement[@name='A']", namespaces=NS_MAP)
+        assert elem.get(f"{XMI}type") == "uml:Interface"
+        assert elem.get(f"{XMI}id") == "9fa622a6-d44f-409a-b09d-a6712fde2787"
+
+    @pytest.mark.parametrize("visitor", [XmiVisitor, XmiStreamVisitor])
+    def test_compact_compressed(self, visitor):
+        def build(context):
+            Sofa().build("tests/test_cases/full_all.sofa", context, visitor())
+            return context.get_content()
+        pretty = build(XmiBufferContext("Test"))
+        compact = build(XmiBufferContext("Test", pretty_print=False))
+        compressed = build(XmiBufferContext("Test", pretty_print=False, compress=True))
+
+        assert len(compact) < len(pretty)
+        assert self._normalize(gzip.decompress(compressed)) == self._normalize(compact)
+        assert etree.tostring(etree.fromstring(compact)) == compact
+
+class TestXmiShardGenerator:
+
+    def _elements(self, content):
+        # Packaged elements other than proxies, by name.
+        root = etree.fromstring(content)
+        return [e.get("name") for e in root.iter(f"{UML}packagedElement") if e.get("href") is None]
+
+    def _proxies(self, content):
+        root = etree.fromstring(content)
+        return [e.get("href") for e in root.iter(f"{UML}packagedElement") if e.get("href") is not None]
+
+    def test_shards(self):
+        dom = XmiBufferContext("Test", mode=XmiFlavor.SPARX_EA)
+        Sofa().build("tests/test_cases/full_all.sofa", dom, XmiVisitor())
+        context = XmiBufferContext("Test", mode=XmiFlavor.SPARX_EA)
+        Sofa().build("tests/test_cases/full_all.sofa", context, XmiShardVisitor())
+
+        assert set(context.shards.keys()) == {"Test.Retail.xmi", "Test.Retail.CRM.xmi"}
+        assert [p.split("#")[0] for p in self._proxies(context.get_content())] == ["Test.Retail.xmi"]
+        crm = context.shards["Test.Retail.CRM.xmi"].get_content()
+        assert self._elements(crm) == ["Test", "CRM", "CustomerDB"]
+        assert b"base_Component" in crm
+
+        # Every element is in exactly one document, besides the outer package.
+        elements = self._elements(context.get_content())
+        for shard in context.shards.values():
+            elements.extend(filter(lambda n: n != "Test", self._elements(shard.get_content())))
+        assert sorted(elements) == sorted(self._elements(dom.get_content()))
+
+    def test_shard_files(self, tmp_path):
+        out_file = tmp_path / "model.xmi"
+        with XmiContext(str(out_file), mode=XmiFlavor.SPARX_EA) as context:
+            Sofa().build("tests/test_cases/full_all.sofa", context, XmiShardVisitor(workers=2))
+
+        href = self._proxies(out_file.read_bytes())[0]
+        shard_file, pkg_id = href.split("#")
+        shard = etree.parse(str(tmp_path / shard_file)).getroot()
+        assert shard.find(f".//{UML}packagedElement[@{XMI}id='{pkg_id}']").get("name") == "Retail"
+        assert (tmp_path / "model.Retail.CRM.xmi").exists()
+
+class TestXmiCachedGenerator:
+
+    def _generate(self, content, cache_file, mode = XmiFlavor.SPARX_EA):
+        context = XmiBufferContext("Test", mode=mode)
+        visitor = XmiCachedVisitor(str(cache_file))
+        sofa_ir = SofaIR()
+        sofa_root = sofa_ir._build(IrContext(sofa_ir), parser.SofaParser().parse(content))
+        Generator().generate(sofa_root, context, visitor)
+        return context.get_content(), visitor.cache
+
+    def _ids(self, content):
+        root = etree.fromstring(content)
+        return {e.get("name"): e.get(f"{XMI}id") for e in root.iter(f"{UML}packagedElement")}
+
+    def test_reuse(self, tmp_path):
+        content = test_variations.relation_variations()
+        first, cache = self._generate(content, tmp_path / "model.cache")
+        assert cache.hits == 0
+        second, cache = self._generate(content, tmp_path / "model.cache")
+        assert cache.misses == 0
+        # Same IDs, so the same output apart from comments and the outer package.
+        ids = self._ids(second)
+        assert ids["A"] == self._ids(first)["A"]
+        dom = XmiBufferContext("Test", mode=XmiFlavor.SPARX_EA)
+        sofa_ir = SofaIR()
+        Generator().generate(sofa_ir._build(IrContext(sofa_ir), parser.SofaParser().parse(content)), dom, XmiVisitor())
+        normalize = TestXmiStreamGenerator()._normalize
+        assert normalize(second) == normalize(dom.get_content())
+
+    def test_reproducible(self, tmp_path):
+        # The outer package keeps its ID as well, so unchanged models give the same XMI.
+        content = test_variations.relation_variations()
+        first, _ = self._generate(content, tmp_path / "model.cache")
+        second, _ = self._generate(content, tmp_path / "model.cache")
+        assert second == first
+
+    def test_changed_element(self, tmp_path):
+        content = test_variations.relation_variations() + "class C\nclass D\n"
+        self._generate(content, tmp_path / "model.cache")
+        content = content.replace("class D", "class D:\n    description: Changed")
+        _, cache = self._generate(content, tmp_path / "model.cache")
+        assert cache.misses == 1
+        # A relation changes the ends in its source, so the source is generated again.
+        _, cache = self._generate(content + "relation C associates D\n", tmp_path / "model.cache")
+        assert cache.misses == 2
+
+    def test_invalidated(self, tmp_path):
+        content = test_variations.class_variations()
+        self._generate(content, tmp_path / "model.cache")
+        _, cache = self._generate(content, tmp_path / "model.cache", XmiFlavor.NORMAL)
+        assert cache.hits == 0
+
+class TestXmiPatcher:
+
+    def _root(self, content):
+        # Imports are resolved relative to the original file.
+        sofa_ir = SofaIR()
+        return sofa_ir.build(IrContext(sofa_ir, "tests/test_cases/full_all.sofa"), content)
+
+    def _ids(self, content):
+        root = etree.fromstring(content)
+        return {e.get("name"): e.get(f"{XMI}id") for e in root.iter(f"{UML}packagedElement")}
+
+    @pytest.mark.parametrize("mode", [XmiFlavor.NORMAL, XmiFlavor.SPARX_EA])
+    @pytest.mark.parametrize("edit, generated", [
+        (lambda s: s, 0),
+        (lambda s: s.replace("class Account\n", "class Account:\n    description: Changed\n"), 1),
+        # Removed relation, added class and relation, along with the elements holding their ends.
+        (lambda s: s.replace("relation PowerOfAttorney associates Person\n", "") 
+                   + "\nclass Extra\nrelation Extra associates Person\n", 4),
+        (lambda s: s.replace("PaymentChannel", "PaymentChannel2"), 3)])
+    def test_same_as_generation(self, tmp_path, mode, edit, generated):
+        content = open("tests/test_cases/full_all.sofa").read()
+        old_file = tmp_path / "model.xmi"
+        with XmiContext(str(old_file), mode=mode) as context:
+            Generator().generate(self._root(content), context, XmiStreamVisitor())
+
+        new_root = self._root(edit(content))
+        patcher = XmiPatcher(str(old_file), new_root.diff(self._root(content)))
+        (tmp_path / "patched").mkdir()
+        with XmiContext(str(tmp_path / "patched" / "model.xmi"), mode=mode) as context:
+            Generator().generate(new_root, context, patcher)
+        assert patcher.generated == generated
+
+        dom = XmiBufferContext("model", mode=mode)
+        Generator().generate(self._root(edit(content)), dom, XmiVisitor())
+        normalize = TestXmiStreamGenerator()._normalize
+        assert normalize((tmp_path / "patched" / "model.xmi").read_bytes()) == normalize(dom.get_content())
+
+    def test_patch_in_place(self, tmp_path):
+        content = open("tests/test_cases/full_all.sofa").read()
+        xmi_file = tmp_path / "model.xmi"
+        with XmiContext(str(xmi_file), mode=XmiFlavor.SPARX_EA) as context:
+            Generator().generate(self._root(content), context, XmiStreamVisitor())
+        old_ids = self._ids(xmi_file.read_bytes())
+
+        new_content = content.replace("class Account\n", "class Account:\n    description: Changed\n")
+        new_root = self._root(new_content)
+        patch_xmi(str(xmi_file), new_root, new_root.diff(self._root(content)))
+
+        patched = xmi_file.read_bytes()
+        assert b'body="Changed"' in patched
+        ids = self._ids(patched)
+        assert ids["Account"] == old_ids["Account"]
+        assert ids["Retail"] == old_ids["Retail"]
+        assert ids["PaymentChannel"] == old_ids["PaymentChannel"]
+        assert list(tmp_path.iterdir()) == [xmi_file]
+
+class TestWrittenIds:
+
+    def _generate(self, out_file, visitor, mode, ids = None):
+        with XmiContext(str(out_file), mode=mode) as context:
+            context.ids = ids
+            context.ids_out_file = f"{out_file}.ids.json"
+            Sofa().build("tests/test_cases/full_all.sofa", context, visitor)
+        with open(context.ids_out_file) as f:
+            return json.load(f)
+
+    @pytest.mark.parametrize("mode", [XmiFlavor.NORMAL, XmiFlavor.SPARX_EA])
+    @pytest.mark.parametrize("visitor", [XmiVisitor, XmiStreamVisitor, XmiParallelVisitor])
+    def test_same_as_export(self, tmp_path, visitor, mode):
+        out_file = tmp_path / "model.xmi"
+        ids = self._generate(out_file, visitor(), mode)
+        exported = IdExporter(str(out_file)).ids
+        assert "Retail.CRM" in ids or "model.Retail.CRM" in ids
+        assert {qname: exported.get(qname) for qname in ids} == ids
+
+    def _assert_consistent(self, out_file):
+        # Every ID is unique, and every reference is to one of them.
+        root = etree.parse(str(out_file)).getroot()
+        ids = [e.get(f"{XMI}id") for e in root.iter() if e.get(f"{XMI}id")]
+        assert len(ids) == len(set(ids))
+        ref_attrs = {f"{XMI}idref", f"{XMI}association", "association", "general", "client", "supplier",
+                     "informationSource", "informationTarget"}
+        refs = [value for e in root.iter() for name, value in e.attrib.items() 
+                if name in ref_attrs or name.startswith("base_")]
+        assert refs and set(refs) <= set(ids)
+
+    @pytest.mark.parametrize("visitor", [XmiVisitor, XmiStreamVisitor, XmiCachedVisitor])
+    def test_stable(self, tmp_path, visitor):
+        # Generating with the written IDs gives the same IDs, as after an export.
+        out_file = tmp_path / "model.xmi"
+        ids = self._generate(out_file, visitor(), XmiFlavor.SPARX_EA)
+        self._assert_consistent(out_file)
+        assert self._generate(out_file, visitor(), XmiFlavor.SPARX_EA, ids) == ids
+        self._assert_consistent(out_file)
+
+    @pytest.mark.parametrize("visitor", [XmiVisitor, XmiStreamVisitor])
+    def test_exported_ids(self, tmp_path, visitor):
+        # IDs exported from Sparx EA are given to the elements only.
+        with open("tests/test_cases/full_all_id.json") as f:
+            exported = json.load(f)
+        out_file = tmp_path / "full_all.xmi"
+        ids = self._generate(out_file, visitor(), XmiFlavor.SPARX_EA, exported)
+        assert ids["full_all.Retail.CRM.CustomerDB"] == exported["full_all.Retail.CRM.CustomerDB"]
+        self._assert_consistent(out_file)
@@ -1,10 +1,14 @@
+import pickle
+import sys
 import pytest
 from textwrap import dedent
 
-from sofaman.generator.generator import BufferContext, FileContext
+from sofaman.generator.generator import BufferContext, FileContext, Generator
+from sofaman.generator.uml2 import XmiVisitor, XmiBufferContext
 import sofaman.parser.sofa_parser as parser
 from sofaman.ir.ir import SofaIR
-from sofaman.ir.model import RelationType, Visibility, DiagramType, IrContext
+from sofaman.ir.model import (RelationType, Visibility, DiagramType, IrContext,
+                              ChangeSet, Classes, Relations, Validator, ValidationError)
 import tests.test_cases.test_variations as test_variations
 
 class _Setup:
@@ -185,3 +189,257 @@ class TestSofaIR:
         assert sofa_root.relations.elems[0].source.name == "A"
         assert sofa_root.relations.elems[0].target.name == "B"
         assert sofa_root.relations.elems[0].type == RelationType.INFORMATION_FLOW
+
+    def test_validate_undefined_reference(self, setup):
+        content = dedent("""
+                    class A
+                    relation A flow B
+        """)
+        sofa_root = self._get_root(setup, lambda: content)
+        with pytest.raises(ValidationError):
+            sofa_root.validate()
+
+    def test_validate_changes(self, setup):
+        sofa_root = self._get_root(setup, test_variations.relation_variations)
+        sofa_root.validate()
+        results = sofa_root.validator.results
+        assert len(results) == len(sofa_root.relations.elems)
+
+        cls_b = sofa_root.get_by_qname("B")
+        assert len(sofa_root.get_referrers("B")) == len(sofa_root.relations.elems)
+
+        sofa_root.remove_child(cls_b, Classes)
+        with pytest.raises(ValidationError):
+            sofa_root.validate(ChangeSet(removed=[cls_b]))
+        # A full validation must give the same result
+        with pytest.raises(ValidationError):
+            Validator().validate(sofa_root)
+
+        sofa_root.append_child(cls_b, Classes)
+        sofa_root.validate(ChangeSet(added=[cls_b]))
+        assert all(map(lambda e: e is None, results.values()))
+
+    def test_validate_changes_untouched(self, setup, monkeypatch):
+        content = dedent("""
+                    class A
+                    class B
+                    class C
+                    relation A associates B
+                    relation B associates C
+                    relation C flow Missing
+        """)
+        sofa_root = self._get_root(setup, lambda: content)
+        with pytest.raises(ValidationError, match="Missing"):
+            sofa_root.validate()
+        previous = dict(sofa_root.validator.results)
+        rel_ab, rel_bc, rel_missing = sofa_root.relations
+        validated = []
+        validate_relation = Validator._validate_relation
+        monkeypatch.setattr(Validator, "_validate_relation",
+                            lambda self, root, rel: validated.append(rel) or validate_relation(self, root, rel))
+
+        # Only the relations of A are checked again, the others keep their results.
+        with pytest.raises(ValidationError, match="Missing"):
+            sofa_root.validate(ChangeSet(modified=[sofa_root.get_by_qname("A")]))
+        assert validated == [rel_ab]
+        results = sofa_root.validator.results
+        assert results.keys() == previous.keys()
+        assert results[rel_bc.id] is None and results[rel_ab.id] is None
+        assert results[rel_missing.id] is previous[rel_missing.id]
+
+        # The bound ends of the checked relations must match their names.
+        rel_bc.target.ref = sofa_root.get_by_qname("A")
+        with pytest.raises(ValidationError, match="(?s)C, but is bound to another element.*Missing"):
+            sofa_root.validate(ChangeSet(modified=[rel_bc]))
+
+    def test_diff(self, setup):
+        old_root = self._get_root(setup, test_variations.relation_variations)
+        new_root = self._get_root(setup, lambda: test_variations.relation_variations()
+                                  .replace("relation A composes B\n", "")
+                                  .replace("protocol: HTTPS", "protocol: HTTP") + "class C\n")
+        change_set = new_root.diff(old_root)
+        assert [e.get_qname() for e in change_set.added] == ["C"]
+        assert [e.get_qname() for e in change_set.removed] == ["A_COMPOSITION_B"]
+        assert [e.get_qname() for e in change_set.modified] == ["A_INFORMATION_FLOW_B"]
+        assert change_set.modified[0] is new_root.get_by_qname("A_INFORMATION_FLOW_B")
+        assert self._get_root(setup, test_variations.relation_variations).diff(old_root).is_empty()
+
+    def test_bind_references(self, setup):
+        sofa_root = self._get_root(setup, test_variations.class_variations)
+        cls_b = sofa_root.classes[1]
+        cls_string = sofa_root.classes[3]
+        assert cls_b.attributes()[0].type_ref is cls_string
+        assert cls_b.operations()[0].parameters[0].type_ref is cls_string
+        assert sofa_root.unresolved == []
+
+        sofa_root = self._get_root(setup, test_variations.relation_variations)
+        rel = sofa_root.relations[0]
+        assert rel.source.ref is sofa_root.classes[0]
+        assert rel.target.ref is sofa_root.classes[1]
+
+        sofa_root = self._get_root(setup, test_variations.stereotype_variations)
+        stereo = sofa_root.components[0].stereotypes()[0]
+        assert stereo.profile_ref is sofa_root.stereotype_profiles[0]
+
+    def test_bind_unresolved(self, setup):
+        content = dedent("""
+                    class A:
+                        stereotypes: [Abc.X]
+                        attributes:
+                            a:
+                                cardinality: 1
+                                type: Missing
+                    relation A flow B
+                    relation C flow A
+        """)
+        sofa_root = self._get_root(setup, lambda: content)
+        unresolved = set(map(lambda u: (u.kind, u.name), sofa_root.unresolved))
+        assert unresolved == {("Stereotype", "Abc.X"), ("Type", "Missing"), ("Target", "B"), ("Source", "C")}
+        # All the unresolved relation ends are reported at once
+        with pytest.raises(ValidationError, match="(?s)B.*C"):
+            sofa_root.validate()
+
+    def test_validate_unresolved(self, setup):
+        content = dedent("""
+                    class A:
+                        stereotypes: [Abc.X]
+                        attributes:
+                            a:
+                                cardinality: 1
+                                type: MissingAttr
+                        operations:
+                            op:
+                                parameters:
+                                    p:
+                                        type: MissingParam
+                    class B:
+                        attributes:
+                            b:
+                                cardinality: 1
+                                type: A
+                    relation A flow C
+        """)
+        sofa_root = self._get_root(setup, lambda: content)
+        # One error for all the unresolved references, of every kind
+        with pytest.raises(ValidationError) as error:
+            sofa_root.validate()
+        assert str(error.value).splitlines() == [
+            "Relation A_INFORMATION_FLOW_C references obj C, but is not defined",
+            "Stereotype Abc.X referenced by A, but is not defined",
+            "Type MissingAttr referenced by a, but is not defined",
+            "Type MissingParam referenced by p, but is not defined"]
+
+    def test_rebind_unresolved(self, setup):
+        content = dedent("""
+                    class A
+                    class B
+                    relation A associates B
+        """)
+        sofa_root = self._get_root(setup, lambda: content)
+        cls_b = sofa_root.get_by_qname("B")
+        relation = sofa_root.relations[0]
+        ends = lambda: [u.name for u in sofa_root.unresolved]
+        # The unresolved ends do not pile up over add/remove cycles.
+        for _ in range(3):
+            sofa_root.remove_child(cls_b, Classes)
+            assert ends() == ["B"]
+            sofa_root.append_child(cls_b, Classes)
+            assert ends() == []
+        sofa_root.remove_child(cls_b, Classes)
+        sofa_root.remove_child(relation, Relations)
+        assert ends() == []
+        sofa_root.append_child(relation, Relations)
+        assert ends() == ["B"]
+
+    def test_rebind_types(self, setup):
+        content = dedent("""
+                    class A:
+                        attributes:
+                            a:
+                                cardinality: 1
+                                type: B
+                        operations:
+                            op:
+                                parameters:
+                                    p:
+                                        type: B
+                    class B
+        """)
+        sofa_root = self._get_root(setup, lambda: content)
+        cls_a, cls_b = sofa_root.get_by_qname("A"), sofa_root.get_by_qname("B")
+        attr = cls_a.attributes()[0]
+        param = cls_a.operations()[0].parameters[0]
+        assert sofa_root.get_referrers("B") == [attr, param]
+        unresolved = lambda: [(u.kind, u.name, u.referrer) for u in sofa_root.unresolved]
+
+        sofa_root.remove_child(cls_b, Classes)
+        assert attr.type_ref is None and param.type_ref is None
+        assert unresolved() == [("Type", "B", attr), ("Type", "B", param)]
+        # The removed class is not referred to by the generated model.
+        with pytest.raises(AssertionError, match="Type B not defined"):
+            Generator().generate(sofa_root, XmiBufferContext("Test"), XmiVisitor())
+
+        sofa_root.append_child(cls_b, Classes)
+        assert attr.type_ref is cls_b and param.type_ref is cls_b
+        assert unresolved() == []
+        xmi = XmiBufferContext("Test")
+        Generator().generate(sofa_root, xmi, XmiVisitor())
+        assert f'type xmi:idref="{cls_b.id}"'.encode() in xmi.get_content()
+
+        # The references of a removed class go with it.
+        sofa_root.remove_child(cls_b, Classes)
+        sofa_root.remove_child(cls_a, Classes)
+        assert unresolved() == []
+        assert sofa_root.get_referrers("B") == []
+
+    def test_pickle(self, setup):
+        sofa_root = IrContext(SofaIR()).build("tests/test_cases/full_all.sofa")
+        sofa_root.validate()
+        state = sofa_root.__getstate__()
+        assert not set(state) & {"index_id", "index_referrers"}
+
+        loaded = pickle.loads(pickle.dumps(sofa_root))
+        assert loaded.index_id.keys() == sofa_root.index_id.keys()
+        assert loaded.index_name.keys() == sofa_root.index_name.keys()
+        assert loaded.index_referrers.keys() == sofa_root.index_referrers.keys()
+        assert loaded.diff(sofa_root).is_empty()
+        loaded.validate()
+
+        # Elements are shared, as in the original
+        rel = loaded.relations[0]
+        assert rel.source.ref is loaded.get_by_qname(rel.source.name)
+        assert loaded.get_by_id(rel.id) is rel
+        assert rel in loaded.get_referrers(rel.target.name)
+        crm = loaded.get_by_qname("Retail.CRM")
+        assert crm.parent_package is loaded.get_by_qname("Retail")
+
+    def test_pickle_type_chain(self, setup):
+        # Attributes typed by the next class, deeper than the recursion limit of pickle.
+        size = sys.getrecursionlimit()
+        content = "".join(f"class C{i}:\n    attributes:\n        next:\n            cardinality: 1\n"
+                          f"            type: C{i + 1}\n" for i in range(size)) + f"class C{size}\n"
+        sofa_root = self._get_root(setup, lambda: content)
+
+        loaded = pickle.loads(pickle.dumps(sofa_root))
+        assert loaded.unresolved == []
+        for i in (0, size - 1):
+            assert loaded.get_by_qname(f"C{i}").attributes()[0].type_ref is loaded.get_by_qname(f"C{i + 1}")
+
+    def test_interned_strings(self, setup):
+        content = dedent("""
+                    primitives: [String]
+                    class A:
+                        attributes:
+                            a:
+                                cardinality: 1
+                                type: String
+                    class B:
+                        attributes:
+                            b:
+                                cardinality: 1
+                                type: String
+        """)
+        sofa_root = self._get_root(setup, lambda: content)
+        cls_a, cls_b = sofa_root.classes
+        # Pickled once
+        assert cls_a.attributes()[0].type is cls_b.attributes()[0].type
@@ -0,0 +1,92 @@
+import sys
+import pytest
+
+from sofaman.generator.generator import Generator, BufferContext
+from sofaman.generator.ndjson import NdjsonVisitor
+from sofaman.ir.ir import SofaIR
+from sofaman.ir.model import IrContext, Package, Relation
+from sofaman.ir.snapshot import GROUPS, SnapshotRoot, write_snapshot
+
+def _ndjson(sofa_root):
+    context = BufferContext()
+    Generator().generate(sofa_root, context, NdjsonVisitor())
+    return context.content
+
+class TestSnapshot:
+
+    @pytest.fixture
+    def sofa_root(self):
+        return IrContext(SofaIR()).build("tests/test_cases/full_all.sofa")
+
+    @pytest.fixture
+    def snapshot_file(self, sofa_root, tmp_path):
+        snapshot_file = str(tmp_path / "full_all.snapshot")
+        write_snapshot(sofa_root, snapshot_file)
+        return snapshot_file
+
+    def test_lazy(self, sofa_root, snapshot_file):
+        with SnapshotRoot(snapshot_file) as snapshot:
+            assert len(snapshot) == sum(len(getattr(sofa_root, group).elems) for group in GROUPS)
+            assert not snapshot._decoded
+
+            package = snapshot.get_by_qname("Retail.CRM")
+            assert isinstance(package, Package)
+            assert package.id == sofa_root.get_by_qname("Retail.CRM").id
+            # Only the package, its parent is decoded when read
+            assert len(snapshot._decoded) == 1
+            assert package.parent_package is snapshot.get_by_qname("Retail")
+            assert len(snapshot._decoded) == 2
+            assert snapshot.get_by_id(package.id) is package
+            assert snapshot.get_by_qname("Unknown") is None
+            with pytest.raises(KeyError):
+                snapshot.get_by_id("unknown")
+
+    def test_links(self, sofa_root, snapshot_file):
+        with SnapshotRoot(snapshot_file) as snapshot:
+            for relation in sofa_root.relations:
+                loaded = snapshot.get_by_id(relation.id)
+                assert isinstance(loaded, Relation)
+                assert loaded.type == relation.type
+                for endpoint, loaded_endpoint in ((relation.source, loaded.source), (relation.target, loaded.target)):
+                    assert loaded_endpoint.ref.id == endpoint.ref.id
+                    assert (loaded_endpoint.port and loaded_endpoint.port.get_name()) == (endpoint.port and endpoint.port.get_name())
+            for elem in snapshot.classes:
+                for attr in elem.attributes() or []:
+                    assert attr.type_ref is snapshot.get_by_qname(attr.type)
+
+    def test_lazy_links(self, tmp_path):
+        # Classes typed and related by the next class, deeper than the recursion limit
+        size = sys.getrecursionlimit() * 2
+        content = "".join(f"class C{i}:\n    attributes:\n        next:\n            cardinality: 1\n"
+                          f"            type: C{i + 1}\n" for i in range(size)) + f"class C{size}\n"
+        content += "".join(f"relation C{i} associates C{i + 1}\n" for i in range(size))
+        sofa_file = tmp_path / "chain.sofa"
+        sofa_file.write_text(content)
+        snapshot_file = str(tmp_path / "chain.snapshot")
+        write_snapshot(IrContext(SofaIR()).build(str(sofa_file)), snapshot_file)
+
+        with SnapshotRoot(snapshot_file) as snapshot:
+            elem = snapshot.get_by_qname("C0")
+            assert len(snapshot._decoded) == 1
+            relation = snapshot.relations[0]
+            assert len(snapshot._decoded) == 2
+            assert relation.source.ref is elem
+            assert relation.target.ref is snapshot.get_by_qname("C1")
+            assert len(snapshot._decoded) == 3
+
+            for i in range(size):
+                elem = elem.attributes()[0].type_ref
+                assert elem.get_name() == f"C{i + 1}"
+            assert elem.attributes() is None
+            assert len(snapshot._decoded) == size + 2
+
+    def test_visit(self, sofa_root, snapshot_file):
+        with SnapshotRoot(snapshot_file) as snapshot:
+            assert _ndjson(snapshot) == _ndjson(sofa_root)
+            assert sofa_root.diff(snapshot).is_empty()
+
+    def test_invalid(self, tmp_path):
+        snapshot_file = tmp_path / "model.snapshot"
+        snapshot_file.write_bytes(b"NOTASNAPSHOT" * 4)
+        with pytest.raises(AssertionError, match="is not a snapshot"):
+            SnapshotRoot(str(snapshot_file))
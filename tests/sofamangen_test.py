@@ -1,5 +1,13 @@
+import gzip
+import json
+import os
+import pytest
 from click.testing import CliRunner
 from sofaman.sofamangen import generate, export
+from lxml import etree
+from sofaman.generator.uml2 import XMI
+from sofaman.tools.export.id_export import IdExporter
+from sofaman.tools.export.id_store import read_ids, write_ids
 
 def test_generate_xmi(tmp_path):
     runner = CliRunner()
@@ -52,6 +60,15 @@ def test_export_id(tmp_path):
     assert result.exit_code == 0
     assert output_file.exists()
 
+def test_export_id_sqlite(tmp_path):
+    runner = CliRunner()
+    output_file = tmp_path / "ids.db"
+
+    result = runner.invoke(export, ["tests/test_cases/full_all.xmi", str(output_file)])
+
+    assert result.exit_code == 0
+    assert read_ids(str(output_file))["full_all"] == "17ff2979-398e-4b16-a62a-4a52387b3b01"
+
 def test_ids_file(tmp_path):
     runner = CliRunner()
     input_file = tmp_path / "input.xmi"
@@ -64,3 +81,281 @@ def test_ids_file(tmp_path):
     assert result.exit_code == 0
     assert output_file.exists()
 
+def test_ids_file_sqlite(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.xmi"
+    ids_file = tmp_path / "ids.db"
+    input_file.write_text("class A")
+    write_ids({"A": "1"}, str(ids_file))
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--ids_file', str(ids_file)])
+
+    assert result.exit_code == 0
+    assert 'xmi:id="1"' in output_file.read_text()
+
+
+def test_write_ids(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.xmi"
+    input_file.write_text("package a\nprimitives: [String]\n"
+                          "class A:\n    package: a\n    attributes:\n        name:\n            cardinality: 1\n"
+                          "            type: String\n"
+                          "class B\nrelation A associates B\nrelation B inherits A\n")
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--write_ids'])
+
+    assert result.exit_code == 0
+    ids = read_ids(str(tmp_path / "output.xmi.ids.json"))
+    assert sorted(ids) == ["output", "output.A_ASSOCIATION_B", "output.B", "output.B_INHERITANCE_A", 
+                           "output.String", "output.a", "output.a.A"]
+    # Packaged elements only, the owned attributes and generalizations are left out.
+    exported = IdExporter(str(output_file)).ids
+    assert {"output.a.A.name", "output.B.B_INHERITANCE_A"} <= exported.keys()
+    assert ids == {qname: id for qname, id in exported.items() if qname in ids}
+
+    # Written IDs are kept by the next generation.
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--ids_file', str(tmp_path / "output.xmi.ids.json")])
+    assert result.exit_code == 0
+    exported = IdExporter(str(output_file)).ids
+    assert ids == {qname: id for qname, id in exported.items() if qname in ids}
+
+@pytest.mark.parametrize("xmi_engine", ["dom", "stream", "parallel", "cached"])
+def test_ids_from_xmi(tmp_path, xmi_engine):
+    runner = CliRunner()
+    input_file = "tests/test_cases/full_all.sofa"
+    output_file = tmp_path / "model.xmi"
+    # The previous version of the output, e.g. after an import into EA
+    (tmp_path / "previous").mkdir()
+    previous_file = tmp_path / "previous" / "model.xmi"
+    runner.invoke(generate, [input_file, str(previous_file)])
+    result = runner.invoke(generate, [input_file, str(output_file), '--ids_from_xmi', str(previous_file), 
+                                      '--xmi_engine', xmi_engine])
+
+    assert result.exit_code == 0
+    previous = IdExporter(str(previous_file)).ids
+    assert IdExporter(str(output_file)).ids["model.Retail.CRM.CustomerDB"] == previous["model.Retail.CRM.CustomerDB"]
+    # Every ID is unique, and every reference is to one of them.
+    root = etree.parse(str(output_file)).getroot()
+    ids = [e.get(f"{XMI}id") for e in root.iter() if e.get(f"{XMI}id")]
+    assert len(ids) == len(set(ids))
+    refs = [value for e in root.iter() for name, value in e.attrib.items() 
+            if name in (f"{XMI}idref", f"{XMI}association", "association", "general") or name.startswith("base_")]
+    assert refs and set(refs) <= set(ids)
+
+@pytest.mark.parametrize("manifest", [[], ['--no_manifest']])
+def test_ids_from_xmi_same_as_output(tmp_path, manifest):
+    runner = CliRunner()
+    output_file = tmp_path / "model.xmi"
+    packaged_ids = lambda: {e.get("name"): e.get(f"{XMI}id") 
+                            for e in etree.parse(str(output_file)).iter("{*}packagedElement")}
+    runner.invoke(generate, ["tests/test_cases/full_all.sofa", str(output_file)])
+    previous = packaged_ids()
+    result = runner.invoke(generate, ["tests/test_cases/full_all.sofa", str(output_file), '--ids_from_xmi', str(output_file), 
+                                      *manifest])
+
+    assert result.exit_code == 0
+    assert len(previous) > 10 and packaged_ids() == previous
+
+def test_ids_from_xmi_invalid(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    xmi_file = tmp_path / "previous.xmi"
+    input_file.write_text("class A")
+    xmi_file.write_text("<xmi:XMI")
+    result = runner.invoke(generate, [str(input_file), str(tmp_path / "output.xmi"), '--ids_from_xmi', str(xmi_file)])
+
+    assert result.exit_code == 1
+    assert "Error: Cannot extract the IDs of" in result.output
+
+def test_generate_unresolved(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    input_file.write_text("class A:\n    attributes:\n        a:\n            cardinality: 1\n            type: Missing\n")
+    result = runner.invoke(generate, [str(input_file), str(tmp_path / "output.xmi")])
+
+    assert result.exit_code == 1
+    assert "Error: Type Missing referenced by a, but is not defined" in result.output
+
+def test_ids_from_xmi_without_xmi(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    input_file.write_text("class A")
+    result = runner.invoke(generate, [str(input_file), str(tmp_path / "output.puml"), '--type', 'puml', 
+                                      '--ids_from_xmi', str(input_file)])
+
+    assert result.exit_code == 1
+    assert "Error: IDs from an XMI file apply to XMI outputs only" in result.output
+
+def test_ids_from_xmi_and_file(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    input_file.write_text("class A")
+    result = runner.invoke(generate, [str(input_file), str(tmp_path / "output.xmi"), '--ids_file', str(input_file), 
+                                      '--ids_from_xmi', str(input_file)])
+
+    assert result.exit_code == 1
+    assert "Error: IDs are taken either from an ID file or from an XMI file" in result.output
+
+def test_generate_xmi_stream(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.xmi"
+    input_file.write_text("class A")
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'xmi', '--xmi_engine', 'stream'])
+
+    assert result.exit_code == 0
+    assert "packagedElement" in output_file.read_text()
+
+def test_generate_xmi_compact_gzip(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.xmi.gz"
+    input_file.write_text("class A")
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'xmi', '--compact', '--gzip'])
+
+    assert result.exit_code == 0
+    content = gzip.decompress(output_file.read_bytes())
+    assert b"\n" not in content
+    assert b'name="output"' in content
+
+def test_generate_xmi_cached(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.xmi"
+    input_file.write_text("class A")
+
+    for _ in range(2):
+        result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'xmi', '--xmi_engine', 'cached'])
+        assert result.exit_code == 0
+    assert "packagedElement" in output_file.read_text()
+    assert (tmp_path / "output.xmi.cache").exists()
+
+@pytest.mark.parametrize("threads", [[], ['--threads']])
+def test_generate_several_outputs(tmp_path, threads):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    xmi_file = tmp_path / "output.xmi"
+    puml_file = tmp_path / "output.puml"
+    input_file.write_text("class A")
+
+    result = runner.invoke(generate, [str(input_file), str(xmi_file), str(puml_file), 
+                                      '--type', 'xmi', '--type', 'puml'] + threads)
+
+    assert result.exit_code == 0
+    assert "packagedElement" in xmi_file.read_text()
+    assert "@startuml output" in puml_file.read_text()
+
+def test_generate_puml_diagrams(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.puml"
+    input_file.write_text("diagrams: [Main]\nclass A:\n    diagrams: [Main]\nclass B")
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'puml', '--diagrams'])
+
+    assert result.exit_code == 0
+    assert "class B" in output_file.read_text()
+    diagram = (tmp_path / "output.Main.puml").read_text()
+    assert "class A" in diagram
+    assert "class B" not in diagram
+
+def test_generate_puml_split(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.puml"
+    input_file.write_text("class A\nclass B\nclass C\nrelation A associates B")
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'puml', '--max_nodes', '2'])
+
+    assert result.exit_code == 0
+    assert "[[output.part1.puml]]" in output_file.read_text()
+    assert "A --> B" in (tmp_path / "output.part1.puml").read_text()
+    assert "class C" in (tmp_path / "output.part2.puml").read_text()
+
+def test_generate_puml_bundled(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.puml"
+    input_file.write_text("class A\nclass B\nrelation A associates B\nrelation B associates A")
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'puml', '--bundle', 'count'])
+
+    assert result.exit_code == 0
+    assert "A <--> B : 2" in output_file.read_text()
+
+def test_generate_puml_templates(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.puml"
+    templates_file = tmp_path / "templates.json"
+    input_file.write_text("class A")
+    templates_file.write_text(json.dumps({"header": "@startuml {name}\nskinparam monochrome true\n"}))
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'puml', 
+                                      '--puml_templates', str(templates_file)])
+
+    assert result.exit_code == 0
+    assert output_file.read_text().startswith("@startuml output\nskinparam monochrome true\n\nclass A")
+
+def test_generate_unchanged(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.puml"
+    input_file.write_text("class A")
+
+    runner.invoke(generate, [str(input_file), str(output_file), '--type', 'puml'])
+    os.utime(output_file, ns=(1, 1))
+    # The manifest is not trusted after the change of time, so the file is compared.
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'puml'])
+
+    assert result.exit_code == 0
+    assert output_file.stat().st_mtime_ns == 1
+    assert "output.puml" in json.loads((tmp_path / "sofaman.manifest.json").read_text())["files"]
+    # Nothing else is left next to the output.
+    assert sorted(os.listdir(tmp_path)) == ["input.sofa", "output.puml", "sofaman.manifest.json"]
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'puml', '--no_manifest'])
+    assert output_file.stat().st_mtime_ns != 1
+
+def test_generate_unchanged_side_files(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.xmi"
+    input_file.write_text("package a\nclass A:\n    package: a\nclass B\nrelation A associates B\n")
+    files = ["output.xmi", "output.xmi.cache", "output.xmi.ids.json"]
+    args = [str(input_file), str(output_file), '--xmi_engine', 'cached', '--write_ids']
+
+    runner.invoke(generate, args)
+    for name in files:
+        os.utime(tmp_path / name, ns=(1, 1))
+    result = runner.invoke(generate, args)
+
+    assert result.exit_code == 0
+    # The cache and the IDs are recorded in the manifest, and not written again either.
+    assert [(tmp_path / name).stat().st_mtime_ns for name in files] == [1, 1, 1]
+    assert sorted(json.loads((tmp_path / "sofaman.manifest.json").read_text())["files"]) == files
+    assert sorted(os.listdir(tmp_path)) == ["input.sofa", *files, "sofaman.manifest.json"]
+
+def test_generate_outputs_mismatch(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    input_file.write_text("class A")
+
+    result = runner.invoke(generate, [str(input_file), str(tmp_path / "a.xmi"), str(tmp_path / "b.xmi")])
+
+    assert result.exit_code != 0
+    assert "Expected one output per type" in result.output
+
+def test_generate_json(tmp_path):
+    runner = CliRunner()
+    input_file = tmp_path / "input.sofa"
+    output_file = tmp_path / "output.ndjson"
+    input_file.write_text("class A\nclass B\nrelation A associates B")
+
+    result = runner.invoke(generate, [str(input_file), str(output_file), '--type', 'json'])
+
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in output_file.read_text().splitlines()]
+    assert [record["kind"] for record in records] == ["model", "class", "class", "relation"]